@@ -1,13 +1,11 @@
 # -*- coding: utf-8 -*-
-from typing import Any
-
 import arrow
 from jinja2 import Template
 from pandas import DataFrame
 from stock_analysis.schemas import StockTick
-from stock_analysis.storage.sqlalchemy.databases import get_session
+from stock_analysis.storage.sqlalchemy.databases import get_readonly_session
 from stock_analysis.storage.sqlalchemy.models import InfluxdbAlertStrategy
-from stock_analysis.storage.influxdb.databases import df_client as influxdb
+from stock_analysis.storage.timeseries import backend
 from stock_analysis.alerts.notifiers import WeComNotifier
 
 
@@ -16,7 +14,7 @@ class InfluxdbWatchDog:
         self.notifier = WeComNotifier()
 
     def watch(self):
-        session = get_session()
+        session = get_readonly_session()
         for strategy in session.query(InfluxdbAlertStrategy).filter_by(enabled=True):
             if not self.detect(strategy):
                 continue
@@ -30,9 +28,7 @@ class InfluxdbWatchDog:
 
     @staticmethod
     def recover_newest_stock_tick(stock_code: str):
-        _, result = influxdb.query(
-            f"select * from stock_ticks where code = '{stock_code}' ORDER BY desc LIMIT 1"
-        ).popitem()
+        result = backend.latest("stock_ticks", stock_code)
         index = result.index[0]
         bids = [
             dict(
@@ -67,6 +63,6 @@ class InfluxdbWatchDog:
             .replace(microsecond=0)
             .isoformat(),
         )
-        _, result = influxdb.query(sql).popitem()  # type: Any, DataFrame
+        result: DataFrame = backend.query(sql)
         # 从 DataFrame 降维到 Series 再降维 到 bool
         return strategy.operator(result, strategy.threshold).any().any()
@@ -1,22 +1,32 @@
 # -*- coding: utf-8 -*-
-from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Iterator, List, Optional, Tuple
 import backtrader as bt
+import numpy as np
 
 import datetime as dt
 from influxdb import InfluxDBClient as idbclient
 from influxdb.exceptions import InfluxDBClientError
+from stock_analysis.storage.influxdb import retention
+from stock_analysis.storage.timeseries import backend
 
 
-TIMEFRAMES = dict(
-    (
-        (bt.TimeFrame.Seconds, "s"),
-        (bt.TimeFrame.Minutes, "m"),
-        (bt.TimeFrame.Days, "d"),
-        (bt.TimeFrame.Weeks, "w"),
-        (bt.TimeFrame.Months, "m"),
-        (bt.TimeFrame.Years, "y"),
-    )
-)
+# 各周期的秒数, 月线与年线没有固定长度, 按日线查询
+TIMEFRAME_SECONDS = {
+    bt.TimeFrame.Seconds: 1,
+    bt.TimeFrame.Minutes: 60,
+    bt.TimeFrame.Days: 86400,
+    bt.TimeFrame.Weeks: 604800,
+}
+
+
+def period_seconds(timeframe: int, compression: int) -> int:
+    return (compression or 1) * TIMEFRAME_SECONDS.get(timeframe, 86400)
+
+
+def parse_date(value: Optional[str]) -> Optional[dt.datetime]:
+    return dt.datetime.fromisoformat(value) if value else None
 
 
 class Data(bt.feeds.DataBase):
@@ -58,7 +68,31 @@ class OHLC(bt.feeds.DataBase):
         return True
 
 
+def time_windows(
+    start: dt.datetime, end: dt.datetime, seconds: int, bars: int
+) -> Iterator[Tuple[dt.datetime, dt.datetime]]:
+    """将 [start, end] 切分为最多包含 bars 根 k 线的窗口 [窗口开始, 窗口结束](均包含)
+
+    窗口边界与 GROUP BY time 的分组一样按 unix 时间对齐, 使每根 k 线只出现在一个窗口中
+    """
+    epoch = dt.datetime(1970, 1, 1)
+    step = seconds * bars
+    boundary = (int((start - epoch).total_seconds()) // step + 1) * step
+    cursor = start
+    while cursor <= end:
+        stop = epoch + dt.timedelta(seconds=boundary)
+        # 时间精度为秒, 窗口结束时间取下一个边界之前的最后一微秒
+        yield cursor, min(stop - dt.timedelta(microseconds=1), end)
+        cursor = stop
+        boundary += step
+
+
 class InfluxDB(bt.feeds.DataBase):
+    """按时间窗口分批查询 k 线, 消费当前窗口时在后台预取下一个窗口, 内存占用与回测的时间跨度无关
+
+    window_bars 为每个窗口最多包含的 k 线数量
+    """
+
     ndb: idbclient
     biter: Iterator
 
@@ -77,21 +111,13 @@ class InfluxDB(bt.feeds.DataBase):
         ("close", "close"),
         ("volume", "volume"),
         ("stock_code", None),
+        ("window_bars", 10000),
     )
 
     def start(self):
         super(InfluxDB, self).start()
-        from_dt = (
-            dt.datetime.fromisoformat(self.params.from_date)
-            if self.params.from_date
-            else None
-        )
-        to_dt = (
-            dt.datetime.fromisoformat(self.params.to_date)
-            if self.params.to_date
-            else None
-        )
         try:
+            # 每个窗口只读取一次, 不经过查询缓存, 以免历史窗口长期占用缓存
             self.ndb = idbclient(
                 self.p.host,
                 self.p.port,
@@ -102,55 +128,85 @@ class InfluxDB(bt.feeds.DataBase):
         except InfluxDBClientError as err:
             raise Exception("Failed to establish connection to InfluxDB: %s" % err)
 
-        tf = "{multiple}{timeframe}".format(
-            multiple=(self.p.compression if self.p.compression else 1),
-            timeframe=TIMEFRAMES.get(self.p.timeframe, "d"),
+        self.seconds = period_seconds(self.p.timeframe, self.p.compression)
+        self.aggregates = None
+        if self.p.dataname not in retention.SOURCES:
+            self.aggregates = dict(
+                open=f'first("{self.p.open}")',
+                high=f'max("{self.p.high}")',
+                low=f'min("{self.p.low}")',
+                close=f'last("{self.p.close}")',
+                volume=f'sum("{self.p.volume}")',
+            )
+
+        from_dt = parse_date(self.p.from_date) or self.first_time()
+        to_dt = parse_date(self.p.to_date) or dt.datetime.utcnow()
+        self.biter = iter([])
+        self.windows = (
+            time_windows(from_dt, to_dt, self.seconds, self.p.window_bars)
+            if from_dt
+            else iter([])
         )
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.prefetch()
 
-        if not from_dt:
-            begin = ""
-        else:
-            begin = "And time >= '{}'".format(from_dt)
+    def stop(self):
+        super(InfluxDB, self).stop()
+        self.executor.shutdown(wait=False)
+
+    def query(self, qstr: str) -> List[Dict]:
+        try:
+            return list(self.ndb.query(qstr).get_points())
+        except InfluxDBClientError as err:
+            raise Exception("InfluxDB query failed: %s" % err)
 
-        if not to_dt:
-            end = "And time <= now()"
+    def first_time(self) -> Optional[dt.datetime]:
+        """未指定 from_date 时, 从第一个数据点开始查询"""
+        conditions = [f"code='{self.p.stock_code}'"]
+        if self.aggregates is None:
+            source = retention.SOURCES[self.p.dataname]
+            aggregates = source.aggregates
+            conditions.extend(source.conditions)
         else:
-            end = "And time <= '{}'".format(to_dt)
-
-        # The query could already consider parameters like fromdate and todate
-        # to have the database skip them and not the internal code
-        qstr = (
-            'SELECT mean("{open_f}") AS "open", mean("{high_f}") AS "high", '
-            'mean("{low_f}") AS "low", mean("{close_f}") AS "close", '
-            'mean("{vol_f}") AS "volume" '
-            'FROM "{measurement}" '
-            "WHERE code='{stock_code}' {begin} {end} "
-            "GROUP BY time({timeframe}) fill(none)"
-        ).format(
-            open_f=self.p.open,
-            high_f=self.p.high,
-            low_f=self.p.low,
-            close_f=self.p.close,
-            vol_f=self.p.volume,
-            stock_code=self.p.stock_code,
-            timeframe=tf,
-            begin=begin,
-            end=end,
-            measurement=self.p.dataname,
+            aggregates = self.aggregates
+        points = self.query(
+            f'SELECT {aggregates["open"]} FROM "{self.p.dataname}" '
+            f"WHERE {' AND '.join(conditions)}"
         )
+        if not points:
+            return None
+        return dt.datetime.strptime(points[0]["time"], "%Y-%m-%dT%H:%M:%SZ")
 
+    def fetch(self, window: Tuple[dt.datetime, dt.datetime]) -> List[Dict]:
+        # 由 retention 选择能满足周期的最粗精度的聚合数据, 避免每次都聚合原始数据
         try:
-            dbars = list(self.ndb.query(qstr).get_points())
+            return retention.query_bars(
+                lambda qstr: list(self.ndb.query(qstr).get_points()),
+                self.p.dataname,
+                self.p.stock_code,
+                self.seconds,
+                start=window[0],
+                end=window[1],
+                aggregates=self.aggregates,
+            )
         except InfluxDBClientError as err:
             raise Exception("InfluxDB query failed: %s" % err)
 
-        self.biter = iter(dbars)
+    def prefetch(self):
+        window = next(self.windows, None)
+        self.pending = (
+            self.executor.submit(self.fetch, window) if window is not None else None
+        )
 
     def _load(self):
-        try:
-            bar = next(self.biter)
-        except StopIteration:
-            return False
+        bar = next(self.biter, None)
+        while bar is None:
+            if self.pending is None:
+                return False
+            dbars = self.pending.result()
+            self.prefetch()
+            self.biter = iter(dbars)
+            bar = next(self.biter, None)
 
         self.l.datetime[0] = bt.utils.date2num(
             dt.datetime.strptime(bar["time"], "%Y-%m-%dT%H:%M:%SZ")
@@ -163,3 +219,171 @@ class InfluxDB(bt.feeds.DataBase):
         self.l.volume[0] = bar["volume"]
 
         return True
+
+
+class TimeSeries(bt.feeds.DataBase):
+    """从 settings.TIMESERIES_BACKEND 配置的存储后端读取 k 线, 周期与聚合方式与 InfluxDB 相同"""
+
+    biter: Iterator
+
+    params = (
+        ("timeframe", bt.TimeFrame.Minutes),
+        ("from_date", None),
+        ("to_date", None),
+        ("stock_code", None),
+    )
+
+    def start(self):
+        super(TimeSeries, self).start()
+        bars = backend.bars(
+            self.p.dataname,
+            self.p.stock_code,
+            period_seconds(self.p.timeframe, self.p.compression),
+            start=parse_date(self.p.from_date),
+            end=parse_date(self.p.to_date),
+        )
+        self.biter = bars.itertuples()
+
+    def _load(self):
+        try:
+            bar = next(self.biter)
+        except StopIteration:
+            return False
+
+        self.l.datetime[0] = bt.utils.date2num(
+            bar.Index.tz_convert(None).to_pydatetime()
+        )
+
+        self.l.open[0] = bar.open
+        self.l.high[0] = bar.high
+        self.l.low[0] = bar.low
+        self.l.close[0] = bar.close
+        self.l.volume[0] = bar.volume
+
+        return True
+
+
+# backtrader 的时间数值为公历序数(1970-01-01 为 719163)加一天中的小数部分
+EPOCH_ORDINAL = 719163
+
+
+def epoch2num(seconds: np.ndarray) -> np.ndarray:
+    """批量将 unix 时间戳(秒)转换为 backtrader 的时间数值, 与逐个调用 bt.utils.date2num 的结果相同"""
+    return seconds / 86400.0 + EPOCH_ORDINAL
+
+
+BAR_COLUMNS = ["datetime", "open", "high", "low", "close", "volume"]
+
+
+def load_bars(
+    dataname: str,
+    stock_code: str,
+    seconds: int,
+    start: Optional[dt.datetime] = None,
+    end: Optional[dt.datetime] = None,
+) -> Dict[str, np.ndarray]:
+    """读取 k 线为 BAR_COLUMNS 各列的 float64 数组, datetime 为 backtrader 的时间数值"""
+    bars = backend.bars(dataname, stock_code, seconds, start=start, end=end)
+    if bars.empty:
+        return {name: np.array([]) for name in BAR_COLUMNS}
+    arrays = dict(datetime=epoch2num(bars.index.asi8 // 10 ** 9))
+    for name in BAR_COLUMNS[1:]:
+        arrays[name] = bars[name].values.astype(np.float64)
+    return arrays
+
+
+class SharedBars:
+    """放在共享内存中的 k 线数组, 其他进程通过 spec 映射同一份数据, 不需要重新读取"""
+
+    def __init__(self, shm: SharedMemory, size: int):
+        self.shm = shm
+        self.size = size
+        matrix = np.ndarray((len(BAR_COLUMNS), size), dtype=np.float64, buffer=shm.buf)
+        self.arrays = dict(zip(BAR_COLUMNS, matrix))
+
+    @classmethod
+    def create(cls, arrays: Dict[str, np.ndarray]) -> "SharedBars":
+        size = len(arrays["datetime"])
+        shm = SharedMemory(create=True, size=max(1, len(BAR_COLUMNS) * size * 8))
+        shared = cls(shm, size)
+        for name in BAR_COLUMNS:
+            shared.arrays[name][:] = arrays[name]
+        return shared
+
+    @classmethod
+    def attach(cls, spec: Tuple[str, int]) -> "SharedBars":
+        name, size = spec
+        return cls(SharedMemory(name=name), size)
+
+    @property
+    def spec(self) -> Tuple[str, int]:
+        return self.shm.name, self.size
+
+    def close(self):
+        # 释放引用 shm.buf 的数组后才能关闭
+        self.arrays = {}
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+class Preloaded(TimeSeries):
+    """一次性将整个时间范围的 k 线读取为连续的 NumPy 数组
+
+    preload 时直接将数组写入各 line 的缓冲区, 不再逐根 k 线调用 _load, 配合 runonce 可以向量化计算指标;
+    设置了 filter 或 tzinput 时退回到逐根加载。
+    shared 为 SharedBars.spec 时从共享内存读取 k 线, 不再查询存储后端。
+    """
+
+    params = (("shared", None),)
+
+    def start(self):
+        # 跳过 TimeSeries.start, 不创建逐行迭代器
+        bt.feeds.DataBase.start(self)
+        self.shared = None
+        if self.p.shared is not None:
+            self.shared = SharedBars.attach(self.p.shared)
+            self.arrays = self.shared.arrays
+        else:
+            self.arrays = load_bars(
+                self.p.dataname,
+                self.p.stock_code,
+                period_seconds(self.p.timeframe, self.p.compression),
+                start=parse_date(self.p.from_date),
+                end=parse_date(self.p.to_date),
+            )
+        self.cursor = 0
+
+    def stop(self):
+        super(Preloaded, self).stop()
+        self.arrays = {}
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
+
+    def preload(self):
+        if self._filters or self._ffilters or self.p.tzinput is not None:
+            return super(Preloaded, self).preload()
+
+        mask = (self.arrays["datetime"] >= self.fromdate) & (
+            self.arrays["datetime"] <= self.todate
+        )
+        size = int(mask.sum())
+        for name in self.lines.getlinealiases():
+            values = self.arrays.get(name)
+            values = values[mask] if values is not None else np.full(size, np.nan)
+            getattr(self.lines, name).array.frombytes(
+                np.ascontiguousarray(values, dtype=np.float64).tobytes()
+            )
+        self.cursor = len(mask)
+        self.home()
+
+    def _load(self):
+        if self.cursor >= len(self.arrays["datetime"]):
+            return False
+        for name, values in self.arrays.items():
+            getattr(self.l, name)[0] = values[self.cursor]
+        self.cursor += 1
+        return True
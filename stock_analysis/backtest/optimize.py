@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""基于 cerebro.optstrategy 的多进程参数寻优
+
+每只股票的 k 线只读取一次并放进共享内存, 各工作进程通过 Preloaded(shared=...) 映射同一份数据;
+每组参数的结果通过 optcallback 实时汇总, 最后按期末资产排序输出。
+"""
+import datetime
+import logging
+import math
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Type
+
+import backtrader as bt
+
+from stock_analysis.backtest.feeds import (
+    Preloaded,
+    SharedBars,
+    load_bars,
+    period_seconds,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_values(spec: str) -> List[float]:
+    """解析参数取值: 逗号分隔的列表(0.03,0.05), 或 start:stop:step 表示的闭区间(0.02:0.1:0.02)"""
+    if ":" in spec:
+        start, stop, step = (float(v) for v in spec.split(":"))
+        count = int(math.floor((stop - start) / step + 1e-9)) + 1
+        return [round(start + step * i, 10) for i in range(count)]
+    return [float(v) for v in spec.split(",")]
+
+
+def parse_grid(specs: Sequence[str]) -> Dict[str, List[Any]]:
+    """解析 name=values 形式的参数网格, 整数取值保持为 int"""
+    grid = {}
+    for spec in specs:
+        name, _, values = spec.partition("=")
+        if not values:
+            raise ValueError(f"invalid parameter spec: {spec}")
+        grid[name.strip()] = [
+            int(v) if float(v).is_integer() and "." not in values else v
+            for v in parse_values(values)
+        ]
+    return grid
+
+
+class Summary(bt.Analyzer):
+    """记录期末资产与已平仓的交易次数"""
+
+    def create_analysis(self):
+        self.rets = dict(value=0.0, trades=0)
+
+    def notify_trade(self, trade):
+        if trade.isclosed:
+            self.rets["trades"] += 1
+
+    def stop(self):
+        self.rets["value"] = self.strategy.broker.getvalue()
+
+
+@dataclass
+class OptimizeResult:
+    code: str
+    params: Dict[str, Any]
+    value: float
+    drawdown: float
+    trades: int
+
+
+class ResultTable:
+    """按期末资产排序的寻优结果, 作为 optcallback 实时接收每组参数的结果"""
+
+    def __init__(self, code: str, names: List[str], total: int, cash: float):
+        self.code = code
+        self.names = names
+        self.total = total
+        self.cash = cash
+        self.results: List[OptimizeResult] = []
+
+    def __call__(self, strats):
+        strat = strats[0]
+        summary = strat.analyzers.summary.get_analysis()
+        result = OptimizeResult(
+            code=self.code,
+            params={name: getattr(strat.p, name) for name in self.names},
+            value=summary["value"],
+            drawdown=strat.analyzers.drawdown.get_analysis().max.drawdown,
+            trades=summary["trades"],
+        )
+        self.results.append(result)
+        best = self.ranked(1)[0]
+        logger.info(
+            "[%s] %d/%d %s -> %.2f, best %.2f %s",
+            self.code,
+            len(self.results),
+            self.total,
+            result.params,
+            result.value,
+            best.value,
+            best.params,
+        )
+
+    def ranked(self, top: Optional[int] = None) -> List[OptimizeResult]:
+        results = sorted(self.results, key=lambda r: r.value, reverse=True)
+        return results[:top] if top else results
+
+    def format(self, top: Optional[int] = None) -> str:
+        header = ["rank", *self.names, "value", "return%", "drawdown%", "trades"]
+        rows = [
+            [
+                str(rank),
+                *(str(result.params[name]) for name in self.names),
+                f"{result.value:.2f}",
+                f"{(result.value / self.cash - 1) * 100:.2f}",
+                f"{result.drawdown:.2f}",
+                str(result.trades),
+            ]
+            for rank, result in enumerate(self.ranked(top), 1)
+        ]
+        widths = [
+            max(len(row[i]) for row in [header, *rows]) for i in range(len(header))
+        ]
+        lines = [
+            "  ".join(cell.rjust(width) for cell, width in zip(row, widths))
+            for row in [header, *rows]
+        ]
+        return f"{self.code}\n" + "\n".join(lines)
+
+
+def optimize(
+    strategy: Type[bt.Strategy],
+    code: str,
+    grid: Dict[str, List[Any]],
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    dataname: str = "stock_history",
+    timeframe: int = bt.TimeFrame.Days,
+    workers: Optional[int] = None,
+    cash: float = 100000.0,
+) -> ResultTable:
+    """遍历 grid 中所有参数组合回测 code, workers 为进程数(默认为 CPU 核数)"""
+    shared = SharedBars.create(
+        load_bars(dataname, code, period_seconds(timeframe, 1), start=start, end=end)
+    )
+    try:
+        total = math.prod(len(values) for values in grid.values())
+        table = ResultTable(code, list(grid), total, cash)
+        # 数据由工作进程从共享内存加载, 不需要 optdatas 预先加载后再序列化给每个任务
+        cerebro = bt.Cerebro(
+            preload=True, runonce=True, optdatas=False, optreturn=True, stdstats=False
+        )
+        cerebro.optstrategy(strategy, verbose=False, **grid)
+        cerebro.optcallback(table)
+        cerebro.adddata(
+            Preloaded(
+                dataname=dataname,
+                stock_code=code,
+                timeframe=timeframe,
+                shared=shared.spec,
+            )
+        )
+        cerebro.addanalyzer(Summary, _name="summary")
+        cerebro.addanalyzer(bt.analyzers.DrawDown, _name="drawdown")
+        cerebro.broker.setcash(cash)
+        cerebro.broker.set_coc(True)
+        cerebro.addsizer(bt.sizers.PercentSizerInt, percents=20)
+        logger.info(
+            "optimizing %s over %d bars with %d combinations", code, shared.size, total,
+        )
+        cerebro.run(maxcpus=workers)
+    finally:
+        shared.unlink()
+    return table
@@ -4,18 +4,38 @@ import logging
 from typing import Tuple
 
 import backtrader as bt
-from stock_analysis import settings
-from stock_analysis.backtest.feeds import InfluxDB
+from stock_analysis.backtest.feeds import Preloaded
 from stock_analysis.utils.timeit import catch_time
 
 
 class AOStrategy(bt.SignalStrategy):
+    """AO 指标的零轴穿越与碟形买卖策略, 涨跌幅均为相对持仓成本的比例"""
+
+    params = (
+        # 持仓收益在 (add_lower, add_upper) 之间且现金充足时加仓
+        ("add_lower", -0.02),
+        ("add_upper", 0.2),
+        # 持有超过 stop_loss_days 天且亏损超过 stop_loss 时止损, 亏损超过 hard_stop_loss 时直接止损
+        ("stop_loss", 0.05),
+        ("stop_loss_days", 5),
+        ("hard_stop_loss", 0.1),
+        # 持有超过 take_profit_days 天且收益超过 take_profit 时止盈减仓
+        ("take_profit", 0.5),
+        ("take_profit_days", 5),
+        # 持有不足 arbitrage_days 天且收益超过 arbitrage_profit 时套利减仓
+        ("arbitrage_profit", 0.1),
+        ("arbitrage_days", 3),
+        ("verbose", True),
+    )
+
     def __init__(self):
         self.AO = bt.ind.AO()
         self.order = None
         self.buy_date = None
 
     def log(self, txt):
+        if not self.p.verbose:
+            return
         dt = self.data.datetime.datetime()
         logging.info("%s, %s" % (dt.isoformat(), txt))
 
@@ -54,7 +74,7 @@ class AOStrategy(bt.SignalStrategy):
                 cost = self.position.size * self.position.price
                 delta = (self.data.close[0] * self.position.size - cost) / cost
                 if (
-                    -0.02 < delta < 0.2
+                    self.p.add_lower < delta < self.p.add_upper
                     and self.broker.cash / self.broker.getvalue() > 0.5
                 ):
                     self.order = self.buy()
@@ -87,20 +107,25 @@ class AOStrategy(bt.SignalStrategy):
         if self.buy_date == today:
             return False, None
         # 止损
-        if delta < -0.05 and (today - self.buy_date) > datetime.timedelta(days=5):
+        holding = today - self.buy_date
+        if delta < -self.p.stop_loss and holding > datetime.timedelta(
+            days=self.p.stop_loss_days
+        ):
             self.log(f"止损, 亏损: {delta}")
             return True, self.close
-        if delta < -0.1:
+        if delta < -self.p.hard_stop_loss:
             self.log(f"止损, 亏损: {delta}")
             return True, self.close
         # 止盈
-        if delta > 0.5 and (today - self.buy_date) > datetime.timedelta(days=5):
+        if delta > self.p.take_profit and holding > datetime.timedelta(
+            days=self.p.take_profit_days
+        ):
             self.log(f"止盈, 减仓, 当前收益: {delta}")
             return True, self.sell
         if (
-            delta > 0.10
+            delta > self.p.arbitrage_profit
             and self.broker.cash / self.broker.getvalue() < 0.75
-            and (today - self.buy_date) < datetime.timedelta(days=3)
+            and holding < datetime.timedelta(days=self.p.arbitrage_days)
         ):
             self.log(f"套利, 减仓, 当前收益: {delta}")
             return True, self.sell
@@ -121,17 +146,17 @@ class AOStrategy(bt.SignalStrategy):
 
 def main():
     with catch_time() as ctx:
-        cerebro = bt.Cerebro(runonce=False)
+        cerebro = bt.Cerebro(preload=True, runonce=True)
         cerebro.addstrategy(AOStrategy)
-        data = InfluxDB(
-            **settings.INFLUXDB_CONF,
+        # replaydata 不支持 preload, 直接读取日线, 由 Preloaded 一次性加载后向量化计算指标
+        data = Preloaded(
             dataname="stock_history",
             stock_code="SZ.300274",
+            timeframe=bt.TimeFrame.Days,
             from_date="2020-01-01",
             to_date="2020-10-01",
         )
-        cerebro.replaydata(data, timeframe=bt.TimeFrame.Days, compression=True)
-        # cerebro.adddata(data)
+        cerebro.adddata(data)
         cerebro.broker.setcash(100000.0)
         cerebro.broker.set_coc(True)
         cerebro.broker.set_coo(False)
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
+import functools
 
 import arrow
 import click
+from stock_analysis import settings
 from stock_analysis.alerts.watchdogs import InfluxdbWatchDog
+from stock_analysis.backtest.optimize import optimize, parse_grid
+from stock_analysis.backtest.strategies.ao import AOStrategy
 from stock_analysis.constants import MarketType, IntervalType
 from stock_analysis.datasources.easyquotation.persistence import (
     SinaTickSynchronizer,
@@ -12,12 +16,19 @@ from stock_analysis.datasources.futuapi.persistence import (
     FUTUStockInfoBatchSynchronizer,
     FUTUTickSynchronizer,
 )
+from stock_analysis.datasources.futuapi.client import TradingDaysFetcher
 from stock_analysis.datasources.futuapi.handlers import receive_futu_notify
-from stock_analysis.datasources.joinquant.persistence import JQStockHistorySynchronizer
+from stock_analysis.datasources.joinquant.backfill import JQHistoryBackfill
 from stock_analysis.schemas import DateTimeRange
-from stock_analysis.utils.daemon import Daemon
-from stock_analysis.utils.basic import detect_stock_market
+from stock_analysis.utils.daemon import Daemon, Plugin
+from stock_analysis.utils.basic import detect_stock_market, detect_stock_markets
+from stock_analysis.utils.trading_calendar import TradingCalendar
 from stock_analysis.storage.sqlalchemy import databases, models
+from stock_analysis.storage.sqlalchemy.migrations import migrate
+from stock_analysis.storage.influxdb import retention
+from stock_analysis.storage.influxdb.cache import query_cache
+from stock_analysis.storage.influxdb.databases import client
+from stock_analysis.storage.timeseries import backend
 
 
 @click.group()
@@ -26,9 +37,44 @@ def cli():
 
 
 @cli.command()
-@click.argument("market", type=click.Choice([t.value for t in MarketType]))
-def fetch_stock_base_info_by_futuapi(market: str):
-    synchronizer = FUTUStockInfoBatchSynchronizer(market)
+def init_db():
+    """创建 SQLite 中尚不存在的数据表"""
+    databases.Base.metadata.create_all()
+    # 新建的表已是最新结构, 迁移只需要补充缺失的部分
+    migrate()
+
+
+@cli.command(name="migrate")
+def migrate_db():
+    """执行数据库迁移"""
+    for name in migrate():
+        click.echo(f"applied {name}")
+
+
+@cli.command()
+@click.option("--rollup-from", type=str, default=None, help="聚合该日期之后已有的数据")
+def setup_influxdb_retention(rollup_from):
+    """创建 InfluxDB 各精度聚合数据的 retention policy 与 continuous query"""
+    for action in retention.setup(client):
+        click.echo(action)
+    if rollup_from:
+        start = arrow.get(rollup_from).naive
+        end = arrow.utcnow().naive
+        for measurement in retention.SOURCES:
+            retention.rollup(client, measurement, start, end)
+
+
+@cli.command()
+@click.argument("market", nargs=-1, type=click.Choice([t.value for t in MarketType]))
+def fetch_stock_base_info_by_futuapi(market):
+    """并发同步多个市场的股票基本信息, 默认同步 SH/SZ/HK/US"""
+    markets = [MarketType(m) for m in market] or [
+        MarketType.SH,
+        MarketType.SZ,
+        MarketType.HK,
+        MarketType.US,
+    ]
+    synchronizer = FUTUStockInfoBatchSynchronizer(markets)
     synchronizer.synchronize()
 
 
@@ -45,26 +91,79 @@ def fetch_stock_base_info_by_tencentapi():
     type=click.Choice([t.value for t in IntervalType]),
     default=IntervalType.ONE_MINUTE,
 )
-@click.option("--code", multiple=True, type=str, required=True)
+@click.option("--code", multiple=True, type=str)
 @click.option("-s", "--start", type=str, default="2015-01-01")
 @click.option("-e", "--end", type=str, default=None)
-def fetch_stock_history_info_by_joinquant(code, interval, start, end):
-    for start_dt, end_dt in arrow.Arrow.span_range(
-        "years", arrow.get(start), arrow.get(end)
-    ):
+@click.option("-w", "--workers", type=int, default=4, help="并发请求数")
+@click.option("--max-rows", type=int, default=200000, help="单次请求最多返回的行数")
+@click.option("--resume", is_flag=True, default=False, help="继续最近一次未完成的回填")
+def fetch_stock_history_info_by_joinquant(
+    code, interval, start, end, workers, max_rows, resume
+):
+    """回填历史行情, 已回填的时间段会被跳过"""
+    if resume:
+        backfill = JQHistoryBackfill.resume(workers=workers, max_rows=max_rows)
+        if backfill is None:
+            click.echo("no unfinished backfill job")
+            return
+    else:
+        if not code:
+            raise click.UsageError("Missing option '--code'.")
         dr = DateTimeRange(
-            start_dt=start_dt.datetime, end_dt=end_dt.datetime, interval=interval
+            start_dt=arrow.get(start).naive,
+            end_dt=(arrow.get(end) if end else arrow.now()).ceil("day").naive,
+            interval=interval,
+        )
+        backfill = JQHistoryBackfill(
+            code_list=sorted(set(code)), dr=dr, workers=workers, max_rows=max_rows
         )
-        synchronizer = JQStockHistorySynchronizer(code_list=set(code), dr=dr)
-        synchronizer.synchronize()
+    backfill.synchronize()
+
+
+@cli.command()
+@click.option("--code", multiple=True, required=True, type=str)
+@click.option("-s", "--start", type=str, default="2018-01-01")
+@click.option("-e", "--end", type=str, default=None)
+@click.option(
+    "-p",
+    "--param",
+    multiple=True,
+    help="参数取值, 如 stop_loss=0.03,0.05 或 stop_loss=0.02:0.1:0.02, 未指定的参数使用默认值",
+)
+@click.option("-w", "--workers", type=int, default=None, help="进程数, 默认为 CPU 核数")
+@click.option("--top", type=int, default=20, help="输出排名前 N 的参数组合")
+def optimize_ao(code, start, end, param, workers, top):
+    """AOStrategy 日线参数寻优"""
+    try:
+        grid = parse_grid(param)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--param")
+    unknown = set(grid) - set(AOStrategy.params._getkeys())
+    if unknown:
+        raise click.BadParameter(
+            f"unknown params: {sorted(unknown)}", param_hint="--param"
+        )
+    for stock_code in code:
+        table = optimize(
+            AOStrategy,
+            stock_code,
+            grid,
+            start=arrow.get(start).naive,
+            end=(arrow.get(end) if end else arrow.now()).ceil("day").naive,
+            workers=workers,
+        )
+        click.echo(table.format(top))
 
 
 @cli.command()
 @click.option("--fetch-data/--no-fetch-data", default=True)
 @click.option("-n", "--notify", type=bool, default=False, is_flag=True)
 @click.option("--listen-futu-callback", type=bool, default=False, is_flag=True)
-def daemon(fetch_data, notify, listen_futu_callback):
-    session = databases.get_session()
+@click.option(
+    "--futu-push/--futu-polling", default=False, help="订阅富途行情推送, 超出订阅额度的股票仍轮询快照",
+)
+def daemon(fetch_data, notify, listen_futu_callback, futu_push):
+    session = databases.get_readonly_session()
     code_list = [
         item[0] for item in session.query(models.StockBaseInfo.stock_code).all()
     ]
@@ -72,32 +171,53 @@ def daemon(fetch_data, notify, listen_futu_callback):
     plugins = []
 
     if fetch_data:
+        synchronizer = SinaTickSynchronizer(
+            [code for code in code_list if detect_stock_market(code) in ["SZ", "SH"]]
+        )
         plugins.append(
-            SinaTickSynchronizer(
-                [
-                    code
-                    for code in code_list
-                    if detect_stock_market(code) in ["SZ", "SH"]
-                ]
-            ).synchronize
+            Plugin(synchronizer.synchronize, period=3, markets=synchronizer.markets)
+        )
+        synchronizer = FUTUTickSynchronizer(
+            [code for code in code_list if detect_stock_market(code) in {"HK", "US"}],
+            push=futu_push,
         )
         plugins.append(
-            FUTUTickSynchronizer(
-                [
-                    code
-                    for code in code_list
-                    if detect_stock_market(code) in {"HK", "US"}
-                ]
-            ).synchronize
+            Plugin(
+                synchronizer.synchronize,
+                period=3,
+                timeout=10,
+                markets=synchronizer.markets,
+            )
         )
+        if settings.TIMESERIES_BACKEND == "influxdb":
+            # InfluxDB 恢复后及时回放 spool, 不受交易时间限制
+            plugins.append(Plugin(backend.replay, period=60, timeout=600))
+            # 每天删除超过保留时长的 tick
+            plugins.append(
+                Plugin(
+                    functools.partial(retention.prune, client),
+                    period=86400,
+                    timeout=600,
+                    name="retention.prune",
+                )
+            )
+            if query_cache is not None:
+                plugins.append(Plugin(query_cache.report, period=600))
 
     if notify:
-        plugins.append(InfluxdbWatchDog().watch)
+        plugins.append(
+            Plugin(
+                InfluxdbWatchDog().watch,
+                period=3,
+                timeout=10,
+                markets=detect_stock_markets(code_list),
+            )
+        )
 
     if listen_futu_callback:
         receive_futu_notify()
 
     try:
-        Daemon(plugins).loop()
+        Daemon(plugins, TradingCalendar(TradingDaysFetcher().fetch)).loop()
     except KeyboardInterrupt:
         raise
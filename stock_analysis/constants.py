@@ -19,6 +19,10 @@ class StockFinancialType(Enum):
     third_quarter = "third_quarter"
 
 
+# 无法得知报告期时(如富途条件选股只返回最新一期财报)使用的报告期
+LATEST_REPORT_PERIOD = "latest"
+
+
 class IntervalType(str, Enum):
     """单位时间长度"""
 
@@ -28,6 +32,21 @@ class IntervalType(str, Enum):
     FIVE_DAY = "5d"
 
 
+class OverflowPolicy(str, Enum):
+    """写入队列已满时的处理策略"""
+
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+
+
+class BackfillStatus(str, Enum):
+    """历史行情回填任务状态"""
+
+    RUNNING = "running"
+    FINISHED = "finished"
+
+
 class AlertOperator(str, Enum):
     """阈值告警对比逻辑"""
 
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 import abc
 import datetime
-import pytz
-from typing import List, Dict
+import logging
+import math
+import threading
+import time
+from typing import Any, Callable, List, Dict, Optional, Tuple
+
+import numpy as np
 
 from stock_analysis.schemas import (
     BaseModel,
@@ -10,12 +15,14 @@ from stock_analysis.schemas import (
     StockBaseInfo,
     StockHistogramItem,
     StockTick,
-    QuotedPrice,
+    TickBatch,
 )
-from stock_analysis.storage.influxdb.databases import client as db
+from stock_analysis import settings
+from stock_analysis.storage.buffer import BufferStats, WriteBehindBuffer
+from stock_analysis.storage.timeseries import backend
 from stock_analysis.storage.sqlalchemy import databases, models
 
-DEFAULT_EPOCH = datetime.datetime(1970, 1, 1)
+logger = logging.getLogger(__name__)
 
 
 class BaseRealTimeClient(metaclass=abc.ABCMeta):
@@ -26,7 +33,7 @@ class BaseRealTimeClient(metaclass=abc.ABCMeta):
         """获取指定股票的实时行情报价"""
 
     @abc.abstractmethod
-    def get_tick_batch(self, code_list: List[str]) -> List[StockTick]:
+    def get_tick_batch(self, code_list: List[str]) -> TickBatch:
         """批量获取指定股票列表的实时行情报价"""
 
     @abc.abstractmethod
@@ -43,12 +50,45 @@ class BaseHistoryClient(metaclass=abc.ABCMeta):
 
 
 class BaseDBWriter(metaclass=abc.ABCMeta):
-    """股票信息更新器"""
+    """股票信息更新器
+
+    write_behind 不为空时, submit 会将 obj 放入 WriteBehindBuffer(write_behind 即其参数), 由后台线程写入
+    """
+
+    write_behind: Optional[Dict[str, Any]] = None
+    _buffer: Optional[WriteBehindBuffer] = None
 
     @abc.abstractmethod
     def write_to_db(self, obj: BaseModel):
         """将 obj 写进数据库"""
 
+    def submit(self, obj):
+        """写入 obj, 开启了 write_behind 时异步写入"""
+        if self.write_behind is None:
+            return self.write_to_db(obj)
+        if self._buffer is None:
+            self._buffer = WriteBehindBuffer(
+                self.flush_to_db,
+                weigh=self.weigh,
+                name=f"{type(self).__name__}-writer",
+                **self.write_behind,
+            )
+        self._buffer.put(obj)
+
+    def flush_to_db(self, objs: List):
+        """由后台线程调用, 批量写入多个 obj"""
+        for obj in objs:
+            self.write_to_db(obj)
+
+    @staticmethod
+    def weigh(obj) -> int:
+        """obj 在写入队列中占用的容量"""
+        return 1
+
+    @property
+    def write_behind_stats(self) -> Optional[BufferStats]:
+        return self._buffer.stats if self._buffer is not None else None
+
 
 class BaseSynchronizer(metaclass=abc.ABCMeta):
     """同步器协议"""
@@ -62,56 +102,175 @@ class StockInfoUpdater(BaseDBWriter):
     session: databases.Session
 
     def write_to_db(self, obj: StockBaseInfo):
-        stock_base_info, _ = databases.get_or_create(
+        self.flush_to_db([obj])
+
+    def flush_to_db(self, objs: List[StockBaseInfo]):
+        databases.bulk_upsert(
             self.session,
-            models.StockBaseInfo(
-                stock_code=obj.code,
-                stock_name=obj.name,
-                pe_annual=obj.pe_annual,
-                pe_ttm=obj.pe_ttm,
-                pb_rate=obj.pb_rate,
-            ),
+            models.StockBaseInfo,
+            [
+                dict(
+                    stock_code=obj.code,
+                    stock_name=obj.name,
+                    pe_annual=obj.pe_annual,
+                    pe_ttm=obj.pe_ttm,
+                    pb_rate=obj.pb_rate,
+                )
+                for obj in objs
+            ],
         )
 
 
-def format_datetime(dt: datetime.datetime) -> str:
-    """transfer datetime to iso-format, and make sure the datetime is base on utc tz"""
-    EPOCH = DEFAULT_EPOCH
-    if dt.tzinfo is not None:
-        EPOCH = datetime.datetime(1970, 1, 1, tzinfo=dt.tzinfo)
+class StockTickWriter(BaseDBWriter):
+    table_name = "stock_ticks"
+    source_type: str
+    write_behind = settings.TICK_WRITE_BEHIND
+    _volume_tracker: Optional["TickVolumeTracker"] = None
 
-    dt = EPOCH + datetime.timedelta(seconds=dt.timestamp())
-    return dt.replace(microsecond=0, tzinfo=pytz.utc).isoformat()
+    def flush_to_db(self, objs: List[TickBatch]):
+        self.write_to_db(TickBatch.concat(objs))
 
+    @staticmethod
+    def weigh(obj: TickBatch) -> int:
+        return len(obj)
 
-def format_quotations(prefix: str, prices: List[QuotedPrice]) -> Dict:
-    ret = {}
-    for idx, quotation in enumerate(prices):
-        ret.update(
-            {
-                f"{prefix}_{idx + 1}_price": quotation.value,
-                f"{prefix}_{idx + 1}_volume": quotation.volume,
-            }
+    def write_to_db(self, batch: TickBatch):
+        if self._volume_tracker is None:
+            self._volume_tracker = TickVolumeTracker(self.latest_cumulative)
+        tick_volume, tick_turnover = self._volume_tracker.deltas(batch)
+        fields = dict(
+            name=batch.name,
+            current=batch.current,
+            volume=batch.volume,
+            turnover=batch.turnover,
+            tick_volume=tick_volume,
+            tick_turnover=tick_turnover,
+        )
+        for prefix in ["bid", "ask"]:
+            prices = getattr(batch, f"{prefix}_price")
+            volumes = getattr(batch, f"{prefix}_volume")
+            for level in range(batch.depth):
+                # 缺失的买卖盘档位不写入
+                fields[f"{prefix}_{level + 1}_price"] = prices[:, level]
+                fields[f"{prefix}_{level + 1}_volume"] = np.ma.masked_array(
+                    volumes[:, level], mask=np.isnan(prices[:, level])
+                )
+        backend.write_columns(
+            self.table_name,
+            tags=dict(code=batch.code, source_type=self.source_type),
+            fields=fields,
+            times=batch.time,
         )
-    return ret
 
+    def latest_cumulative(self) -> Dict[str, Tuple[int, float, float]]:
+        """一次查询当前交易日各股票已写入的 (交易日, 累计成交量, 累计成交额)"""
+        day = TickVolumeTracker.trading_day(time.time())
+        start = datetime.datetime.utcfromtimestamp(day * 86400 - TRADING_DAY_OFFSET)
+        latest = backend.last_values(self.table_name, ["volume", "turnover"], start)
+        return {
+            code: (day, float(row.volume), float(row.turnover))
+            for code, row in latest.dropna().iterrows()
+        }
 
-class StockTickWriter(BaseDBWriter):
-    table_name = "stock_ticks"
-    source_type: str
 
-    def write_to_db(self, objs: List[StockTick]):
-        data = [
-            dict(
-                measurement=self.table_name,
-                tags=dict(code=obj.code, source_type=self.source_type),
-                time=format_datetime(obj.time),
-                fields=dict(
-                    **format_quotations("ask", obj.asks),
-                    **format_quotations("bid", obj.bids),
-                    **obj.dict(include={"current", "volume", "turnover", "name"}),
-                ),
-            )
-            for obj in objs
-        ]
-        db.write_points(data)
+# A 股按北京时间划分交易日, tick 中的累计成交量与成交额在每个交易日开始时清零
+TRADING_DAY_OFFSET = 8 * 3600
+
+
+class TickVolumeTracker:
+    """将 tick 中当日累计的成交量、成交额转换为与同一交易日上一个 tick 之间的增量
+
+    增量按周期求和即为该周期的成交量, 跨周期与跨精度聚合时都不会遗漏;
+    每个交易日第一个 tick 的增量为其累计值, 包含集合竞价的成交。
+    进程启动后第一次计算时调用一次 seed, 以当日已写入的累计值作为起点, 避免重启后重复计算当日的成交量;
+    seed 失败(如 InfluxDB 不可用)时从 0 开始计算, 不影响写入。
+    """
+
+    def __init__(self, seed: Callable[[], Dict[str, Tuple[int, float, float]]]):
+        self.seed = seed
+        self.last: Dict[str, Tuple[int, float, float]] = {}
+        self._seeded = False
+        self._lock = threading.Lock()
+
+    def _seed(self):
+        self._seeded = True
+        try:
+            self.last.update(self.seed())
+        except Exception:
+            logger.warning("seed cumulative tick volume failed", exc_info=True)
+
+    @staticmethod
+    def trading_day(ts: float) -> int:
+        return (int(ts) + TRADING_DAY_OFFSET) // 86400
+
+    def deltas(self, batch: TickBatch) -> Tuple[np.ndarray, np.ndarray]:
+        """按 batch 中的顺序计算每个 tick 的成交量与成交额增量"""
+        tick_volume = np.full(len(batch), np.nan)
+        tick_turnover = np.full(len(batch), np.nan)
+        rows = zip(
+            batch.code.tolist(),
+            batch.time.tolist(),
+            batch.volume.tolist(),
+            batch.turnover.tolist(),
+        )
+        with self._lock:
+            if not self._seeded:
+                self._seed()
+            for idx, (code, ts, volume, turnover) in enumerate(rows):
+                if volume is None or turnover is None:
+                    continue
+                if math.isnan(volume) or math.isnan(turnover):
+                    continue
+                day = self.trading_day(ts)
+                last = self.last.get(code)
+                if last is None or last[0] != day:
+                    last = (day, 0.0, 0.0)
+                # 数据源偶尔返回回退的累计值, 不计为负的成交量
+                tick_volume[idx] = max(volume - last[1], 0)
+                tick_turnover[idx] = max(turnover - last[2], 0)
+                self.last[code] = (day, max(volume, last[1]), max(turnover, last[2]))
+        return tick_volume, tick_turnover
+
+
+class TickChangeDetector:
+    """按股票代码记录最近一次写入的 tick, 过滤掉行情未变化的 tick
+
+    tick 时间未变化(数据源返回了同一笔行情), 或者价格、成交量与买卖盘均未变化(如停牌)时视为未变化
+    """
+
+    def __init__(self):
+        self.last_seen: Dict[str, Tuple[int, bytes]] = {}
+        self.received = 0
+        self.suppressed = 0
+
+    @staticmethod
+    def fingerprints(batch: TickBatch) -> List[bytes]:
+        matrix = np.column_stack(
+            [
+                batch.current,
+                batch.volume,
+                batch.turnover,
+                batch.bid_price,
+                batch.bid_volume,
+                batch.ask_price,
+                batch.ask_volume,
+            ]
+        ).astype(np.float64)
+        return [row.tobytes() for row in matrix]
+
+    def filter(self, batch: TickBatch) -> TickBatch:
+        changed = np.ones(len(batch), dtype=bool)
+        rows = zip(batch.code.tolist(), batch.time.tolist(), self.fingerprints(batch))
+        for idx, (code, ts, fingerprint) in enumerate(rows):
+            last = self.last_seen.get(code)
+            if last is not None and (last[0] == ts or last[1] == fingerprint):
+                changed[idx] = False
+                continue
+            self.last_seen[code] = (ts, fingerprint)
+        self.received += len(batch)
+        self.suppressed += len(batch) - int(changed.sum())
+        return batch[changed]
+
+    @property
+    def suppressed_rate(self) -> float:
+        return self.suppressed / self.received if self.received else 0
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
+import abc
+import asyncio
 import logging
-from typing import Generator, List
+import threading
+import time
+from typing import Dict, Generator, List, Optional, Tuple
 
 import arrow
 import easyquotation
+import numpy as np
+import pandas as pd
 from stock_analysis.datasources.base import BaseRealTimeClient
-from stock_analysis.schemas import StockBaseInfo, StockTick
+from stock_analysis.schemas import StockBaseInfo, StockTick, TickBatch
+from stock_analysis.utils.http import AsyncHTTPConnectionPool
 
 
 logger = logging.getLogger(__name__)
@@ -19,6 +26,11 @@ def format_code(code: str) -> str:
     return code
 
 
+def to_vendor_code(code: str) -> str:
+    """SH.600000 -> sh600000"""
+    return code.replace(".", "").lower()
+
+
 class TencentStockInfoFetcher:
     def __init__(self):
         self.quotation = easyquotation.use("tencent")
@@ -45,11 +57,13 @@ class SinaRealTimeClient(BaseRealTimeClient):
         _, item = self.quotation.real(code).popitem()
         return self.parse_stock(code, item)
 
-    def get_tick_batch(self, code_list: List[str]) -> List[StockTick]:
-        return [
-            self.parse_stock(code, item)
-            for code, item in self.quotation.real(code_list, prefix=True).items()
-        ]
+    def get_tick_batch(self, code_list: List[str]) -> TickBatch:
+        return TickBatch.from_ticks(
+            [
+                self.parse_stock(code, item)
+                for code, item in self.quotation.real(code_list, prefix=True).items()
+            ]
+        )
 
     def get_money_flow(self, code: str):
         pass
@@ -74,3 +88,154 @@ class SinaRealTimeClient(BaseRealTimeClient):
             bids=bids,
             asks=asks,
         )
+
+
+class AsyncQuotationClient(BaseRealTimeClient):
+    """基于 asyncio 的实时行情客户端
+
+    将股票列表按 max_num 分片后通过 keep-alive 连接池并发请求, 逐行切分返回的文本,
+    每个分片收齐后再按列批量转换为 TickBatch。
+    请求在客户端私有的事件循环线程中执行, 以便在同步代码中直接调用且复用连接。
+    """
+
+    host: str
+    port = 80
+    # 每次请求的最大股票数
+    max_num: int
+    encoding = "gbk"
+    headers: Dict[str, str] = {}
+    field_separator: str
+    # 每行至少包含的字段数
+    width: int
+
+    def __init__(self, concurrency: int = 8, timeout: float = 5):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._pool: Optional[AsyncHTTPConnectionPool] = None
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(
+            target=self._loop.run_forever, name=type(self).__name__, daemon=True
+        ).start()
+
+    def get_tick(self, code: str) -> StockTick:
+        return self.get_tick_batch([code]).tick(0)
+
+    def get_tick_batch(self, code_list: List[str]) -> TickBatch:
+        return asyncio.run_coroutine_threadsafe(
+            self.fetch(code_list), self._loop
+        ).result()
+
+    def get_money_flow(self, code: str):
+        pass
+
+    async def fetch(self, code_list: List[str]) -> TickBatch:
+        if self._pool is None:
+            self._pool = AsyncHTTPConnectionPool(
+                self.host, self.port, maxsize=self.concurrency, timeout=self.timeout
+            )
+        codes = [to_vendor_code(code) for code in code_list]
+        shards = await asyncio.gather(
+            *(
+                self.fetch_shard(codes[idx : idx + self.max_num])
+                for idx in range(0, len(codes), self.max_num)
+            )
+        )
+        return TickBatch.concat(shards)
+
+    async def fetch_shard(self, codes: List[str]) -> TickBatch:
+        vendor_codes, rows = [], []
+        async for line in self._pool.iter_lines(self.build_path(codes), self.headers):
+            parsed = self.split_line(line.decode(self.encoding, "ignore"))
+            if parsed is not None:
+                vendor_codes.append(parsed[0])
+                rows.append(parsed[1])
+        try:
+            return self.build(vendor_codes, np.array(rows, dtype=str))
+        except ValueError:
+            logger.warning("ValueError When build batch, fallback to build row by row")
+        batches = []
+        for code, row in zip(vendor_codes, rows):
+            try:
+                batches.append(self.build([code], np.array([row], dtype=str)))
+            except ValueError:
+                logger.warning(f"ValueError When parse {code}: {row}")
+        return TickBatch.concat(batches)
+
+    def split_line(self, line: str) -> Optional[Tuple[str, List[str]]]:
+        """将一行响应切分为 (股票代码, 字段列表), 无数据时返回 None"""
+        # var hq_str_sh600000="..."; / v_sh600000="...";
+        key, _, body = line.partition('="')
+        fields = body.rstrip('";\r').split(self.field_separator)
+        if len(fields) < self.width:
+            return None
+        return key.rpartition("_")[2], fields[: self.width]
+
+    @abc.abstractmethod
+    def build_path(self, codes: List[str]) -> str:
+        """构造请求 codes 行情的 url path"""
+
+    @abc.abstractmethod
+    def build(self, codes: List[str], table: np.ndarray) -> TickBatch:
+        """将字段表(每行一只股票)按列转换为 TickBatch"""
+
+
+def to_int(column: np.ndarray) -> np.ndarray:
+    return column.astype(np.float64).astype(np.int64)
+
+
+class AsyncSinaRealTimeClient(AsyncQuotationClient):
+    host = "hq.sinajs.cn"
+    max_num = 800
+    headers = {"Referer": "http://finance.sina.com.cn/"}
+    field_separator = ","
+    width = 32
+
+    def build_path(self, codes: List[str]) -> str:
+        return f"/rn={int(time.time() * 1000)}&list={','.join(codes)}"
+
+    def build(self, codes: List[str], table: np.ndarray) -> TickBatch:
+        if not len(table):
+            return TickBatch.from_ticks([])
+        # 与 arrow.get 一致, 将行情时间视为 UTC
+        times = np.char.add(np.char.add(table[:, 30], "T"), table[:, 31])
+        # 字段含义与 easyquotation 保持一致: volume 为成交额, turnover 为成交量
+        return TickBatch(
+            code=np.array([format_code(code) for code in codes], dtype=object),
+            name=table[:, 0].astype(object),
+            time=times.astype("datetime64[s]").astype(np.int64),
+            current=table[:, 3].astype(np.float64),
+            volume=to_int(table[:, 9]),
+            turnover=to_int(table[:, 8]),
+            bid_volume=to_int(table[:, 10:20:2]),
+            bid_price=table[:, 11:20:2].astype(np.float64),
+            ask_volume=to_int(table[:, 20:30:2]),
+            ask_price=table[:, 21:30:2].astype(np.float64),
+        )
+
+
+class AsyncTencentRealTimeClient(AsyncQuotationClient):
+    host = "qt.gtimg.cn"
+    max_num = 60
+    field_separator = "~"
+    width = 50
+
+    def build_path(self, codes: List[str]) -> str:
+        return f"/q={','.join(codes)}"
+
+    def build(self, codes: List[str], table: np.ndarray) -> TickBatch:
+        if not len(table):
+            return TickBatch.from_ticks([])
+        times = pd.to_datetime(table[:, 30], format="%Y%m%d%H%M%S")
+        # 与 AsyncSinaRealTimeClient 保持一致: volume 为成交额, turnover 为成交量
+        return TickBatch(
+            code=np.array([format_code(code) for code in codes], dtype=object),
+            name=table[:, 1].astype(object),
+            time=times.values.astype("datetime64[s]").astype(np.int64),
+            current=table[:, 3].astype(np.float64),
+            volume=(table[:, 37].astype(np.float64) * 10000).astype(np.int64),
+            turnover=to_int(table[:, 36]) * 100,
+            bid_price=table[:, 9:19:2].astype(np.float64),
+            bid_volume=to_int(table[:, 10:20:2]) * 100,
+            ask_price=table[:, 19:29:2].astype(np.float64),
+            ask_volume=to_int(table[:, 20:30:2]) * 100,
+        )
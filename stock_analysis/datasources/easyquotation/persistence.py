@@ -1,27 +1,40 @@
 # -*- coding: utf-8 -*-
+import logging
 from typing import List
 
+from stock_analysis import settings
+from stock_analysis.constants import MarketType
 from stock_analysis.datasources.base import (
     BaseSynchronizer,
     StockInfoUpdater,
     StockTickWriter,
+    TickChangeDetector,
 )
 from stock_analysis.datasources.easyquotation.client import (
-    SinaRealTimeClient,
+    AsyncSinaRealTimeClient,
     TencentStockInfoFetcher,
 )
 from stock_analysis.storage.sqlalchemy import databases
 
 
+logger = logging.getLogger(__name__)
+
+
 class SinaTickSynchronizer(BaseSynchronizer, StockTickWriter):
     source_type = "sina"
+    markets = {MarketType.SH, MarketType.SZ}
 
     def __init__(self, code_list: List[str]):
         self.code_list = code_list
-        self.client = SinaRealTimeClient()
+        self.client = AsyncSinaRealTimeClient(**settings.REALTIME_QUOTATION)
+        self.change_detector = TickChangeDetector()
 
     def synchronize(self):
-        self.write_to_db(self.client.get_tick_batch(code_list=self.code_list))
+        ticks = self.client.get_tick_batch(code_list=self.code_list)
+        changed = self.change_detector.filter(ticks)
+        logger.debug("%d of %d ticks changed", len(changed), len(ticks))
+        if changed:
+            self.submit(changed)
 
 
 class TencentStockInfoBatchSynchronizer(BaseSynchronizer, StockInfoUpdater):
@@ -30,5 +43,4 @@ class TencentStockInfoBatchSynchronizer(BaseSynchronizer, StockInfoUpdater):
         self.fetcher = TencentStockInfoFetcher()
 
     def synchronize(self):
-        for obj in self.fetcher.iter():
-            self.write_to_db(obj)
+        self.flush_to_db(list(self.fetcher.iter()))
@@ -1,22 +1,40 @@
 # -*- coding: utf-8 -*-
+import datetime
 import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Tuple, Dict
+from typing import List, Optional, Tuple, Dict
 
+import numpy as np
+import pandas as pd
+from dateutil.tz import tzlocal
+from futu import RET_OK
 from futu.common import constant
-from futu.common.constant import FinancialQuarter, Market, SortDir, StockField
+from futu.common.constant import (
+    FinancialQuarter,
+    Market,
+    SortDir,
+    StockField,
+    TradeDateMarket,
+)
 from futu.quote.open_quote_context import FinancialFilter, SimpleFilter
 from stock_analysis.datasources.futuapi.context import get_quote_ctx
+from stock_analysis.datasources.futuapi.ratelimit import rate_limiter
 from stock_analysis.datasources.futuapi.schemas import (
     StockBaseInfo as FUTUStockBaseInfo,
 )
 from stock_analysis.utils.basic import detect_stock_market
 from stock_analysis.schemas import StockBaseInfo
 from stock_analysis.datasources.base import BaseRealTimeClient
-from stock_analysis.schemas import StockTick
+from pandas import DataFrame
+from stock_analysis.schemas import StockTick, TickBatch
+from stock_analysis.storage.sqlalchemy import databases, models
 
 logger = logging.getLogger(__name__)
 
+Book = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
 
 @dataclass
 class StockInfoFetcher:
@@ -78,7 +96,16 @@ class StockInfoFetcher:
     ) -> Tuple[bool, int, List[FUTUStockBaseInfo]]:
         """从 富途 API 批量获取股票基本信息"""
         ctx = get_quote_ctx()
-        ret, ls = ctx.get_stock_filter(Market.SZ, self.fields, begin=offset, num=limit)
+        ret, ls = rate_limiter.call(
+            "get_stock_filter",
+            ctx.get_stock_filter,
+            self.market,
+            self.fields,
+            begin=offset,
+            num=limit,
+        )
+        if ret != RET_OK:
+            raise ValueError(f"get_stock_filter failed: {ls}")
         result = (bool(ls[0]), ls[1], [])
         for obj in ls[2]:
             financial = {
@@ -102,7 +129,7 @@ class StockInfoFetcher:
                     pe_annual=obj.pe_annual,
                     pe_ttm=obj.pe_ttm,
                     pb_rate=obj.pb_rate,
-                    **financial
+                    **financial,
                 )
             )
         return result
@@ -121,53 +148,206 @@ class KLineFetcher:
     ):
         # TODO: 获取实时 k 线
         ctx = get_quote_ctx()
-        ret, ls = ctx.get_cur_kline(stock_code, num=limit, ktype=ktype, autype=autype)
+        ret, ls = rate_limiter.call(
+            "get_cur_kline",
+            ctx.get_cur_kline,
+            stock_code,
+            num=limit,
+            ktype=ktype,
+            autype=autype,
+        )
+
+
+@dataclass
+class TradingDaysFetcher:
+    """交易日获取"""
+
+    markets = {
+        Market.HK: TradeDateMarket.HK,
+        Market.US: TradeDateMarket.US,
+        Market.SH: TradeDateMarket.CN,
+        Market.SZ: TradeDateMarket.CN,
+    }
+
+    def fetch(self, market: str, year: int) -> Dict[datetime.date, str]:
+        """获取 market 在 year 年内的交易日及其交易类型(WHOLE/MORNING/AFTERNOON)"""
+        ctx = get_quote_ctx()
+        ret, data = rate_limiter.call(
+            "request_trading_days",
+            ctx.request_trading_days,
+            self.markets[market],
+            start=f"{year}-01-01",
+            end=f"{year}-12-31",
+        )
+        if ret != RET_OK:
+            raise ValueError(f"request_trading_days failed: {data}")
+        return {
+            datetime.date.fromisoformat(item["time"]): item["trade_date_type"]
+            for item in data
+        }
+
+
+def snapshot_to_batch(
+    datas: DataFrame, stock_info_maps: Dict[str, StockBaseInfo]
+) -> TickBatch:
+    """将 get_market_snapshot 返回的 DataFrame 按列转换为 TickBatch"""
+    bid_price, bid_volume = TickBatch.empty_book(len(datas))
+    ask_price, ask_volume = TickBatch.empty_book(len(datas))
+    # update_time 为不带时区的本地时间
+    times = pd.to_datetime(datas["update_time"]).dt.tz_localize(tzlocal())
+    return TickBatch(
+        code=datas["code"].values.astype(object),
+        # 获取不到基本信息时以股票代码作为名称
+        name=np.array(
+            [
+                stock_info_maps[code].name if code in stock_info_maps else code
+                for code in datas["code"]
+            ],
+            dtype=object,
+        ),
+        time=times.values.astype("datetime64[s]").astype(np.int64),
+        current=datas["last_price"].values.astype(np.float64),
+        volume=datas["volume"].values.astype(np.int64),
+        turnover=datas["turnover"].values.astype(np.int64),
+        bid_price=bid_price,
+        bid_volume=bid_volume,
+        ask_price=ask_price,
+        ask_volume=ask_volume,
+    )
+
+
+def quote_to_batch(
+    datas: DataFrame, stock_info_maps: Dict[str, StockBaseInfo], books: Dict[str, Book]
+) -> TickBatch:
+    """将报价推送的 DataFrame 转换为 TickBatch, 盘口使用 books 中最近一次推送的摆盘"""
+    batch = snapshot_to_batch(
+        datas.assign(update_time=datas["data_date"] + " " + datas["data_time"]),
+        stock_info_maps,
+    )
+    for idx, code in enumerate(batch.code):
+        if code in books:
+            (
+                batch.bid_price[idx],
+                batch.bid_volume[idx],
+                batch.ask_price[idx],
+                batch.ask_volume[idx],
+            ) = books[code]
+    return batch
+
+
+def parse_order_book(content: Dict) -> Book:
+    """将摆盘推送转换为 (bid_price, bid_volume, ask_price, ask_volume) 各 depth 档"""
+    bid_price, bid_volume = TickBatch.empty_book(1)
+    ask_price, ask_volume = TickBatch.empty_book(1)
+    for prices, volumes, items in [
+        (bid_price, bid_volume, content["Bid"]),
+        (ask_price, ask_volume, content["Ask"]),
+    ]:
+        # 每档为 (价格, 数量, 委托订单数, ...)
+        for level, item in enumerate(items[: TickBatch.depth]):
+            prices[0, level], volumes[0, level] = item[0], item[1]
+    return bid_price[0], bid_volume[0], ask_price[0], ask_volume[0]
 
 
 class FUTURealTimeClient(BaseRealTimeClient):
+    """富途实时行情
+
+    股票名称优先从 SQLite 的 StockBaseInfo 读取, 缺失的按市场批量从 OpenD 获取并写回数据库;
+    快照按 OpenD 单次请求上限分片后并发请求。
+    """
+
     stock_info_maps: Dict[str, StockBaseInfo] = {}
+    # get_market_snapshot 单次请求的股票数量上限
+    snapshot_limit = 400
 
-    def get_tick_batch(self, code_list: List[str]) -> List[StockTick]:
-        ctx = get_quote_ctx()
-        _, datas = ctx.get_market_snapshot(code_list)
-        stock_info_maps = {code: self.get_stock_info(code) for code in code_list}
-        return [
-            StockTick(
-                name=stock_info_maps[data["code"]].name,
-                code=stock_info_maps[data["code"]].code,
-                time=data["update_time"],
-                current=data["last_price"],
-                volume=data["volume"],
-                turnover=data["turnover"],
-            )
-            for idx, data in datas.iterrows()
+    def __init__(self, max_workers: int = 4):
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="futu")
+
+    def get_tick_batch(self, code_list: List[str]) -> TickBatch:
+        self.load_stock_info(code_list)
+        chunks = [
+            code_list[start : start + self.snapshot_limit]
+            for start in range(0, len(code_list), self.snapshot_limit)
         ]
+        frames = [
+            datas
+            for datas in self.executor.map(self.get_market_snapshot, chunks)
+            if datas is not None
+        ]
+        if not frames:
+            return TickBatch.from_ticks([])
+        return snapshot_to_batch(
+            pd.concat(frames, ignore_index=True), self.stock_info_maps
+        )
 
-    def get_tick(self, code: str) -> StockTick:
+    @staticmethod
+    def get_market_snapshot(code_list: List[str]) -> Optional[DataFrame]:
         ctx = get_quote_ctx()
-        _, data = ctx.get_market_snapshot([code])
-        stock_info = self.get_stock_info(code)
-        return StockTick(
-            # TODO: 获取名称
-            name=stock_info.name,
-            code=stock_info.code,
-            time=data["update_time"][0],
-            current=data["last_price"][0],
-            volume=data["volume"][0],
-            turnover=data["turnover"][0],
+        ret, datas = rate_limiter.call(
+            "get_market_snapshot", ctx.get_market_snapshot, code_list
         )
+        if ret != RET_OK:
+            logger.error("get_market_snapshot failed: %s", datas)
+            return None
+        return datas
+
+    def get_tick(self, code: str) -> StockTick:
+        return self.get_tick_batch([code]).tick(0)
 
     def get_money_flow(self, code: str):
         raise NotImplementedError
 
+    @classmethod
+    def load_stock_info(cls, code_list: List[str]):
+        """批量加载股票基本信息到 stock_info_maps"""
+        missing = [code for code in code_list if code not in cls.stock_info_maps]
+        if not missing:
+            return
+
+        session = databases.get_session()
+        try:
+            # SQLite 单条语句的参数数量有限, 分批查询
+            for start in range(0, len(missing), 500):
+                rows = session.query(
+                    models.StockBaseInfo.stock_code, models.StockBaseInfo.stock_name
+                ).filter(
+                    models.StockBaseInfo.stock_code.in_(missing[start : start + 500])
+                )
+                for code, name in rows:
+                    if name:
+                        cls.stock_info_maps[code] = StockBaseInfo(code=code, name=name)
+
+            missing_by_market: Dict[str, List[str]] = defaultdict(list)
+            for code in missing:
+                if code not in cls.stock_info_maps:
+                    missing_by_market[detect_stock_market(code)].append(code)
+            ctx = get_quote_ctx()
+            for market, codes in missing_by_market.items():
+                ret, data = rate_limiter.call(
+                    "get_stock_basicinfo",
+                    ctx.get_stock_basicinfo,
+                    market,
+                    code_list=codes,
+                )
+                if ret != RET_OK:
+                    logger.error("get_stock_basicinfo failed: %s", data)
+                    continue
+                for code, name in zip(data["code"], data["name"]):
+                    cls.stock_info_maps[code] = StockBaseInfo(code=code, name=name)
+                databases.bulk_upsert(
+                    session,
+                    models.StockBaseInfo,
+                    [
+                        dict(stock_code=code, stock_name=name)
+                        for code, name in zip(data["code"], data["name"])
+                    ],
+                )
+                logger.info("fetched %d stock info of %s", len(data), market)
+        finally:
+            session.close()
+
     @classmethod
     def get_stock_info(cls, code: str) -> StockBaseInfo:
         """获取股票的基本信息"""
-        if code not in cls.stock_info_maps:
-            ctx = get_quote_ctx()
-            ret, data = ctx.get_stock_basicinfo(
-                detect_stock_market(code), code_list=[code]
-            )
-            info = StockBaseInfo(code=data["code"][0], name=data["name"][0])
-            cls.stock_info_maps[code] = info
+        cls.load_stock_info([code])
         return cls.stock_info_maps[code]
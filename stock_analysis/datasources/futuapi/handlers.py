@@ -1,11 +1,26 @@
 # -*- coding: utf-8 -*-
 import logging
+from typing import Callable, Dict
 from jinja2 import Template
 from textwrap import dedent
-from futu import PriceReminderHandlerBase, RET_OK, RET_ERROR
+from futu import (
+    OrderBookHandlerBase,
+    PriceReminderHandlerBase,
+    StockQuoteHandlerBase,
+    RET_OK,
+    RET_ERROR,
+)
+from pandas import DataFrame
 
 from stock_analysis.alerts.notifiers import WeComNotifier
+from stock_analysis.datasources.futuapi.client import (
+    Book,
+    FUTURealTimeClient,
+    parse_order_book,
+    quote_to_batch,
+)
 from stock_analysis.datasources.futuapi.context import get_quote_ctx
+from stock_analysis.schemas import TickBatch
 
 
 logger = logging.getLogger(__name__)
@@ -35,6 +50,62 @@ class WeComPriceReminder(PriceReminderHandlerBase):
         return RET_OK, content
 
 
+class QuotePushHandler(StockQuoteHandlerBase):
+    def __init__(self, callback: Callable[[DataFrame], None]):
+        super().__init__()
+        self.callback = callback
+
+    def on_recv_rsp(self, rsp_pb):
+        ret_code, content = super().on_recv_rsp(rsp_pb)
+        if ret_code != RET_OK:
+            logger.error("QuotePushHandler: error, msg: %s" % content)
+            return RET_ERROR, content
+        try:
+            self.callback(content)
+        except Exception:
+            logger.exception("QuotePushHandler: handle quote failed")
+        return RET_OK, content
+
+
+class OrderBookPushHandler(OrderBookHandlerBase):
+    def __init__(self, callback: Callable[[Dict], None]):
+        super().__init__()
+        self.callback = callback
+
+    def on_recv_rsp(self, rsp_pb):
+        ret_code, content = super().on_recv_rsp(rsp_pb)
+        if ret_code != RET_OK:
+            logger.error("OrderBookPushHandler: error, msg: %s" % content)
+            return RET_ERROR, content
+        try:
+            self.callback(content)
+        except Exception:
+            logger.exception("OrderBookPushHandler: handle order book failed")
+        return RET_OK, content
+
+
+class TickPushReceiver:
+    """合并报价与摆盘推送: 摆盘推送只更新缓存的盘口, 每次报价推送生成一批 tick 交给 callback"""
+
+    def __init__(self, callback: Callable[[TickBatch], None]):
+        self.callback = callback
+        self.books: Dict[str, Book] = {}
+
+    def register(self):
+        ctx = get_quote_ctx()
+        ctx.set_handler(QuotePushHandler(self.on_quote))
+        ctx.set_handler(OrderBookPushHandler(self.on_order_book))
+
+    def on_quote(self, datas: DataFrame):
+        FUTURealTimeClient.load_stock_info(list(datas["code"]))
+        self.callback(
+            quote_to_batch(datas, FUTURealTimeClient.stock_info_maps, self.books)
+        )
+
+    def on_order_book(self, content: Dict):
+        self.books[content["code"]] = parse_order_book(content)
+
+
 def receive_futu_notify():
     ctx = get_quote_ctx()
     ctx.set_handler(WeComPriceReminder())
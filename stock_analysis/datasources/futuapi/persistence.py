@@ -1,20 +1,28 @@
 # -*- coding: utf-8 -*-
-import time
 import logging
-from typing import List
+import threading
+import time
+from collections import defaultdict
+from queue import Queue
+from typing import Dict, List
 
 from stock_analysis.constants import MarketType
 from stock_analysis.datasources.base import (
     BaseSynchronizer,
     BaseDBWriter,
     StockTickWriter,
+    TickChangeDetector,
 )
 from stock_analysis.datasources.futuapi.client import (
     StockInfoFetcher,
     FUTURealTimeClient,
 )
+from stock_analysis.datasources.futuapi.handlers import TickPushReceiver
 from stock_analysis.datasources.futuapi.schemas import StockBaseInfo
+from stock_analysis.datasources.futuapi.subscription import SubscriptionManager
+from stock_analysis.schemas import TickBatch
 from stock_analysis.storage.sqlalchemy import databases, models
+from stock_analysis.utils.basic import detect_stock_markets
 
 
 logger = logging.getLogger(__name__)
@@ -24,47 +32,129 @@ class FUTUStockInfoUpdater(BaseDBWriter):
     session: databases.Session
 
     def write_to_db(self, obj: StockBaseInfo):
-        stock_base_info, _ = databases.get_or_create(
+        self.flush_to_db([obj])
+
+    def flush_to_db(self, objs: List[StockBaseInfo]):
+        databases.bulk_upsert(
+            self.session,
+            models.StockBaseInfo,
+            [
+                dict(
+                    stock_code=obj.code,
+                    stock_name=obj.name,
+                    pe_annual=obj.pe_annual,
+                    pe_ttm=obj.pe_ttm,
+                    pb_rate=obj.pb_rate,
+                )
+                for obj in objs
+            ],
+        )
+        databases.bulk_upsert(
             self.session,
-            models.StockBaseInfo(
-                stock_code=obj.code,
-                stock_name=obj.name,
-                pe_annual=obj.pe_annual,
-                pe_ttm=obj.pe_ttm,
-                pb_rate=obj.pb_rate,
-            ),
+            models.StockFinancial,
+            [financial for obj in objs for financial in obj.list_financial()],
+            index_elements=["stock_code", "financial_type", "report_period"],
         )
-        for financial in obj.list_financial():
-            databases.get_or_create(self.session, models.StockFinancial(**financial))
 
 
 class FUTUStockInfoBatchSynchronizer(BaseSynchronizer, FUTUStockInfoUpdater):
-    def __init__(self, market: MarketType):
-        self.market = market
+    """并发同步多个市场的股票基本信息
+
+    每个市场一个线程翻页请求(共享 rate_limiter 的限额), 当前线程作为唯一的 SQLite 写入方,
+    因此写入第 N 页时已经在请求第 N+1 页。
+    """
+
+    page_size = 200
+
+    def __init__(self, markets: List[MarketType]):
+        self.markets = markets
         self.session = databases.get_session()
-        self.fetcher = StockInfoFetcher(market)
 
-    def synchronize(self):
+    def fetch_pages(self, market: MarketType, pages: Queue):
+        fetcher = StockInfoFetcher(market)
         offset = 0
-        while True:
-            # TODO: 优化 fetch_result 的建模
-            fetch_result = self.fetcher.batch_fetch(offset=offset)
-            offset += 200
-            for stock in fetch_result[2]:
-                self.write_to_db(stock)
-            time.sleep(10)
-            if fetch_result[0]:
-                break
+        try:
+            while True:
+                # TODO: 优化 fetch_result 的建模
+                fetch_result = fetcher.batch_fetch(limit=self.page_size, offset=offset)
+                offset += self.page_size
+                pages.put((market, fetch_result[2]))
+                if fetch_result[0]:
+                    break
+        except Exception:
+            logger.exception("fetch stock info of %s failed", market)
+        finally:
+            # None 表示该市场已结束
+            pages.put((market, None))
+
+    def synchronize(self):
+        # 限制预取的页数, 避免写入慢时积压过多数据
+        pages: Queue = Queue(maxsize=len(self.markets) * 2)
+        for market in self.markets:
+            threading.Thread(
+                target=self.fetch_pages,
+                args=(market, pages),
+                name=f"fetch-{market}",
+                daemon=True,
+            ).start()
+
+        started = time.monotonic()
+        rows: Dict[MarketType, int] = defaultdict(int)
+        running = len(self.markets)
+        while running:
+            market, stocks = pages.get()
+            elapsed = time.monotonic() - started
+            if stocks is None:
+                running -= 1
+                logger.info(
+                    "%s finished: %d rows in %.0fs, %.1f rows/s",
+                    market,
+                    rows[market],
+                    elapsed,
+                    rows[market] / elapsed,
+                )
+                continue
+            self.flush_to_db(stocks)
+            rows[market] += len(stocks)
+            logger.info(
+                "%s: %d rows, %.1f rows/s", market, rows[market], rows[market] / elapsed
+            )
 
 
 class FUTUTickSynchronizer(BaseSynchronizer, StockTickWriter):
+    """富途实时行情同步
+
+    push 为 True 时在订阅额度内订阅报价与摆盘推送, 收到推送即写入;
+    超出额度或订阅失败的股票仍由 synchronize 轮询快照。
+    """
+
     source_type = "futu"
 
-    def __init__(self, code_list: List[str]):
+    def __init__(self, code_list: List[str], push: bool = False):
         self.code_list = code_list
+        self.markets = detect_stock_markets(code_list)
         self.client = FUTURealTimeClient()
+        self.change_detector = TickChangeDetector()
+        # 推送回调与轮询在不同线程中写入
+        self.lock = threading.Lock()
+        self.polling_code_list = code_list
+        if push and code_list:
+            self.subscription = SubscriptionManager()
+            TickPushReceiver(self.write_ticks).register()
+            subscribed = self.subscription.subscribe(code_list)
+            self.polling_code_list = [
+                code for code in code_list if code not in subscribed
+            ]
 
     def synchronize(self):
-        logger.info(f"synchronizing {self.code_list}")
-        if self.code_list:
-            self.write_to_db(self.client.get_tick_batch(code_list=self.code_list))
+        logger.info(f"synchronizing {self.polling_code_list}")
+        if not self.polling_code_list:
+            return
+        self.write_ticks(self.client.get_tick_batch(code_list=self.polling_code_list))
+
+    def write_ticks(self, ticks: TickBatch):
+        with self.lock:
+            changed = self.change_detector.filter(ticks)
+        logger.debug("%d of %d ticks changed", len(changed), len(ticks))
+        if changed:
+            self.submit(changed)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""OpenD 接口限流: 每个接口一个令牌桶, 所有调用方共享"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from futu import RET_OK
+from stock_analysis import settings
+
+logger = logging.getLogger(__name__)
+
+# OpenD 返回的频率限制错误信息
+RATE_LIMIT_MESSAGES = ("频率", "frequen")
+
+
+class TokenBucket:
+    """每 period 秒最多 limit 次请求
+
+    令牌按 limit / period 的速率匀速补充, 桶容量为 limit, 因此空闲后允许一次性消耗整个周期的额度。
+    penalize 会清空令牌并暂停 backoff 秒, backoff 在连续触发限流时翻倍(最长 period 秒)。
+    """
+
+    def __init__(self, limit: int, period: float = 30):
+        self.limit = limit
+        self.period = period
+        self.rate = limit / period
+        self.tokens = float(limit)
+        self.backoff = 1.0
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.limit, self.tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self._blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def penalize(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = 0
+            self._blocked_until = now + self.backoff
+            self.backoff = min(self.backoff * 2, self.period)
+
+    def reset_backoff(self):
+        self.backoff = 1.0
+
+
+class RateLimiter:
+    """按接口名限流, 未配置限额的接口不限流"""
+
+    def __init__(
+        self, limits: Dict[str, int], period: float = 30, max_retries: int = 5
+    ):
+        self.buckets = {
+            endpoint: TokenBucket(limit, period) for endpoint, limit in limits.items()
+        }
+        self.max_retries = max_retries
+
+    def call(
+        self, endpoint: str, func: Callable[..., Tuple[int, Any]], *args, **kwargs
+    ) -> Tuple[int, Any]:
+        """限流后调用 OpenD 接口, 被 OpenD 限流时退避重试"""
+        bucket: Optional[TokenBucket] = self.buckets.get(endpoint)
+        if bucket is None:
+            return func(*args, **kwargs)
+
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            ret, data = func(*args, **kwargs)
+            if ret == RET_OK or not is_rate_limited(data):
+                bucket.reset_backoff()
+                return ret, data
+            logger.warning(
+                "%s is rate limited, retry in %.0fs: %s", endpoint, bucket.backoff, data
+            )
+            bucket.penalize()
+        return ret, data
+
+
+def is_rate_limited(data: Any) -> bool:
+    return isinstance(data, str) and any(
+        message in data.lower() for message in RATE_LIMIT_MESSAGES
+    )
+
+
+rate_limiter = RateLimiter(settings.FUTU_RATE_LIMITS)
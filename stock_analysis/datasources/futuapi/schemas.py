@@ -2,7 +2,7 @@
 from typing import Dict, List
 
 from pydantic import BaseModel
-from stock_analysis.constants import StockFinancialType
+from stock_analysis.constants import LATEST_REPORT_PERIOD, StockFinancialType
 from stock_analysis.schemas import StockBaseInfo as _StockBaseInfo
 
 
@@ -38,11 +38,15 @@ class StockBaseInfo(_StockBaseInfo):
     def list_financial(self) -> List[Dict]:
         result = []
         for quarter in StockFinancialType:
+            values = getattr(self, quarter.value).dict()
             result.append(
                 dict(
                     stock_code=self.code,
                     financial_type=quarter.value,
-                    values=getattr(self, quarter.value).dict(),
+                    # 条件选股接口只返回最新一期的财报, 没有报告期
+                    report_period=LATEST_REPORT_PERIOD,
+                    values=values,
+                    **values,
                 )
             )
         return result
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import logging
+from typing import List, Set
+
+from futu import RET_OK, SubType
+from stock_analysis.datasources.futuapi.context import get_quote_ctx
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionManager:
+    """在 OpenD 订阅额度内订阅报价与摆盘推送"""
+
+    subtypes = [SubType.QUOTE, SubType.ORDER_BOOK]
+
+    def __init__(self):
+        self.subscribed: Set[str] = set()
+
+    def subscribe(self, code_list: List[str]) -> Set[str]:
+        """按剩余额度依次订阅 code_list, 返回已订阅的股票"""
+        ctx = get_quote_ctx()
+        ret, data = ctx.query_subscription()
+        if ret != RET_OK:
+            logger.error("query_subscription failed: %s", data)
+            return self.subscribed
+
+        # 每只股票的每种订阅类型各占用 1 个额度
+        capacity = data["remain"] // len(self.subtypes)
+        candidates = [code for code in code_list if code not in self.subscribed]
+        if len(candidates) > capacity:
+            logger.warning(
+                "subscription quota remains %d, %d stocks will be polled",
+                data["remain"],
+                len(candidates) - capacity,
+            )
+            candidates = candidates[:capacity]
+        if not candidates:
+            return self.subscribed
+
+        ret, err = ctx.subscribe(candidates, self.subtypes)
+        if ret != RET_OK:
+            logger.error("subscribe failed: %s", err)
+            return self.subscribed
+        self.subscribed.update(candidates)
+        logger.info("subscribed %d stocks", len(candidates))
+        return self.subscribed
+
+    def unsubscribe_all(self):
+        """取消订阅, 注意 OpenD 要求订阅至少 1 分钟后才能取消"""
+        if not self.subscribed:
+            return
+        ctx = get_quote_ctx()
+        ret, err = ctx.unsubscribe(list(self.subscribed), self.subtypes)
+        if ret != RET_OK:
+            logger.error("unsubscribe failed: %s", err)
+            return
+        self.subscribed.clear()
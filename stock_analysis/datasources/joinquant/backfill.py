@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""并发回填 joinquant 历史行情"""
+import datetime
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+import jqdatasdk
+from pandas import DataFrame
+from stock_analysis.constants import BackfillStatus, IntervalType
+from stock_analysis.datasources.base import BaseSynchronizer
+from stock_analysis.datasources.joinquant.client import JQClient
+from stock_analysis.datasources.joinquant.coverage import CoverageIndex, RESOLUTION
+from stock_analysis.datasources.joinquant.persistence import (
+    StockHistoryWriter,
+    format_code,
+)
+from stock_analysis.schemas import DateTimeRange
+from stock_analysis.storage.influxdb import retention
+from stock_analysis.storage.sqlalchemy import databases, models
+from stock_analysis.storage.timeseries import backend
+
+logger = logging.getLogger(__name__)
+
+# 每个自然日最多的 k 线数量, 用于估算请求返回的行数
+BARS_PER_DAY = {
+    IntervalType.ONE_MINUTE: 240,
+    IntervalType.FIVE_MINUTES: 48,
+    IntervalType.ONE_DAY: 1,
+    IntervalType.FIVE_DAY: 1,
+}
+
+
+@dataclass
+class BackfillTask:
+    """一次 get_price 请求: 多只股票在同一时间窗口内的行情"""
+
+    code_list: List[str]
+    dr: DateTimeRange
+
+    @property
+    def estimated_rows(self) -> int:
+        days = (self.dr.end_dt - self.dr.start_dt).days + 1
+        return len(self.code_list) * days * BARS_PER_DAY[self.dr.interval]
+
+
+def plan_tasks(
+    code_list: List[str], dr: DateTimeRange, max_rows: int
+) -> List[BackfillTask]:
+    """按时间窗口与股票分组切分回填任务, 使每个任务估算的行数不超过 max_rows"""
+    bars = BARS_PER_DAY[dr.interval]
+    total_days = (dr.end_dt - dr.start_dt).days + 1
+    window_days = max(1, min(total_days, max_rows // bars))
+    codes_per_task = max(1, max_rows // (bars * window_days))
+
+    tasks = []
+    start_dt = dr.start_dt
+    while start_dt <= dr.end_dt:
+        next_start = start_dt + datetime.timedelta(days=window_days)
+        window = DateTimeRange(
+            start_dt=start_dt,
+            end_dt=min(next_start - datetime.timedelta(seconds=1), dr.end_dt),
+            interval=dr.interval,
+        )
+        for idx in range(0, len(code_list), codes_per_task):
+            tasks.append(BackfillTask(code_list[idx : idx + codes_per_task], window))
+        start_dt = next_start
+    return tasks
+
+
+@dataclass
+class BackfillProgress:
+    total: int
+    done: int = 0
+    failed: int = 0
+    rows: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def update(self, rows: int):
+        self.done += 1
+        self.rows += rows
+        elapsed = time.monotonic() - self.started
+        eta = elapsed / self.done * (self.total - self.done)
+        logger.info(
+            "backfill %d/%d tasks, %d rows, %.0f rows/s, ETA %s",
+            self.done,
+            self.total,
+            self.rows,
+            self.rows / elapsed,
+            datetime.timedelta(seconds=int(eta)),
+        )
+
+
+class JQHistoryBackfill(BaseSynchronizer, StockHistoryWriter):
+    """回填历史行情
+
+    只回填 history_coverage 中未记录的时间段, 每个任务写入成功后记录其时间段, 因此中断后重新执行即可从断点继续。
+    每个任务通过一次 get_price 获取多只股票的数据, 由 workers 个线程并发请求, 当前线程负责写入 InfluxDB;
+    提交任务前检查 joinquant 当日剩余的请求条数, 不足时停止提交。
+
+    dr 为不带时区的北京时间
+    """
+
+    def __init__(
+        self,
+        code_list: List[str],
+        dr: DateTimeRange,
+        workers: int = 4,
+        max_rows: int = 200000,
+        job: Optional[models.BackfillJob] = None,
+    ):
+        self.code_list = code_list
+        self.dr = dr
+        self.workers = workers
+        self.max_rows = max_rows
+        self.client = JQClient()
+        self.session = databases.get_session()
+        self.coverage = CoverageIndex(self.session)
+        self.job = job or models.BackfillJob(
+            code_list=code_list,
+            interval=dr.interval,
+            start_dt=dr.start_dt,
+            end_dt=dr.end_dt,
+        )
+
+    @classmethod
+    def resume(cls, **kwargs) -> Optional["JQHistoryBackfill"]:
+        """恢复最近一次未完成的回填任务"""
+        session = databases.get_session()
+        job = (
+            session.query(models.BackfillJob)
+            .filter_by(status=BackfillStatus.RUNNING)
+            .order_by(models.BackfillJob.id.desc())
+            .first()
+        )
+        session.close()
+        if job is None:
+            return None
+        dr = DateTimeRange(
+            start_dt=job.start_dt, end_dt=job.end_dt, interval=job.interval
+        )
+        return cls(code_list=job.code_list, dr=dr, job=job, **kwargs)
+
+    def plan(self) -> List[BackfillTask]:
+        """按缺失的时间段生成任务, 缺失时间段相同的股票合并请求"""
+        tasks = []
+        groups = self.coverage.gaps(
+            self.code_list, self.dr.interval, self.dr.start_dt, self.dr.end_dt
+        )
+        for gaps, code_list in groups.items():
+            for start_dt, end_dt in gaps:
+                dr = DateTimeRange(
+                    start_dt=start_dt, end_dt=end_dt, interval=self.dr.interval
+                )
+                tasks.extend(plan_tasks(code_list, dr, self.max_rows))
+        return tasks
+
+    def mark_covered(self, task: BackfillTask):
+        # 今天的数据可能还不完整, 不记录为已回填
+        covered_until = (
+            datetime.datetime.combine(datetime.date.today(), datetime.time())
+            - RESOLUTION
+        )
+        end_dt = min(task.dr.end_dt, covered_until)
+        if task.dr.start_dt <= end_dt:
+            self.coverage.add(
+                task.code_list, task.dr.interval, task.dr.start_dt, end_dt
+            )
+
+    def rollup(self, frame: DataFrame):
+        """回填的数据早于 continuous query 的处理范围, 写入后聚合为各精度的 k 线"""
+        source = retention.SOURCES[self.table_name]
+        if frame.empty or self.dr.interval != source.interval:
+            return
+        times = frame["time"]
+        start = times.min().to_pydatetime()
+        end = times.max().to_pydatetime() + datetime.timedelta(seconds=1)
+        try:
+            backend.rollup(
+                self.table_name,
+                start,
+                end,
+                codes=[format_code(code) for code in frame["code"].unique()],
+            )
+        except Exception:
+            # 数据已写入, 不因聚合失败重新请求; 可由 setup_influxdb_retention --rollup-from 重新聚合
+            logger.exception(
+                "rollup %s from %s to %s failed", self.table_name, start, end
+            )
+
+    def fetch(self, task: BackfillTask) -> DataFrame:
+        return self.client.get_price_frame(task.code_list, task.dr)
+
+    def synchronize(self) -> List[BackfillTask]:
+        """执行回填, 返回因额度不足未执行的任务"""
+        self.job = self.session.merge(self.job)
+        self.session.commit()
+        tasks = self.plan()
+        logger.info(
+            "backfill %d codes in %s with %d tasks",
+            len(self.code_list),
+            self.dr,
+            len(tasks),
+        )
+        progress = BackfillProgress(total=len(tasks))
+        pending: Dict[Future, BackfillTask] = {}
+        remaining: Iterator[BackfillTask] = iter(tasks)
+        skipped: List[BackfillTask] = []
+
+        with ThreadPoolExecutor(
+            self.workers, thread_name_prefix="backfill"
+        ) as executor:
+
+            def submit() -> bool:
+                task = next(remaining, None)
+                if task is None:
+                    return False
+                # 已提交但未返回的任务也会消耗额度
+                reserved = sum(t.estimated_rows for t in pending.values())
+                if jqdatasdk.get_query_count("spare") - reserved < task.estimated_rows:
+                    skipped.append(task)
+                    skipped.extend(remaining)
+                    logger.warning(
+                        "joinquant query quota is not enough, %d tasks skipped",
+                        len(skipped),
+                    )
+                    return False
+                pending[executor.submit(self.fetch, task)] = task
+                return True
+
+            # 同时最多有 workers * 2 个任务在请求或等待写入, 避免写入慢时积压
+            for _ in range(self.workers * 2):
+                if not submit():
+                    break
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = pending.pop(future)
+                    try:
+                        frame = future.result()
+                        self.write_to_db(frame)
+                        self.rollup(frame)
+                        self.mark_covered(task)
+                    except Exception:
+                        logger.exception("backfill %s failed", task)
+                        progress.failed += 1
+                        frame = DataFrame()
+                    progress.update(len(frame))
+                    submit()
+        logger.info(
+            "backfill finished, %d rows, %d failed, %d skipped",
+            progress.rows,
+            progress.failed,
+            len(skipped),
+        )
+        if not skipped and not progress.failed:
+            self.job.status = BackfillStatus.FINISHED
+            self.session.commit()
+        return skipped
@@ -1,46 +1,114 @@
 # -*- coding: utf-8 -*-
 """该模块提供从 joinquant 查询股票价格的封装"""
-import math
+import datetime
+from functools import partial
 from typing import Dict, List
 
 import jqdatasdk
 from pandas import DataFrame
 from stock_analysis import settings
+from stock_analysis.constants import IntervalType
 from stock_analysis.datasources.base import BaseHistoryClient
+from stock_analysis.datasources.joinquant.hdf5 import JQDataCache
 from stock_analysis.schemas import DateTimeRange, StockBaseInfo, StockHistogramItem
 from stock_analysis.datasources.joinquant.utils import normalize_stock_code
 
+# get_price_frame 返回的列, 与 StockHistogramItem 的字段对应
+HISTORY_COLUMNS = [
+    "time",
+    "code",
+    "interval",
+    "open",
+    "close",
+    "high",
+    "low",
+    "current",
+    "volume",
+    "turnover",
+    "paused",
+]
+
+cache = JQDataCache(**settings.JOINQUANT_CACHE) if settings.JOINQUANT_CACHE else None
+
 
 class JQClient(BaseHistoryClient):
     def get_bars(self, code: str, dr: DateTimeRange) -> List[StockHistogramItem]:
         return self.get_price(code, dr)
 
     def get_price(self, code: str, dr: DateTimeRange) -> List[StockHistogramItem]:
-        """调用 jqdatasdk.get_price 获取指定股票代码在指定时间范围内的行情"""
-
-        stock_info = self.get_stock_info(code)
-        normalize_code = self.normalize_codes([code])[0]
-        prices: DataFrame = jqdatasdk.get_price(
-            security=normalize_code,
-            start_date=dr.start_dt,
-            end_date=dr.end_dt,
-            frequency=dr.interval,
-            fields=["open", "close", "high", "low", "volume", "money", "paused", "avg"],
-        )
+        """获取指定股票代码在指定时间范围内的行情"""
+
+        return self.get_prices([code], dr)
+
+    def get_prices(
+        self, code_list: List[str], dr: DateTimeRange
+    ) -> List[StockHistogramItem]:
+        """获取多只股票在指定时间范围内的行情"""
+
+        self.load_stock_info(code_list)
         return [
-            StockHistogramItem(
-                name=stock_info.name,
-                code=stock_info.code,
-                interval=dr.interval,
-                time=item[0].to_pydatetime(),
-                turnover=item[1]["money"],
-                current=item[1]["avg"],
-                **item[1]
-            )
-            for item in prices.iterrows()
-            if not math.isnan(item[1][0])
+            StockHistogramItem(name=self.stock_info_maps[record["code"]].name, **record)
+            for record in self.get_price_frame(code_list, dr).to_dict("records")
         ]
 
+    def get_price_frame(self, code_list: List[str], dr: DateTimeRange) -> DataFrame:
+        """按列获取多只股票在指定时间范围内的行情, 配置了缓存时优先读取本地缓存
+
+        返回的列见 HISTORY_COLUMNS, 已去除没有行情(上市前或退市后)的行
+        """
+
+        normalized_codes = dict(zip(self.normalize_codes(code_list), code_list))
+        if cache is None:
+            prices = self.fetch_prices(
+                list(normalized_codes), dr.start_dt, dr.end_dt, dr.interval
+            )
+        else:
+            prices = cache.get_price(
+                partial(self.fetch_prices, interval=dr.interval),
+                list(normalized_codes),
+                dr.interval.value,
+                dr.start_dt,
+                dr.end_dt,
+            )
+        if prices.empty:
+            return DataFrame(columns=HISTORY_COLUMNS)
+
+        prices = prices[prices["open"].notna()]
+        return DataFrame(
+            {
+                "time": prices["time"].values,
+                "code": prices["code"].map(normalized_codes).values,
+                "interval": dr.interval.value,
+                "open": prices["open"].values,
+                "close": prices["close"].values,
+                "high": prices["high"].values,
+                "low": prices["low"].values,
+                "current": prices["avg"].values,
+                "volume": prices["volume"].values,
+                "turnover": prices["money"].values,
+                "paused": prices["paused"].values.astype(bool),
+            },
+            columns=HISTORY_COLUMNS,
+        )
+
+    @staticmethod
+    def fetch_prices(
+        code_list: List[str],
+        start_dt: datetime.datetime,
+        end_dt: datetime.datetime,
+        interval: IntervalType,
+    ) -> DataFrame:
+        """一次 jqdatasdk.get_price 调用获取多只股票的行情"""
+
+        return jqdatasdk.get_price(
+            security=code_list,
+            start_date=start_dt,
+            end_date=end_dt,
+            frequency=interval,
+            fields=["open", "close", "high", "low", "volume", "money", "paused", "avg"],
+            panel=False,
+        )
+
     normalized_code_maps: Dict[str, str] = {}
     stock_info_maps: Dict[str, StockBaseInfo] = {}
 
@@ -56,6 +124,24 @@ class JQClient(BaseHistoryClient):
             cls.normalized_code_maps[key] = value
         return [cls.normalized_code_maps[code] for code in code_list]
 
+    @classmethod
+    def load_stock_info(cls, code_list: List[str]):
+        """通过一次 get_all_securities 调用批量加载股票的基本信息"""
+
+        unknown_codes = [code for code in code_list if code not in cls.stock_info_maps]
+        if not unknown_codes:
+            return
+        fetch = partial(jqdatasdk.get_all_securities, types=["stock"])
+        securities = fetch() if cache is None else cache.get_securities(fetch)
+        for code, normalize_code in zip(
+            unknown_codes, cls.normalize_codes(unknown_codes)
+        ):
+            if normalize_code in securities.index:
+                name = securities.at[normalize_code, "display_name"]
+                cls.stock_info_maps[code] = StockBaseInfo(code=code, name=name)
+            else:
+                cls.get_stock_info(code)
+
     @classmethod
     def get_stock_info(cls, code: str) -> StockBaseInfo:
         """获取股票的基本信息"""
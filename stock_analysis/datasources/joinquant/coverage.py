@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""记录已回填的历史行情时间段, 并计算缺失的时间段"""
+import datetime
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from stock_analysis.constants import IntervalType
+from stock_analysis.storage.sqlalchemy import databases, models
+
+Span = Tuple[datetime.datetime, datetime.datetime]
+
+# 时间段的最小单位, 首尾相差不超过该值的时间段视为相邻
+RESOLUTION = datetime.timedelta(seconds=1)
+
+
+def merge_spans(spans: List[Span]) -> List[Span]:
+    """合并重叠或相邻的时间段"""
+    merged: List[Span] = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1] + RESOLUTION:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def compute_gaps(spans: List[Span], start: datetime.datetime, end: datetime.datetime):
+    """计算 [start, end] 中未被 spans 覆盖的时间段"""
+    gaps = []
+    cursor = start
+    for span_start, span_end in merge_spans(spans):
+        if span_end < cursor:
+            continue
+        if span_start > end:
+            break
+        if span_start > cursor:
+            gaps.append((cursor, span_start - RESOLUTION))
+        cursor = span_end + RESOLUTION
+    if cursor <= end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+class CoverageIndex:
+    """按 (股票, 周期) 记录已写入的时间段"""
+
+    def __init__(self, session: databases.Session):
+        self.session = session
+
+    def spans(self, code: str, interval: IntervalType) -> List[Span]:
+        rows = self.session.query(
+            models.HistoryCoverage.start_dt, models.HistoryCoverage.end_dt
+        ).filter_by(stock_code=code, interval=interval)
+        return [(start, end) for start, end in rows]
+
+    def gaps(
+        self,
+        code_list: List[str],
+        interval: IntervalType,
+        start: datetime.datetime,
+        end: datetime.datetime,
+    ) -> Dict[Tuple[Span, ...], List[str]]:
+        """计算每只股票缺失的时间段, 按缺失时间段相同的股票分组返回"""
+        groups: Dict[Tuple[Span, ...], List[str]] = defaultdict(list)
+        for code in code_list:
+            gaps = compute_gaps(self.spans(code, interval), start, end)
+            if gaps:
+                groups[tuple(gaps)].append(code)
+        return groups
+
+    def add(
+        self,
+        code_list: List[str],
+        interval: IntervalType,
+        start: datetime.datetime,
+        end: datetime.datetime,
+    ):
+        """记录 code_list 在 [start, end] 内的数据已写入, 与已有的时间段合并"""
+        query = self.session.query(models.HistoryCoverage)
+        for code in code_list:
+            rows = query.filter(
+                models.HistoryCoverage.stock_code == code,
+                models.HistoryCoverage.interval == interval,
+                models.HistoryCoverage.start_dt <= end + RESOLUTION,
+                models.HistoryCoverage.end_dt >= start - RESOLUTION,
+            ).all()
+            span_start = min([start, *(row.start_dt for row in rows)])
+            span_end = max([end, *(row.end_dt for row in rows)])
+            for row in rows:
+                self.session.delete(row)
+            self.session.add(
+                models.HistoryCoverage(
+                    stock_code=code,
+                    interval=interval,
+                    start_dt=span_start,
+                    end_dt=span_end,
+                )
+            )
+        self.session.commit()
@@ -1,5 +1,181 @@
 # -*- coding: utf-8 -*-
-"""该模块提供读取和更新从 joinquant 获取的 hdf5 文件"""
-# TODO:
-# - 从 hdf5 解析 ctable 对象
-# - 更新 ctable 对象
+"""该模块提供读取和更新从 joinquant 获取的 hdf5 文件
+
+行情按 (标准化代码, 周期, 自然日) 各存为一个 blosc 压缩的 hdf5 文件, 证券信息每天缓存一份;
+缓存总大小超过 max_bytes 时按文件修改时间(读取时会更新)淘汰最久未使用的文件。
+"""
+import datetime
+import logging
+import os
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+from pandas import DataFrame
+
+logger = logging.getLogger(__name__)
+
+PriceFetcher = Callable[[List[str], datetime.datetime, datetime.datetime], DataFrame]
+
+# PyTables/HDF5 不是线程安全的, 回填的多个线程同时读写缓存时, 所有 hdf5 读写都需要持有该锁
+hdf5_lock = threading.Lock()
+
+
+def day_ranges(
+    days: Iterable[datetime.date],
+) -> List[Tuple[datetime.date, datetime.date]]:
+    """将日期合并为连续的 [开始, 结束] 日期段"""
+    ranges: List[Tuple[datetime.date, datetime.date]] = []
+    for day in sorted(days):
+        if ranges and day - ranges[-1][1] == datetime.timedelta(days=1):
+            ranges[-1] = (ranges[-1][0], day)
+        else:
+            ranges.append((day, day))
+    return ranges
+
+
+class JQDataCache:
+    """joinquant 行情与证券信息的本地读穿缓存"""
+
+    suffix = ".h5"
+
+    def __init__(
+        self, directory: str, max_bytes: int = 10 * 1024 ** 3, complevel: int = 5
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.complevel = complevel
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None
+
+    def path(self, code: str, interval: str, day: datetime.date) -> Path:
+        return self.directory / interval / code / f"{day:%Y%m%d}{self.suffix}"
+
+    def read(self, path: Path) -> DataFrame:
+        # 更新修改时间, 作为 LRU 淘汰的依据
+        os.utime(path)
+        with hdf5_lock:
+            return pd.read_hdf(path, "data")
+
+    def write(self, path: Path, data: DataFrame):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 先写临时文件再重命名, 避免读到写了一半的文件
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with hdf5_lock:
+            data.to_hdf(
+                tmp, "data", mode="w", complib="blosc", complevel=self.complevel
+            )
+        os.replace(tmp, path)
+        self._grow(path.stat().st_size)
+
+    def get_price(
+        self,
+        fetch: PriceFetcher,
+        code_list: List[str],
+        interval: str,
+        start_dt: datetime.datetime,
+        end_dt: datetime.datetime,
+    ) -> DataFrame:
+        """读取 code_list 在 [start_dt, end_dt] 内的行情, 缓存中缺失的按整天调用 fetch 获取并写入缓存
+
+        fetch(code_list, start_dt, end_dt) 返回 get_price(panel=False) 格式的 DataFrame
+        """
+        days = [ts.date() for ts in pd.date_range(start_dt.date(), end_dt.date())]
+        frames = []
+        missing: Dict[str, List[datetime.date]] = defaultdict(list)
+        for code in code_list:
+            for day in days:
+                path = self.path(code, interval, day)
+                try:
+                    frames.append(self.read(path).assign(code=code))
+                except FileNotFoundError:
+                    missing[code].append(day)
+
+        # 只请求各股票缺失的连续日期段, 缺失日期段相同的股票合并为一次请求
+        requests: Dict[Tuple[datetime.date, datetime.date], List[str]] = defaultdict(
+            list
+        )
+        for code, missing_days in missing.items():
+            for day_range in day_ranges(missing_days):
+                requests[day_range].append(code)
+
+        today = datetime.date.today()
+        for (first, last), codes in requests.items():
+            fetched = fetch(
+                codes,
+                datetime.datetime.combine(first, datetime.time()),
+                datetime.datetime.combine(last, datetime.time.max),
+            )
+            groups: Dict[Tuple[str, datetime.date], DataFrame] = {}
+            if not fetched.empty:
+                groups = dict(
+                    list(fetched.groupby([fetched["code"], fetched["time"].dt.date]))
+                )
+            empty = fetched.iloc[:0]
+            for code in codes:
+                for ts in pd.date_range(first, last):
+                    day = ts.date()
+                    data = groups.get((code, day), empty)
+                    frames.append(data)
+                    # 当天的数据可能还不完整; 没有数据的日期(停牌、节假日)也写入空文件, 避免重复请求
+                    if day < today:
+                        self.write(
+                            self.path(code, interval, day),
+                            data.drop(columns="code", errors="ignore"),
+                        )
+        if requests:
+            self.evict()
+
+        if not frames:
+            return DataFrame()
+        data = pd.concat(frames, ignore_index=True, sort=False)
+        if "time" not in data:
+            # 所有日期都没有数据, fetch 返回的空 DataFrame 可能没有任何列
+            return DataFrame()
+        data = data[(data["time"] >= start_dt) & (data["time"] <= end_dt)]
+        return data.sort_values(["time", "code"]).reset_index(drop=True)
+
+    def get_securities(self, fetch: Callable[[], DataFrame]) -> DataFrame:
+        """证券信息每天只请求一次"""
+        path = self.directory / f"securities{self.suffix}"
+        if path.exists():
+            modified = datetime.date.fromtimestamp(path.stat().st_mtime)
+            if modified == datetime.date.today():
+                with hdf5_lock:
+                    return pd.read_hdf(path, "data")
+        securities = fetch()
+        self.write(path, securities)
+        return securities
+
+    def _files(self) -> List[Path]:
+        return list(self.directory.rglob(f"*{self.suffix}"))
+
+    def _grow(self, size: int):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(path.stat().st_size for path in self._files())
+            else:
+                self._size += size
+
+    def evict(self):
+        """缓存超过 max_bytes 时删除最久未使用的文件"""
+        with self._lock:
+            if self._size is None or self._size <= self.max_bytes:
+                return
+            stats = []
+            for path in self._files():
+                try:
+                    stats.append((path.stat(), path))
+                except FileNotFoundError:
+                    continue
+            stats.sort(key=lambda item: item[0].st_mtime)
+            self._size = sum(stat.st_size for stat, _ in stats)
+            for stat, path in stats:
+                if self._size <= self.max_bytes:
+                    break
+                path.unlink()
+                self._size -= stat.st_size
+            logger.info("evicted joinquant cache to %d bytes", self._size)
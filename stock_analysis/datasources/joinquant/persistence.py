@@ -1,21 +1,20 @@
 # -*- coding: utf-8 -*-
 import logging
-import datetime
 from typing import List
 
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
 from stock_analysis.datasources.base import BaseSynchronizer, BaseDBWriter
-from stock_analysis.schemas import StockHistogramItem, DateTimeRange
+from stock_analysis.schemas import DateTimeRange
 from stock_analysis.datasources.joinquant.client import JQClient
-from stock_analysis.storage.influxdb.databases import client as db
+from stock_analysis.storage.timeseries import backend
 
 
 logger = logging.getLogger(__name__)
 
 
-def format_datetime(dt: datetime.datetime) -> str:
-    return dt.replace(microsecond=0).isoformat()
-
-
 def format_code(code: str) -> str:
     if code.endswith("XSHE"):
         return "SZ." + code.replace(".XSHE", "")
@@ -25,30 +24,37 @@ def format_code(code: str) -> str:
 
 
 class StockHistoryWriter(BaseDBWriter):
+    """按列写入 k 线, obj 为 JQClient.get_price_frame 返回的 DataFrame"""
+
     table_name = "stock_history"
 
-    def write_to_db(self, obj: List[StockHistogramItem]):
-        data = [
-            dict(
-                measurement=self.table_name,
-                tags=dict(code=format_code(item.code), interval=item.interval.value),
-                time=format_datetime(item.time),
-                fields=item.dict(
-                    include={
-                        "open",
-                        "close",
-                        "high",
-                        "low",
-                        "current",
-                        "volume",
-                        "turnover",
-                        "paused",
-                    }
-                ),
-            )
-            for item in obj
-        ]
-        db.write_points(data)
+    def flush_to_db(self, objs: List[DataFrame]):
+        self.write_to_db(pd.concat(objs, ignore_index=True))
+
+    @staticmethod
+    def weigh(obj: DataFrame) -> int:
+        return len(obj)
+
+    def write_to_db(self, obj: DataFrame):
+        if obj.empty:
+            return
+        fields = {
+            key: obj[key].values.astype(np.float64)
+            for key in ["open", "close", "high", "low", "current"]
+        }
+        fields["volume"] = obj["volume"].values.astype(np.int64)
+        fields["turnover"] = obj["turnover"].values.astype(np.int64)
+        fields["paused"] = obj["paused"].values.astype(bool)
+        codes = {code: format_code(code) for code in obj["code"].unique()}
+        backend.write_columns(
+            self.table_name,
+            tags=dict(
+                code=obj["code"].map(codes).values, interval=obj["interval"].values,
+            ),
+            fields=fields,
+            # joinquant 返回的是不带时区的北京时间, 与此前一样按 UTC 写入
+            times=obj["time"].values.astype("datetime64[s]").astype(np.int64),
+        )
 
 
 class JQStockHistorySynchronizer(BaseSynchronizer, StockHistoryWriter):
@@ -64,4 +70,4 @@ class JQStockHistorySynchronizer(BaseSynchronizer, StockHistoryWriter):
                 code,
                 self.dr,
             )
-            self.write_to_db(self.client.get_bars(code, self.dr))
+            self.write_to_db(self.client.get_price_frame([code], self.dr))
@@ -2,6 +2,12 @@
 import logging.config
 from pathlib import Path
 
+# 时序数据存储后端: influxdb, 或不需要部署服务的嵌入式列存储 columnar(数据保存在 COLUMNAR_STORE 目录)
+TIMESERIES_BACKEND = "influxdb"
+COLUMNAR_STORE = dict(
+    directory=str(Path(__file__).parent.parent / "runtime/timeseries")
+)
+
 INFLUXDB_CONF = dict(
     host="your-host",
     port="your-port",
@@ -9,18 +15,72 @@ INFLUXDB_CONF = dict(
     password="your-password",
     database="your-database",
 )
+# InfluxDB 写入选项: 每批写入的点数, 是否 gzip 压缩请求体, 时间戳精度(s/ms/u/n)
+INFLUXDB_WRITE_OPTIONS = dict(batch_size=5000, gzip=False, precision="s")
+# InfluxDB 查询结果缓存, 设为 None 则不缓存
+# ttl: 包含最近数据的查询结果缓存的秒数, 需大于告警轮询周期(3 秒)才能命中, 本进程写入时仍会失效; settle: 结束时间早于该秒数之前的查询视为历史查询, 结果不过期
+INFLUXDB_QUERY_CACHE = dict(max_bytes=64 * 1024 * 1024, ttl=10, settle=300)
+# InfluxDB 不可用时暂存写入数据的本地 spool, 设为 None 则不暂存
+# segment_bytes: 单个分段文件大小上限; max_bytes: spool 总大小上限, 超出时丢弃最旧的分段
+INFLUXDB_SPOOL = dict(
+    directory=str(Path(__file__).parent.parent / "runtime/spool/influxdb"),
+    segment_bytes=16 * 1024 * 1024,
+    max_bytes=1024 * 1024 * 1024,
+    fsync_interval=1,
+)
+# InfluxDB 分级保留: raw 为各原始测量的保留时长, rollups 为各精度 OHLCV 聚合数据的保留时长, INF 表示永久保留
+INFLUXDB_RETENTION = dict(
+    raw=dict(stock_ticks="30d"), rollups={"1m": "365d", "5m": "1095d", "1d": "INF"},
+)
+# 实时行情后台写入队列(WriteBehindBuffer)参数, 设为 None 则在轮询线程中同步写入
+# policy: 队列满时的处理策略, block/drop_oldest/drop_newest
+TICK_WRITE_BEHIND = dict(
+    max_size=200000,
+    flush_size=10000,
+    flush_interval=1,
+    policy="drop_oldest",
+    max_retries=3,
+    backoff=0.5,
+)
 
 # 数据库配置
 SQLALCHEMY_DB_URL = "sqlite:///" + str(
     Path(__file__).parent.parent / "runtime/stock.db"
 )
+# SQLite 每个连接执行的 PRAGMA, WAL 模式下读写互不阻塞
+SQLITE_PRAGMAS = dict(
+    journal_mode="WAL",
+    synchronous="NORMAL",
+    mmap_size=256 * 1024 * 1024,
+    busy_timeout=5000,
+)
+# MySQL/PostgreSQL 等数据库的连接池参数
+SQLALCHEMY_ENGINE_OPTIONS = dict(
+    pool_size=5, max_overflow=10, pool_recycle=3600, pool_pre_ping=True
+)
 
 # JOIN QUANT 配置
 JOINQUANT_AUTH = dict(username="your-username", password="your-password")
+# joinquant 行情与证券信息的本地缓存, 设为 None 则不缓存
+JOINQUANT_CACHE = dict(
+    directory=str(Path(__file__).parent.parent / "runtime/cache/joinquant"),
+    max_bytes=10 * 1024 ** 3,
+    complevel=5,
+)
 
 # FUTUOpenD
 FUTU_OPEND_PRI_KEY = "abs-path-to-your-rsa-private-key"
 FUTU_OPEND_SERVER = dict(host="your-host", port="your-port")
+# FUTUOpenD 各接口每 30 秒的请求次数上限, 未列出的接口不限流
+FUTU_RATE_LIMITS = dict(
+    get_stock_filter=10, get_market_snapshot=60, request_trading_days=30,
+)
+
+# 各市场节假日, 无法从 FUTUOpenD 获取交易日时使用, 例如 {"SH": ["2021-01-01"]}
+MARKET_HOLIDAYS = {}
+
+# 新浪/腾讯实时行情: 并发请求数与单次请求超时时间(秒)
+REALTIME_QUOTATION = dict(concurrency=8, timeout=5)
 
 # 企业微信通知 webhook 地址
 WECOM_NOTIFY_URL = None
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 import datetime
-from typing import List, Optional
+from dataclasses import dataclass, fields
+from typing import ClassVar, Iterator, List, Optional
 
+import numpy as np
+import pytz
 from pydantic import BaseModel, Field
 
 from stock_analysis.constants import IntervalType
@@ -43,6 +46,107 @@ class StockTick(BaseModel):
         return f"{total_bid_volume} / {total_ask_volume}"
 
 
+@dataclass
+class TickBatch:
+    """按列存储的一批实时行情, 每只股票占一行
+
+    买/卖盘为固定 depth 档的二维数组, 缺失的档位价格为 NaN、数量为 0
+    """
+
+    depth: ClassVar[int] = 5
+
+    code: np.ndarray
+    name: np.ndarray
+    # tick 发生的时间, 秒级 unix 时间戳
+    time: np.ndarray
+    current: np.ndarray
+    volume: np.ndarray
+    turnover: np.ndarray
+    bid_price: np.ndarray
+    bid_volume: np.ndarray
+    ask_price: np.ndarray
+    ask_volume: np.ndarray
+
+    def __len__(self):
+        return len(self.code)
+
+    def __getitem__(self, index) -> "TickBatch":
+        return TickBatch(**{f.name: getattr(self, f.name)[index] for f in fields(self)})
+
+    def __iter__(self) -> Iterator[StockTick]:
+        return (self.tick(idx) for idx in range(len(self)))
+
+    def tick(self, idx: int) -> StockTick:
+        """获取第 idx 行的 StockTick 视图"""
+        return StockTick(
+            name=self.name[idx],
+            code=self.code[idx],
+            time=datetime.datetime.fromtimestamp(int(self.time[idx]), pytz.utc),
+            current=self.current[idx],
+            volume=self.volume[idx],
+            turnover=self.turnover[idx],
+            bids=[
+                dict(value=value, volume=volume)
+                for value, volume in zip(self.bid_price[idx], self.bid_volume[idx])
+                if not np.isnan(value)
+            ],
+            asks=[
+                dict(value=value, volume=volume)
+                for value, volume in zip(self.ask_price[idx], self.ask_volume[idx])
+                if not np.isnan(value)
+            ],
+        )
+
+    @classmethod
+    def empty_book(cls, size: int):
+        """构造 size 行没有买卖盘数据的 (price, volume) 数组"""
+        return (
+            np.full((size, cls.depth), np.nan),
+            np.zeros((size, cls.depth), dtype=np.int64),
+        )
+
+    @classmethod
+    def concat(cls, batches: List["TickBatch"]) -> "TickBatch":
+        if not batches:
+            return cls.from_ticks([])
+        return cls(
+            **{
+                f.name: np.concatenate([getattr(batch, f.name) for batch in batches])
+                for f in fields(cls)
+            }
+        )
+
+    @classmethod
+    def from_ticks(cls, ticks: List[StockTick]) -> "TickBatch":
+        bid_price, bid_volume = cls.empty_book(len(ticks))
+        ask_price, ask_volume = cls.empty_book(len(ticks))
+        for idx, tick in enumerate(ticks):
+            for level, quoted in enumerate(tick.bids[: cls.depth]):
+                bid_price[idx, level], bid_volume[idx, level] = (
+                    quoted.value,
+                    quoted.volume,
+                )
+            for level, quoted in enumerate(tick.asks[: cls.depth]):
+                ask_price[idx, level], ask_volume[idx, level] = (
+                    quoted.value,
+                    quoted.volume,
+                )
+        return cls(
+            code=np.array([tick.code for tick in ticks], dtype=object),
+            name=np.array([tick.name for tick in ticks], dtype=object),
+            time=np.array(
+                [int(tick.time.timestamp()) for tick in ticks], dtype=np.int64
+            ),
+            current=np.array([tick.current for tick in ticks], dtype=np.float64),
+            volume=np.array([tick.volume or 0 for tick in ticks], dtype=np.int64),
+            turnover=np.array([tick.turnover or 0 for tick in ticks], dtype=np.int64),
+            bid_price=bid_price,
+            bid_volume=bid_volume,
+            ask_price=ask_price,
+            ask_volume=ask_volume,
+        )
+
+
 class StockHistogramItem(BaseModel):
     """股票 k 线"""
 
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""有界的后台写入缓冲队列"""
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, List
+
+from stock_analysis.constants import OverflowPolicy
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BufferStats:
+    """缓冲队列统计, 数量均按 weigh 计算(如数据点数)"""
+
+    # 当前排队中的数量
+    queued: int = 0
+    flushed: int = 0
+    dropped: int = 0
+    retries: int = 0
+    last_flush_latency: float = 0
+
+
+class WriteBehindBuffer:
+    """由后台线程消费的有界写入队列
+
+    排队数量达到 flush_size 或距上次写入超过 flush_interval 秒时, 将队列中的数据一次性交给 flush,
+    失败时按指数退避重试 max_retries 次, 仍失败则丢弃。
+    队列已满时按 policy 阻塞生产者, 或丢弃最旧/最新的数据。
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[List[Any]], None],
+        max_size: int = 100000,
+        flush_size: int = 5000,
+        flush_interval: float = 1,
+        policy: OverflowPolicy = OverflowPolicy.BLOCK,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        weigh: Callable[[Any], int] = lambda item: 1,
+        name: str = "write-behind",
+    ):
+        self.flush = flush
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.policy = OverflowPolicy(policy)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.weigh = weigh
+        self.name = name
+        self.stats = BufferStats()
+
+        self._items: Deque[Any] = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, item) -> bool:
+        """放入队列, 返回 item 是否被接收"""
+        weight = self.weigh(item)
+        with self._cond:
+            # 队列为空时总是接收, 以免单个超过 max_size 的 item 永远无法写入
+            while self._items and self.stats.queued + weight > self.max_size:
+                if self.policy == OverflowPolicy.BLOCK:
+                    self._cond.wait()
+                elif self.policy == OverflowPolicy.DROP_OLDEST:
+                    dropped = self.weigh(self._items.popleft())
+                    self.stats.queued -= dropped
+                    self._drop(dropped)
+                else:
+                    self._drop(weight)
+                    return False
+            self._items.append(item)
+            self.stats.queued += weight
+            if self.stats.queued >= self.flush_size:
+                self._cond.notify_all()
+        return True
+
+    def _drop(self, weight: int):
+        self.stats.dropped += weight
+        logger.warning("%s is full, drop %d", self.name, weight)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and self.stats.queued < self.flush_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                items, weight = list(self._items), self.stats.queued
+                self._items.clear()
+                self.stats.queued = 0
+                self._cond.notify_all()
+                if not items and self._closed:
+                    return
+            if items:
+                self._flush(items, weight)
+
+    def _flush(self, items: List[Any], weight: int):
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                self.flush(items)
+            except Exception:
+                logger.exception("%s flush %d failed", self.name, weight)
+                if attempt < self.max_retries:
+                    self.stats.retries += 1
+                    time.sleep(self.backoff * 2 ** attempt)
+                continue
+            self.stats.flushed += weight
+            self.stats.last_flush_latency = time.monotonic() - started
+            logger.debug(
+                "%s flushed %d in %.3fs, stats: %s",
+                self.name,
+                weight,
+                self.stats.last_flush_latency,
+                self.stats,
+            )
+            return
+        self._drop(weight)
+
+    def close(self, timeout: float = None):
+        """写入队列中剩余的数据并停止后台线程"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""本地列存储支持的 InfluxQL 子集
+
+SELECT <字段或聚合函数> FROM <measurement> [WHERE <条件> [AND <条件>...]] [GROUP BY time(<周期>)]
+[fill(none)] [ORDER BY [time] ASC|DESC] [LIMIT <n>]
+
+- 聚合函数: mean/median/max/min/sum/count/first/last/spread
+- 条件只支持 AND 连接, time 可以与时间字符串或 now() - <时长> 比较
+- GROUP BY 中的 tag 被忽略, 且空的时间段总是按 fill(none) 处理
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from stock_analysis.storage.influxdb.retention import UNITS
+
+AGGREGATES = {
+    "mean": "mean",
+    "median": "median",
+    "max": "max",
+    "min": "min",
+    "sum": "sum",
+    "count": "count",
+    "first": "first",
+    "last": "last",
+    "spread": lambda values: values.max() - values.min(),
+}
+
+QUERY_RE = re.compile(
+    r"""^\s*SELECT\s+(?P<fields>.+?)\s+FROM\s+(?P<measurement>\S+)
+    (?:\s+WHERE\s+(?P<where>.+?))?
+    (?:\s+GROUP\s+BY\s+(?P<group>.+?))?
+    (?:\s+fill\(\s*(?P<fill>\w+)\s*\))?
+    (?:\s+ORDER\s+BY\s+(?P<order>.+?))?
+    (?:\s+LIMIT\s+(?P<limit>\d+))?
+    \s*;?\s*$""",
+    re.IGNORECASE | re.DOTALL | re.VERBOSE,
+)
+FIELD_RE = re.compile(
+    r'^(?:(?P<func>\w+)\(\s*"?(?P<arg>[\w*]+)"?\s*\)|"?(?P<name>[\w*]+)"?)'
+    r'(?:\s+AS\s+"?(?P<alias>\w+)"?)?$',
+    re.IGNORECASE,
+)
+CONDITION_RE = re.compile(
+    r'^"?(?P<key>\w+)"?\s*(?P<op>=|!=|<>|>=|<=|>|<)\s*(?P<value>.+)$'
+)
+NOW_RE = re.compile(r"^now\(\)\s*(?:(?P<sign>[-+])\s*(?P<duration>\d+[smhdw]))?$", re.I)
+
+
+def duration_seconds(value: str) -> int:
+    match = re.fullmatch(r"(\d+)([smhdw])", value.strip())
+    if not match:
+        raise ValueError(f"invalid duration: {value}")
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+
+@dataclass
+class Field:
+    name: str
+    alias: str
+    func: Optional[str] = None
+
+
+@dataclass
+class Condition:
+    key: str
+    op: str
+    value: Any
+
+    def apply(self, column: np.ndarray) -> np.ndarray:
+        value = self.value
+        if self.op == "=":
+            return column == value
+        if self.op in ("!=", "<>"):
+            return column != value
+        if self.op == ">":
+            return column > value
+        if self.op == ">=":
+            return column >= value
+        if self.op == "<":
+            return column < value
+        return column <= value
+
+
+@dataclass
+class Query:
+    measurement: str
+    fields: List[Field]
+    conditions: List[Condition] = field(default_factory=list)
+    interval: Optional[int] = None
+    descending: bool = False
+    limit: Optional[int] = None
+
+    @property
+    def codes(self) -> Optional[List[str]]:
+        """WHERE 中指定的股票代码, 未指定时返回 None"""
+        codes = [c.value for c in self.conditions if c.key == "code" and c.op == "="]
+        return codes or None
+
+    @property
+    def time_range(self) -> Tuple[Optional[int], Optional[int]]:
+        """查询的时间范围(秒级时间戳, 闭区间)"""
+        start, end = None, None
+        for c in self.conditions:
+            if c.key != "time":
+                continue
+            if c.op in (">", ">="):
+                value = c.value + (c.op == ">")
+                start = value if start is None else max(start, value)
+            elif c.op in ("<", "<="):
+                value = c.value - (c.op == "<")
+                end = value if end is None else min(end, value)
+            elif c.op == "=":
+                start = end = c.value
+        return start, end
+
+    @property
+    def aggregated(self) -> bool:
+        return any(f.func for f in self.fields)
+
+
+def parse_time(value: str, now: int) -> int:
+    match = NOW_RE.match(value)
+    if match:
+        if not match.group("duration"):
+            return now
+        delta = duration_seconds(match.group("duration"))
+        return now - delta if match.group("sign") == "-" else now + delta
+    ts = pd.Timestamp(value.strip("'"))
+    if ts.tzinfo is None:
+        ts = ts.tz_localize("UTC")
+    return int(ts.timestamp())
+
+
+def parse_value(key: str, value: str, now: int) -> Any:
+    value = value.strip()
+    if key == "time":
+        return parse_time(value, now)
+    if value.startswith("'") and value.endswith("'"):
+        return value[1:-1].replace("\\'", "'")
+    if value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    return float(value)
+
+
+def parse(sql: str, now: Optional[int] = None) -> Query:
+    """解析 InfluxQL, 不支持的语法抛出 ValueError"""
+    match = QUERY_RE.match(sql)
+    if not match:
+        raise ValueError(f"unsupported query: {sql}")
+    now = int(pd.Timestamp.utcnow().timestamp()) if now is None else now
+
+    fields = []
+    for item in match.group("fields").split(","):
+        m = FIELD_RE.match(item.strip())
+        if not m:
+            raise ValueError(f"unsupported field: {item}")
+        if m.group("func"):
+            func = m.group("func").lower()
+            if func not in AGGREGATES:
+                raise ValueError(f"unsupported function: {func}")
+            fields.append(Field(m.group("arg"), m.group("alias") or func, func))
+        else:
+            fields.append(Field(m.group("name"), m.group("alias") or m.group("name")))
+
+    conditions = []
+    if match.group("where"):
+        if re.search(r"\sOR\s", match.group("where"), re.I):
+            raise ValueError("OR is not supported")
+        for item in re.split(r"\s+AND\s+", match.group("where"), flags=re.I):
+            m = CONDITION_RE.match(item.strip().strip("()"))
+            if not m:
+                raise ValueError(f"unsupported condition: {item}")
+            key = m.group("key")
+            conditions.append(
+                Condition(key, m.group("op"), parse_value(key, m.group("value"), now))
+            )
+
+    interval = None
+    if match.group("group"):
+        m = re.search(r"time\(\s*(\w+)\s*\)", match.group("group"), re.I)
+        if m:
+            interval = duration_seconds(m.group(1))
+
+    order = (match.group("order") or "").lower()
+    return Query(
+        # 去掉 "database"."retention_policy". 前缀
+        measurement=match.group("measurement").split(".")[-1].strip('"'),
+        fields=fields,
+        conditions=conditions,
+        interval=interval,
+        descending=order.endswith("desc"),
+        limit=int(match.group("limit")) if match.group("limit") else None,
+    )
+
+
+def execute(query: Query, data: DataFrame) -> DataFrame:
+    """在按时间排序的 data(time 列为秒级时间戳)上执行 query, 返回以 UTC 时间为索引的 DataFrame"""
+    mask = np.ones(len(data), dtype=bool)
+    for condition in query.conditions:
+        if condition.key not in data:
+            mask &= condition.op in ("!=", "<>")
+            continue
+        mask &= condition.apply(data[condition.key].values)
+    if not mask.all():
+        data = data[mask]
+
+    if query.aggregated:
+        start, _ = query.time_range
+        if query.interval:
+            buckets = data["time"].values // query.interval * query.interval
+        else:
+            # 没有 GROUP BY time 时与 InfluxDB 一样以查询的开始时间作为结果的时间
+            buckets = np.full(len(data), start or 0, dtype=np.int64)
+        grouped = data.groupby(buckets, sort=True)
+        columns = {}
+        for f in query.fields:
+            if f.func is None or f.name not in data:
+                continue
+            columns[f.alias] = grouped[f.name].agg(AGGREGATES[f.func])
+        result = DataFrame(columns, columns=[f.alias for f in query.fields])
+        result = result.dropna(how="all")
+        times = result.index.values.astype(np.int64)
+    else:
+        pairs = []
+        for f in query.fields:
+            if f.name == "*":
+                pairs.extend((c, c) for c in data.columns if c != "time")
+            else:
+                pairs.append((f.name, f.alias))
+        result = DataFrame(
+            {
+                alias: data[name].values if name in data else np.nan
+                for name, alias in pairs
+            },
+            index=np.arange(len(data)),
+            columns=[alias for _, alias in pairs],
+        )
+        times = data["time"].values
+
+    result.index = pd.to_datetime(np.array(times, dtype=np.int64), unit="s", utc=True)
+    if query.descending:
+        result = result.iloc[::-1]
+    if query.limit is not None:
+        result = result.iloc[: query.limit]
+    return result
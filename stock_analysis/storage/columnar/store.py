@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""嵌入式列存储, 用于不部署 InfluxDB 的场景
+
+数据按 <measurement>/<code>/<YYYYMMDD(UTC)>/ 分区, 分区内每列为一个只追加写入的定长二进制文件,
+列的类型记录在 columns.json 中, 读取时通过 np.memmap 直接映射, 不需要反序列化。
+
+- 字符串列按首次写入时的最大长度(至少 32)定长存储, 之后更长的值会被截断
+- 与 InfluxDB 一样, 相同 tag 与时间戳的数据在读取时合并, 以最后一次写入为准
+- 只支持单个进程写入
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from stock_analysis.storage.columnar import influxql
+from stock_analysis.storage.influxdb.retention import SOURCES, select_clause
+
+logger = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 86400
+
+
+def fill_value(dtype: np.dtype):
+    """缺失值的填充值"""
+    if dtype.kind == "f":
+        return np.nan
+    if dtype.kind == "U":
+        return ""
+    return dtype.type(0)
+
+
+def normalize(column) -> np.ndarray:
+    """将字段值转换为可定长存储的数组, 缺失值替换为 fill_value"""
+    mask = None
+    if isinstance(column, np.ma.MaskedArray):
+        mask = np.ma.getmaskarray(column)
+        column = column.data
+    column = np.asarray(column)
+    if column.dtype.kind == "O":
+        column = np.array(["" if v is None else str(v) for v in column.tolist()])
+    if mask is not None and mask.any():
+        column = column.copy()
+        column[mask] = fill_value(column.dtype)
+    return column
+
+
+class Partition:
+    """一个 (measurement, code, 日期) 分区"""
+
+    def __init__(self, path: Path, code: str):
+        self.path = path
+        self.code = code
+        self.schema_path = path / "columns.json"
+
+    def load_schema(self) -> Dict:
+        try:
+            return json.loads(self.schema_path.read_text())
+        except FileNotFoundError:
+            return dict(columns={}, tags=[])
+
+    def save_schema(self, schema: Dict):
+        tmp = self.schema_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(schema))
+        os.replace(tmp, self.schema_path)
+
+    def column_path(self, name: str) -> Path:
+        return self.path / f"{name}.bin"
+
+    def rows(self, schema: Dict) -> int:
+        # 写入中断时各列长度可能不一致, 以最短的列为准
+        return min(
+            (
+                self.column_path(name).stat().st_size // np.dtype(dtype).itemsize
+                for name, dtype in schema["columns"].items()
+            ),
+            default=0,
+        )
+
+    def append(self, columns: Dict[str, np.ndarray], tags: Sequence[str]):
+        self.path.mkdir(parents=True, exist_ok=True)
+        schema = self.load_schema()
+        rows = self.rows(schema)
+        size = len(columns["time"])
+
+        changed = False
+        for name, column in columns.items():
+            if name in schema["columns"]:
+                continue
+            dtype = column.dtype
+            if dtype.kind == "U":
+                dtype = np.dtype(f"<U{max(32, dtype.itemsize // 4)}")
+            schema["columns"][name] = dtype.str
+            # 新增的列先补齐已有的行
+            with open(self.column_path(name), "wb") as fh:
+                fh.write(np.full(rows, fill_value(dtype), dtype=dtype).tobytes())
+            changed = True
+        for tag in tags:
+            if tag not in schema["tags"]:
+                schema["tags"].append(tag)
+                changed = True
+        if changed:
+            self.save_schema(schema)
+
+        for name, dtype in schema["columns"].items():
+            dtype = np.dtype(dtype)
+            column = columns.get(name)
+            if column is None:
+                column = np.full(size, fill_value(dtype), dtype=dtype)
+            with open(self.column_path(name), "ab") as fh:
+                fh.write(column.astype(dtype).tobytes())
+
+    def read(self) -> Optional[DataFrame]:
+        """读取分区, 按时间排序并去重"""
+        schema = self.load_schema()
+        rows = self.rows(schema)
+        if not rows:
+            return None
+        columns = {
+            name: np.memmap(self.column_path(name), dtype=dtype, mode="r", shape=rows)
+            for name, dtype in schema["columns"].items()
+        }
+        data = DataFrame(columns, copy=False)
+        data["code"] = self.code
+        if not (np.diff(columns["time"]) > 0).all():
+            # 与 InfluxDB 一样, 重复写入的点按字段合并, 以最后一次写入的非空值为准
+            data = (
+                data.groupby(["time", "code"] + schema["tags"], sort=True)
+                .last()
+                .reset_index()
+            )
+        return data
+
+
+class ColumnarStore:
+    """本地列存储, 提供与 InfluxDB 后端相同的写入与查询接口"""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def partition(self, measurement: str, code: str, day: int) -> Partition:
+        date = datetime.date(1970, 1, 1) + datetime.timedelta(days=int(day))
+        return Partition(self.directory / measurement / code / f"{date:%Y%m%d}", code)
+
+    def write_columns(
+        self,
+        measurement: str,
+        tags: Dict[str, Union[str, Sequence[str]]],
+        fields: Dict[str, np.ndarray],
+        times: np.ndarray,
+    ):
+        """按列写入, 参数与 LineProtocolWriter.write_columns 相同, tags 中必须包含 code"""
+        times = np.asarray(times, dtype=np.int64)
+        size = len(times)
+        if not size:
+            return
+        columns = {"time": times}
+        for key, value in tags.items():
+            columns[key] = normalize(
+                np.full(size, value) if isinstance(value, str) else value
+            )
+        for key, value in fields.items():
+            columns[key] = normalize(value)
+
+        groups = pd.DataFrame(
+            {"code": columns["code"], "day": times // SECONDS_PER_DAY}
+        ).groupby(["code", "day"])
+        other_tags = [key for key in tags if key != "code"]
+        with self._lock:
+            for (code, day), idx in groups.indices.items():
+                self.partition(measurement, code, day).append(
+                    {key: column[idx] for key, column in columns.items()}, other_tags
+                )
+
+    def codes(self, measurement: str) -> List[str]:
+        path = self.directory / measurement
+        return sorted(p.name for p in path.iterdir()) if path.exists() else []
+
+    def days(self, measurement: str, code: str) -> List[str]:
+        path = self.directory / measurement / code
+        return sorted(p.name for p in path.iterdir()) if path.exists() else []
+
+    def scan(
+        self,
+        measurement: str,
+        code: str,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+    ) -> DataFrame:
+        """读取 code 在 [start, end](秒级时间戳)内的数据"""
+        first = self._day_name(start) if start is not None else ""
+        last = self._day_name(end) if end is not None else "99999999"
+        frames = []
+        for day in self.days(measurement, code):
+            if first <= day <= last:
+                data = Partition(self.directory / measurement / code / day, code).read()
+                if data is not None:
+                    frames.append(data)
+        if not frames:
+            return DataFrame(columns=["time"])
+        data = pd.concat(frames, ignore_index=True, sort=False)
+        mask = np.ones(len(data), dtype=bool)
+        if start is not None:
+            mask &= data["time"].values >= start
+        if end is not None:
+            mask &= data["time"].values <= end
+        return data if mask.all() else data[mask]
+
+    @staticmethod
+    def _day_name(ts: int) -> str:
+        return f"{datetime.datetime.utcfromtimestamp(ts):%Y%m%d}"
+
+    def query(self, sql: str) -> DataFrame:
+        """执行 InfluxQL 子集(见 influxql 模块), 返回以 UTC 时间为索引的 DataFrame"""
+        query = influxql.parse(sql)
+        start, end = query.time_range
+        codes = query.codes or self.codes(query.measurement)
+        if query.descending and query.limit is not None and not query.aggregated:
+            return self._tail(query, codes, start, end)
+        frames = [self.scan(query.measurement, code, start, end) for code in codes]
+        frames = [frame for frame in frames if len(frame)]
+        if not frames:
+            return DataFrame()
+        data = pd.concat(frames, ignore_index=True, sort=False)
+        if len(frames) > 1:
+            data = data.sort_values("time", kind="mergesort")
+        return influxql.execute(query, data)
+
+    def _tail(self, query: influxql.Query, codes, start, end) -> DataFrame:
+        """ORDER BY time DESC LIMIT n: 从最新的分区向前读取, 读够 n 行即停止"""
+        frames = []
+        for code in codes:
+            rows = 0
+            for day in reversed(self.days(query.measurement, code)):
+                if end is not None and day > self._day_name(end):
+                    continue
+                if start is not None and day < self._day_name(start):
+                    break
+                path = self.directory / query.measurement / code / day
+                data = Partition(path, code).read()
+                if data is None:
+                    continue
+                data = influxql.execute(query, data)
+                frames.append(data)
+                rows += len(data)
+                if rows >= query.limit:
+                    break
+        if not frames:
+            return DataFrame()
+        data = pd.concat(frames, sort=False).sort_index(
+            ascending=False, kind="mergesort"
+        )
+        return data.iloc[: query.limit]
+
+    def latest(self, measurement: str, code: str) -> DataFrame:
+        return self.query(
+            f"SELECT * FROM \"{measurement}\" WHERE code='{code}' ORDER BY time DESC LIMIT 1"
+        )
+
+    def last_values(
+        self, measurement: str, fields: Sequence[str], start: datetime.datetime
+    ) -> DataFrame:
+        """start(UTC) 之后各股票 fields 的最后一个值, 以股票代码为索引"""
+        select = ", ".join(f'last("{f}") AS "{f}"' for f in fields)
+        rows = {}
+        for code in self.codes(measurement):
+            data = self.query(
+                f'SELECT {select} FROM "{measurement}" '
+                f"WHERE code='{code}' AND time >= '{start}'"
+            )
+            if len(data):
+                rows[code] = data.iloc[-1]
+        return DataFrame.from_dict(rows, orient="index", columns=list(fields))
+
+    def bars(
+        self,
+        measurement: str,
+        code: str,
+        seconds: int,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        aggregates: Optional[Dict[str, str]] = None,
+    ) -> DataFrame:
+        """按 seconds 周期聚合 OHLCV, 聚合方式与 retention.SOURCES 相同"""
+        aggregates = aggregates or SOURCES[measurement].aggregates
+        conditions = [f"code='{code}'"]
+        if measurement in SOURCES:
+            conditions.extend(SOURCES[measurement].conditions)
+        if start:
+            conditions.append(f"time >= '{start}'")
+        if end:
+            conditions.append(f"time <= '{end}'")
+        return self.query(
+            f'SELECT {select_clause(aggregates)} FROM "{measurement}" '
+            f"WHERE {' AND '.join(conditions)} GROUP BY time({seconds}s) fill(none)"
+        )
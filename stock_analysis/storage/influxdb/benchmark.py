@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""对比 write_points(json) 与按列编码 line protocol 的编码速度
+
+python -m stock_analysis.storage.influxdb.benchmark
+"""
+import datetime
+from typing import Dict, List
+
+import numpy as np
+import pytz
+from influxdb.line_protocol import make_lines
+from stock_analysis.schemas import QuotedPrice, StockTick, TickBatch
+from stock_analysis.storage.influxdb.line_protocol import encode
+from stock_analysis.utils.timeit import catch_time
+
+
+def format_datetime(dt: datetime.datetime) -> str:
+    """旧版 StockTickWriter 使用的时间格式化"""
+    EPOCH = datetime.datetime(1970, 1, 1)
+    if dt.tzinfo is not None:
+        EPOCH = datetime.datetime(1970, 1, 1, tzinfo=dt.tzinfo)
+
+    dt = EPOCH + datetime.timedelta(seconds=dt.timestamp())
+    return dt.replace(microsecond=0, tzinfo=pytz.utc).isoformat()
+
+
+def format_quotations(prefix: str, prices: List[QuotedPrice]) -> Dict:
+    ret = {}
+    for idx, quotation in enumerate(prices):
+        ret.update(
+            {
+                f"{prefix}_{idx + 1}_price": quotation.value,
+                f"{prefix}_{idx + 1}_volume": quotation.volume,
+            }
+        )
+    return ret
+
+
+def encode_by_json(ticks: List[StockTick]) -> str:
+    """旧版 StockTickWriter: 构造 json 后由 influxdb-python 转换为 line protocol"""
+    data = [
+        dict(
+            measurement="stock_ticks",
+            tags=dict(code=obj.code, source_type="sina"),
+            time=format_datetime(obj.time),
+            fields=dict(
+                **format_quotations("ask", obj.asks),
+                **format_quotations("bid", obj.bids),
+                **obj.dict(include={"current", "volume", "turnover", "name"}),
+            ),
+        )
+        for obj in ticks
+    ]
+    return make_lines(dict(points=data), precision="s")
+
+
+def encode_by_columns(batch: TickBatch) -> List[str]:
+    fields = dict(
+        name=batch.name,
+        current=batch.current,
+        volume=batch.volume,
+        turnover=batch.turnover,
+    )
+    for prefix in ["bid", "ask"]:
+        prices = getattr(batch, f"{prefix}_price")
+        volumes = getattr(batch, f"{prefix}_volume")
+        for level in range(batch.depth):
+            fields[f"{prefix}_{level + 1}_price"] = prices[:, level]
+            fields[f"{prefix}_{level + 1}_volume"] = volumes[:, level]
+    return encode(
+        "stock_ticks",
+        tags=dict(code=batch.code, source_type="sina"),
+        fields=fields,
+        times=batch.time,
+    )
+
+
+def make_batch(size: int) -> TickBatch:
+    rng = np.random.default_rng(0)
+    prices = rng.uniform(1, 100, size).round(2)
+    book = prices[:, None] + np.arange(-5, 5)[None, :] * 0.01
+    return TickBatch(
+        code=np.array([f"SH.{600000 + idx}" for idx in range(size)], dtype=object),
+        name=np.array([f"股票{idx}" for idx in range(size)], dtype=object),
+        time=np.full(size, int(datetime.datetime(2020, 10, 16, 7).timestamp())),
+        current=prices,
+        volume=rng.integers(0, 10 ** 8, size),
+        turnover=rng.integers(0, 10 ** 10, size),
+        bid_price=book[:, 4::-1],
+        bid_volume=rng.integers(0, 10 ** 5, (size, TickBatch.depth)),
+        ask_price=book[:, 5:],
+        ask_volume=rng.integers(0, 10 ** 5, (size, TickBatch.depth)),
+    )
+
+
+def main(size: int = 5000, rounds: int = 5):
+    batch = make_batch(size)
+    ticks = list(batch)
+    for name, func, arg in [
+        ("json + make_lines", encode_by_json, ticks),
+        ("columnar encode", encode_by_columns, batch),
+    ]:
+        with catch_time() as ctx:
+            for _ in range(rounds):
+                func(arg)
+        print(f"{name:>20}: {size * rounds / ctx.time_delta:,.0f} points/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""InfluxDB 查询结果缓存
+
+以规范化后的查询语句为 key, 缓存 SELECT 查询的结果:
+- 查询范围包含 now() 或最近 settle 秒内的数据时, 结果只缓存 ttl 秒
+- 完全是历史数据的查询结果不会过期, 直到被淘汰或被本进程的写入失效
+- 缓存总大小超过 max_bytes 时按 LRU 淘汰
+"""
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, FrozenSet, Hashable, Iterable, Optional
+
+import pandas as pd
+from pandas import DataFrame
+
+from stock_analysis import settings
+
+logger = logging.getLogger(__name__)
+
+TIME_RE = re.compile(r"\btime\s*(>=|>|<=|<|=)\s*'([^']+)'", re.IGNORECASE)
+CODE_RE = re.compile(r"\bcode\s*=\s*'([^']+)'", re.IGNORECASE)
+FROM_RE = re.compile(r"\bFROM\s+(\S+)", re.IGNORECASE)
+
+# ResultSet 中每行(list)与每个值(Python 对象及其指针)大约占用的字节数
+ROW_BYTES = 64
+VALUE_BYTES = 40
+
+
+def normalize(sql: str) -> str:
+    return " ".join(sql.split()).rstrip(";")
+
+
+def cacheable(sql: str) -> bool:
+    """只缓存 SELECT 查询, SELECT ... INTO 会写入数据, 不缓存"""
+    sql = normalize(sql).upper()
+    return sql.startswith("SELECT ") and " INTO " not in sql
+
+
+def sizeof(value: Any) -> int:
+    """估算查询结果占用的字节数"""
+    if isinstance(value, DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, dict):
+        return sum(sizeof(item) for item in value.values())
+    if isinstance(value, list):
+        return sum(sizeof(item) for item in value)
+    raw = getattr(value, "raw", None)
+    if raw is not None:
+        # influxdb.resultset.ResultSet, 按行数与列数估算
+        size = 0
+        for series in raw.get("series", []):
+            rows = len(series.get("values") or [])
+            size += rows * (ROW_BYTES + len(series.get("columns", [])) * VALUE_BYTES)
+        return size
+    return len(repr(value))
+
+
+@dataclass
+class Scope:
+    """查询涉及的测量、股票代码与时间范围(秒级时间戳), 为 None 表示不限"""
+
+    measurement: Optional[str] = None
+    codes: Optional[FrozenSet[str]] = None
+    start: Optional[float] = None
+    end: Optional[float] = None
+    touches_now: bool = True
+
+    @classmethod
+    def parse(cls, sql: str) -> "Scope":
+        scope = cls()
+        match = FROM_RE.search(sql)
+        if match and "," not in match.group(1):
+            scope.measurement = match.group(1).split(".")[-1].strip('"')
+        codes = CODE_RE.findall(sql)
+        if codes:
+            scope.codes = frozenset(codes)
+        for op, value in TIME_RE.findall(sql):
+            try:
+                ts = pd.Timestamp(value)
+            except ValueError:
+                continue
+            if ts.tzinfo is None:
+                ts = ts.tz_localize("UTC")
+            ts = ts.timestamp()
+            if op in (">", ">=", "="):
+                scope.start = ts if scope.start is None else max(scope.start, ts)
+            if op in ("<", "<=", "="):
+                scope.end = ts if scope.end is None else min(scope.end, ts)
+        scope.touches_now = "now()" in sql.lower() or scope.end is None
+        return scope
+
+    def overlaps(
+        self, measurement: str, codes: Optional[Iterable[str]], start: float, end: float
+    ) -> bool:
+        if self.measurement is not None and self.measurement != measurement:
+            return False
+        if self.codes is not None and codes is not None and not self.codes & codes:
+            return False
+        if self.start is not None and end < self.start:
+            return False
+        if self.end is not None and start > self.end:
+            return False
+        return True
+
+
+@dataclass
+class Entry:
+    value: Any
+    size: int
+    scope: Scope
+    # 为 None 时不过期
+    expires_at: Optional[float] = None
+
+
+@dataclass
+class CacheStats:
+    """查询缓存统计"""
+
+    hits: int = 0
+    misses: int = 0
+    expired: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+
+class QueryCache:
+    """按字节数 LRU 淘汰的查询结果缓存
+
+    :param ttl: 查询范围包含最近数据时结果的缓存时间(秒)
+    :param settle: 结束时间距今超过 settle 秒的查询视为历史查询, 结果不过期
+    """
+
+    def __init__(
+        self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 10, settle: float = 300
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.settle = settle
+        self.stats = CacheStats()
+        self._entries: "OrderedDict[Hashable, Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 每次失效加一, 查询期间发生过失效时不缓存查询结果, 以免缓存写入前的数据
+        self._generation = 0
+
+    def get(self, key: Hashable, sql: str, load: Callable[[], Any]) -> Any:
+        """读取 key 的缓存结果, 不存在或已过期时调用 load 查询并缓存
+
+        返回的结果在多次查询间共享, 调用方不应修改。
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.expires_at is None or entry.expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.stats.hits += 1
+                    return entry.value
+                self._remove(key)
+                self.stats.expired += 1
+            self.stats.misses += 1
+            generation = self._generation
+
+        value = load()
+        scope = Scope.parse(sql)
+        historical = not scope.touches_now and scope.end < time.time() - self.settle
+        entry = Entry(
+            value=value,
+            size=sizeof(value),
+            scope=scope,
+            expires_at=None if historical else time.monotonic() + self.ttl,
+        )
+        if entry.size > self.max_bytes:
+            return value
+        with self._lock:
+            if generation != self._generation:
+                return value
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.stats.bytes += entry.size
+            self.stats.entries = len(self._entries)
+            while self.stats.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+        return value
+
+    def invalidate(
+        self,
+        measurement: str,
+        codes: Optional[Iterable[str]],
+        start: float,
+        end: float,
+    ):
+        """写入 measurement 后使包含写入数据的缓存失效
+
+        :param codes: 写入的股票代码, 为 None 表示不限
+        :param start: 写入数据的最早时间(秒级时间戳)
+        :param end: 写入数据的最晚时间(秒级时间戳)
+        """
+        codes = frozenset(codes) if codes is not None else None
+        with self._lock:
+            self._generation += 1
+            keys = [
+                key
+                for key, entry in self._entries.items()
+                if entry.scope.overlaps(measurement, codes, start, end)
+            ]
+            for key in keys:
+                self._remove(key)
+            self.stats.invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self.stats.bytes = 0
+            self.stats.entries = 0
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key)
+        self.stats.bytes -= entry.size
+        self.stats.entries = len(self._entries)
+
+    def report(self):
+        """输出缓存统计"""
+        logger.info(
+            "influxdb query cache: hit rate %.1f%%, %s",
+            self.stats.hit_rate * 100,
+            self.stats,
+        )
+
+
+class CachedClient:
+    """InfluxDBClient/DataFrameClient 的代理, SELECT 查询经过 cache, 其余调用直接转发"""
+
+    def __init__(self, client, cache: Optional[QueryCache]):
+        self.client = client
+        self.cache = cache
+        # 不同的服务器、数据库与客户端类型(返回值类型不同)分开缓存
+        self.namespace = (
+            type(client).__name__,
+            client._host,
+            client._port,
+            client._database,
+        )
+
+    def query(self, query: str, *args, **kwargs):
+        if self.cache is None or args or kwargs or not cacheable(query):
+            return self.client.query(query, *args, **kwargs)
+        return self.cache.get(
+            (self.namespace, normalize(query)), query, lambda: self.client.query(query)
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+query_cache = (
+    QueryCache(**settings.INFLUXDB_QUERY_CACHE)
+    if settings.INFLUXDB_QUERY_CACHE
+    else None
+)
@@ -2,7 +2,17 @@
 from influxdb import InfluxDBClient, DataFrameClient
 
 from stock_analysis import settings
+from stock_analysis.storage.influxdb.cache import CachedClient, query_cache
+from stock_analysis.storage.influxdb.line_protocol import LineProtocolWriter
+from stock_analysis.storage.influxdb.spool import Spool
 
-client = InfluxDBClient(**settings.INFLUXDB_CONF)
+client = CachedClient(InfluxDBClient(**settings.INFLUXDB_CONF), query_cache)
 
-df_client = DataFrameClient(**settings.INFLUXDB_CONF)
+df_client = CachedClient(DataFrameClient(**settings.INFLUXDB_CONF), query_cache)
+
+line_writer = LineProtocolWriter(
+    client,
+    settings.INFLUXDB_CONF["database"],
+    spool=Spool(**settings.INFLUXDB_SPOOL) if settings.INFLUXDB_SPOOL else None,
+    **settings.INFLUXDB_WRITE_OPTIONS,
+)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""按列将数据编码为 InfluxDB line protocol, 并批量写入"""
+import gzip
+import logging
+import re
+import threading
+import time
+from typing import Callable, Dict, FrozenSet, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import requests
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from stock_analysis.storage.influxdb.spool import Spool
+
+logger = logging.getLogger(__name__)
+
+# InfluxDB 不可用时的异常, 此时将数据写入 spool; 4xx 等数据本身有问题的异常仍然抛出
+UNAVAILABLE_ERRORS = (requests.exceptions.RequestException, InfluxDBServerError)
+
+# 秒级时间戳转换为各精度时的倍数
+PRECISIONS = {"s": 1, "ms": 10 ** 3, "u": 10 ** 6, "n": 10 ** 9}
+
+
+def escape_tag(value: str) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace(" ", "\\ ")
+        .replace(",", "\\,")
+        .replace("=", "\\=")
+        .replace("\n", "\\n")
+    )
+
+
+# 转义后的 tag key/value 与 measurement
+TAG_TOKEN = r"(?:\\.|[^,= \\])+"
+# measurement 与 tag 组成的 series key, 到第一个未转义的空格为止
+SERIES_RE = re.compile(r"^(?:\\.|[^ \\])+")
+MEASUREMENT_RE = re.compile(rf"^({TAG_TOKEN})")
+CODE_TAG_RE = re.compile(rf"(?<!\\),code=({TAG_TOKEN})")
+
+
+def unescape_tag(value: str) -> str:
+    return re.sub(r"\\(.)", r"\1", value)
+
+
+def decode_scopes(
+    lines: List[str], precision: str = "s"
+) -> Dict[str, Tuple[Optional[FrozenSet[str]], int, int]]:
+    """解析 lines 写入的 {measurement: (股票代码, 最早时间, 最晚时间)}, 时间为秒级时间戳
+
+    没有 code tag 的行使该 measurement 的股票代码为 None(不限)
+    """
+    scopes: Dict[str, Tuple[Optional[set], int, int]] = {}
+    for line in lines:
+        series = SERIES_RE.match(line)
+        if not series:
+            continue
+        measurement = unescape_tag(MEASUREMENT_RE.match(series.group()).group(1))
+        code = CODE_TAG_RE.search(series.group())
+        ts = int(line.rsplit(" ", 1)[1]) // PRECISIONS[precision]
+        codes, start, end = scopes.get(measurement, (set(), ts, ts))
+        if codes is not None:
+            if code is None:
+                codes = None
+            else:
+                codes.add(unescape_tag(code.group(1)))
+        scopes[measurement] = (codes, min(start, ts), max(end, ts))
+    return {
+        measurement: (frozenset(codes) if codes is not None else None, start, end)
+        for measurement, (codes, start, end) in scopes.items()
+    }
+
+
+def quote_ident(value: str) -> str:
+    return '"{}"'.format(
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    )
+
+
+def encode_field(key: str, column: np.ndarray) -> List[str]:
+    """将一列字段值编码为 key=value 列表, 缺失值(NaN/None/被 mask)编码为空字符串"""
+    key = escape_tag(key)
+    mask = None
+    if isinstance(column, np.ma.MaskedArray):
+        mask = np.ma.getmaskarray(column)
+        column = column.data
+    column = np.asarray(column)
+
+    if column.dtype.kind == "f":
+        nan = np.isnan(column)
+        mask = nan if mask is None else mask | nan
+        values = [f"{key}={value!r}" for value in column.tolist()]
+    elif column.dtype.kind in "iu":
+        values = [f"{key}={value}i" for value in column.tolist()]
+    elif column.dtype.kind == "b":
+        values = [f"{key}={value}" for value in column.tolist()]
+    else:
+        values = [
+            f"{key}={quote_ident(str(value))}" if value is not None else ""
+            for value in column.tolist()
+        ]
+
+    if mask is not None and mask.any():
+        for idx in np.flatnonzero(mask).tolist():
+            values[idx] = ""
+    return values
+
+
+def encode(
+    measurement: str,
+    tags: Dict[str, Union[str, Sequence[str]]],
+    fields: Dict[str, np.ndarray],
+    times: np.ndarray,
+    precision: str = "s",
+) -> List[str]:
+    """按列编码 line protocol
+
+    :param tags: 标签值, 可以是所有行共用的字符串, 也可以是每行一个值的序列
+    :param fields: 字段值, 每行一个值, 整数/浮点数/布尔值/字符串分别按 InfluxDB 对应类型编码
+    :param times: 秒级 unix 时间戳
+    """
+    size = len(times)
+    series = [escape_tag(measurement)] * size
+    # 与 influxdb-python 一致, 标签与字段均按 key 排序
+    for key in sorted(tags):
+        value = tags[key]
+        prefix = f",{escape_tag(key)}="
+        if isinstance(value, str):
+            series = [f"{s}{prefix}{escape_tag(value)}" for s in series]
+        else:
+            escaped = {v: escape_tag(v) for v in set(value)}
+            series = [f"{s}{prefix}{escaped[v]}" for s, v in zip(series, value)]
+
+    columns = [encode_field(key, fields[key]) for key in sorted(fields)]
+    timestamps = (np.asarray(times, dtype=np.int64) * PRECISIONS[precision]).tolist()
+    lines = []
+    for s, values, ts in zip(series, zip(*columns), timestamps):
+        field_set = ",".join(value for value in values if value)
+        if field_set:
+            lines.append(f"{s} {field_set} {ts}")
+    return lines
+
+
+class LineProtocolWriter:
+    """按 batch_size 分批将 line protocol 写入 InfluxDB
+
+    设置了 spool 时, InfluxDB 不可用的期间数据会暂存到本地 spool, 恢复后先按顺序回放 spool 再写入新数据;
+    回放失败后按指数退避(最长 max_backoff 秒)等待下次重试, 等待期间新数据直接写入 spool;
+    回放时被 InfluxDB 拒绝(4xx, 如字段类型冲突、超出保留期)的批次重试也不会成功, 移入 spool 的 dead letter 后继续回放。
+    on_replay 不为空时, 每批回放的数据写入后以这批 lines 调用 on_replay(如使查询缓存失效)。
+    """
+
+    on_replay: Optional[Callable[[List[str]], None]] = None
+
+    def __init__(
+        self,
+        client: InfluxDBClient,
+        database: str,
+        batch_size: int = 5000,
+        gzip: bool = False,
+        precision: str = "s",
+        spool: Optional[Spool] = None,
+        max_backoff: float = 300,
+    ):
+        self.client = client
+        self.database = database
+        self.batch_size = batch_size
+        self.gzip = gzip
+        self.precision = precision
+        self.spool = spool
+        self.max_backoff = max_backoff
+
+        self._replay_lock = threading.Lock()
+        self._backoff = 1.0
+        self._retry_at = 0.0
+
+    def write_columns(
+        self,
+        measurement: str,
+        tags: Dict[str, Union[str, Sequence[str]]],
+        fields: Dict[str, np.ndarray],
+        times: np.ndarray,
+    ):
+        """按列编码并写入, 参数含义见 encode"""
+        self.write(encode(measurement, tags, fields, times, self.precision))
+
+    def write(self, lines: List[str]):
+        if self.spool is None:
+            return self._write(lines)
+
+        # 保证写入顺序: spool 中还有数据时需要先回放
+        if self.spool.pending and not self.replay():
+            self.spool.append(lines)
+            return
+        try:
+            self._write(lines)
+        except UNAVAILABLE_ERRORS:
+            logger.exception("write to influxdb failed, spool %d points", len(lines))
+            self._delay_retry()
+            self.spool.append(lines)
+
+    def replay(self) -> bool:
+        """回放 spool 中的数据, 返回 spool 是否已全部写入"""
+        if self.spool is None or not self.spool.pending:
+            return True
+        if time.monotonic() < self._retry_at:
+            return False
+        # 已有线程在回放时不等待, 由调用方将新数据写入 spool
+        if not self._replay_lock.acquire(blocking=False):
+            return False
+        try:
+            self.spool.replay(self._replay, batch_size=self.batch_size * 10)
+        except UNAVAILABLE_ERRORS:
+            logger.warning("replay spool failed, retry in %.0fs", self._backoff)
+            self._delay_retry()
+            return False
+        finally:
+            self._replay_lock.release()
+        self._backoff = 1.0
+        return True
+
+    def _delay_retry(self):
+        self._retry_at = time.monotonic() + self._backoff
+        self._backoff = min(self._backoff * 2, self.max_backoff)
+
+    def _replay(self, lines: List[str]):
+        for start in range(0, len(lines), self.batch_size):
+            batch = lines[start : start + self.batch_size]
+            try:
+                self.write_batch(batch)
+            except InfluxDBClientError as err:
+                self.spool.reject(batch, str(err))
+        if self.on_replay is not None:
+            self.on_replay(lines)
+
+    def _write(self, lines: List[str]):
+        for start in range(0, len(lines), self.batch_size):
+            self.write_batch(lines[start : start + self.batch_size])
+
+    def write_batch(self, lines: List[str]):
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        headers = {"Content-Type": "application/octet-stream", "Accept": "text/plain"}
+        if self.gzip:
+            data = gzip.compress(data, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+        self.client.request(
+            url="write",
+            method="POST",
+            params=dict(db=self.database, precision=self.precision),
+            data=data,
+            expected_response_code=204,
+            headers=headers,
+        )
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""InfluxDB 分级保留: 原始数据只保留 N 天, 由 continuous query 维护 1m/5m/1d 等精度的 OHLCV 聚合数据
+
+聚合数据写入与精度同名的 retention policy(如 "rollup_5m"."stock_ticks"), 测量名与原始数据相同;
+查询时由 bar_query 选择能满足所需周期的最粗精度。
+"""
+import datetime
+import logging
+import re
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Sized, TypeVar
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+
+from stock_analysis import settings
+from stock_analysis.constants import IntervalType
+
+logger = logging.getLogger(__name__)
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+EPOCH = datetime.datetime(1970, 1, 1)
+# 按 rollup 选择聚合数据时, 每个股票代码条件的数量上限, 超过时聚合全部股票
+MAX_ROLLUP_CODES = 100
+
+Result = TypeVar("Result", bound=Sized)
+
+# 由 k 线聚合为更大周期的 k 线
+BAR_AGGREGATES = dict(
+    open='first("open")',
+    high='max("high")',
+    low='min("low")',
+    close='last("close")',
+    volume='sum("volume")',
+    turnover='sum("turnover")',
+)
+
+
+@dataclass
+class Source:
+    """需要聚合的原始测量
+
+    :param aggregates: 各 OHLCV 字段由原始字段聚合的方式
+    :param resolution: 原始数据的精度(秒), 不生成不比它更粗的聚合
+    :param interval: 只读取 interval tag 为该值的原始数据, 同一股票可能同时写入了多个周期的 k 线
+    """
+
+    aggregates: Dict[str, str]
+    resolution: int = 0
+    interval: Optional[str] = None
+
+    @property
+    def conditions(self) -> List[str]:
+        """读取原始数据及其聚合数据时需要附加的条件"""
+        return [f"interval='{self.interval}'"] if self.interval else []
+
+
+SOURCES = {
+    # tick 中的成交量与成交额是当日累计值, 按写入时计算的逐笔增量(见 TickVolumeTracker)求和
+    "stock_ticks": Source(
+        aggregates=dict(
+            open='first("current")',
+            high='max("current")',
+            low='min("current")',
+            close='last("current")',
+            volume='sum("tick_volume")',
+            turnover='sum("tick_turnover")',
+        )
+    ),
+    "stock_history": Source(
+        aggregates=BAR_AGGREGATES,
+        resolution=60,
+        interval=IntervalType.ONE_MINUTE.value,
+    ),
+}
+
+
+def parse_duration(value: str) -> Optional[datetime.timedelta]:
+    """解析 InfluxDB 的时长, INF 返回 None"""
+    if value.upper() == "INF":
+        return None
+    match = re.fullmatch(r"(\d+)([smhdw])", value)
+    if not match:
+        raise ValueError(f"invalid duration: {value}")
+    return datetime.timedelta(seconds=int(match.group(1)) * UNITS[match.group(2)])
+
+
+@dataclass
+class Tier:
+    """一个聚合精度及其保留时长"""
+
+    name: str
+    duration: str
+
+    @property
+    def seconds(self) -> int:
+        return int(parse_duration(self.name).total_seconds())
+
+    @property
+    def policy(self) -> str:
+        return f"rollup_{self.name}"
+
+    def covers(self, start: Optional[datetime.datetime]) -> bool:
+        """start(UTC) 之后的数据是否仍在保留期内, start 为空表示查询全部数据"""
+        retention = parse_duration(self.duration)
+        if retention is None:
+            return True
+        return start is not None and start >= datetime.datetime.utcnow() - retention
+
+
+def load_tiers() -> List[Tier]:
+    """按精度从细到粗排列的聚合层级"""
+    tiers = [
+        Tier(name, duration)
+        for name, duration in settings.INFLUXDB_RETENTION["rollups"].items()
+    ]
+    return sorted(tiers, key=lambda tier: tier.seconds)
+
+
+def select_clause(aggregates: Dict[str, str]) -> str:
+    return ", ".join(f'{expr} AS "{field}"' for field, expr in aggregates.items())
+
+
+def select_tier(
+    measurement: str, seconds: int, start: Optional[datetime.datetime] = None
+) -> Optional[Tier]:
+    """选择能聚合出 seconds 周期 k 线的最粗精度, 没有合适的聚合数据时返回 None(查询原始数据)"""
+    source = SOURCES.get(measurement)
+    if source is None:
+        return None
+    candidates = [
+        tier
+        for tier in load_tiers()
+        if source.resolution < tier.seconds <= seconds
+        and seconds % tier.seconds == 0
+        and tier.covers(start)
+    ]
+    return candidates[-1] if candidates else None
+
+
+def bar_query(
+    measurement: str,
+    code: str,
+    seconds: int,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    aggregates: Optional[Dict[str, str]] = None,
+    rollups: bool = True,
+) -> str:
+    """生成查询 seconds 周期 OHLCV 的语句, rollups 为 True 时优先从聚合数据中查询
+
+    :param aggregates: 查询原始数据时各字段的聚合方式, 默认按 SOURCES 中的配置
+    """
+    tier = select_tier(measurement, seconds, start) if rollups else None
+    if tier is not None:
+        source = f'"{tier.policy}"."{measurement}"'
+        aggregates = BAR_AGGREGATES
+    else:
+        source = f'"{measurement}"'
+        if aggregates is None:
+            aggregates = SOURCES[measurement].aggregates
+
+    conditions = [f"code='{code}'"]
+    if measurement in SOURCES:
+        # 聚合数据保留了原始数据的 tag, 两者使用相同的条件
+        conditions.extend(SOURCES[measurement].conditions)
+    if start:
+        conditions.append(f"time >= '{start}'")
+    conditions.append(f"time <= '{end}'" if end else "time <= now()")
+    return (
+        f"SELECT {select_clause(aggregates)} FROM {source} "
+        f"WHERE {' AND '.join(conditions)} GROUP BY time({seconds}s) fill(none)"
+    )
+
+
+def query_bars(
+    query: Callable[[str], Result],
+    measurement: str,
+    code: str,
+    seconds: int,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    aggregates: Optional[Dict[str, str]] = None,
+) -> Result:
+    """以 query 执行 bar_query, 聚合数据不存在(尚未执行 setup)或没有数据(尚未聚合)时改为查询原始数据"""
+    args = (measurement, code, seconds, start, end, aggregates)
+    if select_tier(measurement, seconds, start) is not None:
+        try:
+            result = query(bar_query(*args))
+            if len(result):
+                return result
+        except InfluxDBClientError as err:
+            logger.warning(
+                "query %s rollups failed, fallback to raw: %s", measurement, err
+            )
+    return query(bar_query(*args, rollups=False))
+
+
+def rollup_select(measurement: str, tier: Tier, conditions: Sequence[str] = ()) -> str:
+    """聚合 measurement 并写入 tier 对应的 retention policy 的语句"""
+    database = settings.INFLUXDB_CONF["database"]
+    source = SOURCES[measurement]
+    conditions = [*source.conditions, *conditions]
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+    return (
+        f"SELECT {select_clause(source.aggregates)} "
+        f'INTO "{database}"."{tier.policy}"."{measurement}" '
+        f'FROM "{measurement}" {where}GROUP BY time({tier.name}), *'
+    )
+
+
+def setup(client: InfluxDBClient) -> List[str]:
+    """创建或更新各精度的 retention policy 与 continuous query, 返回执行的操作"""
+    actions = []
+    database = settings.INFLUXDB_CONF["database"]
+    policies = {
+        policy["name"]: policy for policy in client.get_list_retention_policies()
+    }
+    tiers = load_tiers()
+    for tier in tiers:
+        if tier.policy not in policies:
+            client.create_retention_policy(tier.policy, tier.duration, "1", database)
+            actions.append(f"create retention policy {tier.policy} {tier.duration}")
+        else:
+            # SHOW RETENTION POLICIES 返回的时长格式为 8760h0m0s, 不比较直接更新
+            client.alter_retention_policy(tier.policy, database, tier.duration)
+
+    existing = {
+        query["name"]
+        for item in client.get_list_continuous_queries()
+        for query in item.get(database, [])
+    }
+    for measurement, source in SOURCES.items():
+        for tier in tiers:
+            if tier.seconds <= source.resolution:
+                continue
+            name = f"cq_{measurement}_{tier.name}"
+            if name in existing:
+                # continuous query 不支持修改, 删除后重建
+                client.drop_continuous_query(name, database)
+            # 重新计算上一个周期, 包含延迟写入的数据
+            client.create_continuous_query(
+                name,
+                rollup_select(measurement, tier),
+                database,
+                resample_opts=f"FOR {tier.seconds * 2}s",
+            )
+            actions.append(f"create continuous query {name}")
+    return actions
+
+
+def align_time(
+    value: datetime.datetime, seconds: int, ceil: bool = False
+) -> datetime.datetime:
+    """与 GROUP BY time 一样按 unix 时间将 value 对齐到 seconds 的整数倍"""
+    offset = int((value - EPOCH).total_seconds())
+    aligned = offset // seconds * seconds
+    if ceil and aligned < offset:
+        aligned += seconds
+    return EPOCH + datetime.timedelta(seconds=aligned)
+
+
+def rollup(
+    client: InfluxDBClient,
+    measurement: str,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    step: datetime.timedelta = datetime.timedelta(days=7),
+    codes: Optional[Sequence[str]] = None,
+):
+    """聚合 [start, end) 内已有的数据, continuous query 只处理最近的数据, 回填、回放的历史数据需要手动聚合
+
+    :param codes: 只聚合这些股票, 为空或超过 MAX_ROLLUP_CODES 只时聚合全部股票
+    """
+    source = SOURCES[measurement]
+    conditions = []
+    if codes and len(codes) <= MAX_ROLLUP_CODES:
+        pattern = "|".join(re.escape(code) for code in sorted(codes))
+        conditions.append(f"code =~ /^({pattern})$/")
+    for tier in load_tiers():
+        if tier.seconds <= source.resolution:
+            continue
+        # 按精度对齐, 避免只包含部分数据的边界周期覆盖已有的完整聚合结果
+        cursor = align_time(start, tier.seconds)
+        tier_end = align_time(end, tier.seconds, ceil=True)
+        # 按 step 分段执行, 避免一次查询的数据量过大
+        while cursor < tier_end:
+            stop = min(cursor + step, tier_end)
+            client.query(
+                rollup_select(
+                    measurement,
+                    tier,
+                    conditions=[
+                        *conditions,
+                        f"time >= '{cursor}'",
+                        f"time < '{stop}'",
+                    ],
+                )
+            )
+            cursor = stop
+        logger.info(
+            "rolled up %s to %s from %s to %s", measurement, tier.name, start, end
+        )
+
+
+def prune(client: InfluxDBClient):
+    """删除超过保留时长的原始数据
+
+    原始数据与 k 线同在默认的 retention policy 中, 无法通过 retention policy 的时长淘汰, 改为定期删除。
+    """
+    for measurement, duration in settings.INFLUXDB_RETENTION["raw"].items():
+        if parse_duration(duration) is None:
+            continue
+        client.query(f'DELETE FROM "{measurement}" WHERE time < now() - {duration}')
+        logger.info("pruned %s older than %s", measurement, duration)
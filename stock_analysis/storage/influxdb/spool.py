@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""写入 InfluxDB 失败时暂存 line protocol 的本地分段日志"""
+import atexit
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import BinaryIO, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Spool:
+    """只追加写入的分段日志
+
+    数据按顺序写入编号递增的分段文件, 当前分段超过 segment_bytes 后切换到新分段;
+    所有分段总大小超过 max_bytes 时删除最旧的分段。
+    为减少 fsync 次数, 每 fsync_interval 秒(以及切换分段时)才 fsync 一次。
+    被 InfluxDB 拒绝(4xx)的数据由 reject 追加到 dead letter 文件, 不再回放。
+    """
+
+    suffix = ".lp"
+    dead_letter_name = "dead_letter.txt"
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int = 16 * 1024 * 1024,
+        max_bytes: int = 1024 * 1024 * 1024,
+        fsync_interval: float = 1,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.dropped_bytes = 0
+
+        self._lock = threading.Lock()
+        self._file: Optional[BinaryIO] = None
+        self._file_size = 0
+        self._last_fsync = time.monotonic()
+        # 未回放的分段(包括当前分段), 只在启动时扫描一次目录
+        self._segments: List[Path] = sorted(self.directory.glob(f"*{self.suffix}"))
+        self._sequence = int(self._segments[-1].stem) if self._segments else 0
+        atexit.register(self.close)
+
+    def segments(self) -> List[Path]:
+        with self._lock:
+            return list(self._segments)
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._segments)
+
+    @property
+    def dead_letter_path(self) -> Path:
+        return self.directory / self.dead_letter_name
+
+    def append(self, lines: List[str]):
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        with self._lock:
+            if self._file is None or self._file_size >= self.segment_bytes:
+                self._seal()
+                self._sequence += 1
+                path = self.directory / f"{self._sequence:012d}{self.suffix}"
+                self._file = open(path, "ab")
+                self._file_size = 0
+                self._segments.append(path)
+                self._enforce_limit()
+            self._file.write(data)
+            self._file.flush()
+            self._file_size += len(data)
+            if time.monotonic() - self._last_fsync >= self.fsync_interval:
+                self._fsync()
+
+    def _fsync(self):
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.monotonic()
+
+    def _seal(self):
+        """关闭当前分段, 之后的数据写入新分段"""
+        if self._file is not None:
+            self._fsync()
+            self._file.close()
+            self._file = None
+
+    def _enforce_limit(self):
+        sizes = [path.stat().st_size for path in self._segments]
+        total = sum(sizes)
+        # 不删除刚创建的当前分段
+        for path, size in zip(self._segments[:-1], sizes):
+            if total <= self.max_bytes:
+                break
+            path.unlink()
+            self._segments.remove(path)
+            total -= size
+            self.dropped_bytes += size
+            logger.error("spool exceeds %d bytes, drop %s", self.max_bytes, path)
+
+    def replay(self, write: Callable[[List[str]], None], batch_size: int = 50000):
+        """按顺序回放所有分段, 每个分段全部写入成功后删除; write 抛出异常时停止回放
+
+        分段可能被部分写入后中断, 再次回放时会重复写入, 由于 InfluxDB 中相同 series 与时间戳的点会被覆盖,
+        重复写入是幂等的。
+        """
+        with self._lock:
+            self._seal()
+            segments = list(self._segments)
+        for path in segments:
+            try:
+                lines = path.read_bytes().decode("utf-8").splitlines()
+            except FileNotFoundError:
+                # 回放期间超出 max_bytes 被删除
+                continue
+            for start in range(0, len(lines), batch_size):
+                write(lines[start : start + batch_size])
+            with self._lock:
+                if path in self._segments:
+                    path.unlink()
+                    self._segments.remove(path)
+            logger.info("replayed %d points from %s", len(lines), path)
+
+    def reject(self, lines: List[str], reason: str):
+        """将被拒绝写入的数据追加到 dead letter 文件, 以 # 开头的注释行记录时间与原因"""
+        header = f"# {time.strftime('%Y-%m-%dT%H:%M:%S')} {' '.join(reason.split())}"
+        data = ("\n".join([header, *lines]) + "\n").encode("utf-8")
+        with self._lock:
+            with open(self.dead_letter_path, "ab") as fh:
+                fh.write(data)
+                os.fsync(fh.fileno())
+        logger.error(
+            "%d points rejected by influxdb, moved to %s: %s",
+            len(lines),
+            self.dead_letter_path,
+            reason,
+        )
+
+    def close(self):
+        with self._lock:
+            self._seal()
@@ -1,19 +1,68 @@
 # -*- coding: utf-8 -*-
-from sqlalchemy import create_engine
+import decimal
+import enum
+import hashlib
+import json
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy import Table, bindparam, create_engine, event, text, tuple_
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session, sessionmaker
 
 from stock_analysis import settings
 
-engine = create_engine(str(settings.SQLALCHEMY_DB_URL))
+
+def configure_engine(url: str, readonly: bool = False) -> Engine:
+    """按 settings 创建 engine
+
+    SQLite 在每个连接上执行 SQLITE_PRAGMAS(WAL 模式下读写互不阻塞), readonly 时额外开启 query_only;
+    其他数据库使用 SQLALCHEMY_ENGINE_OPTIONS 中的连接池参数。
+    """
+    if make_url(url).get_backend_name() != "sqlite":
+        return create_engine(url, **settings.SQLALCHEMY_ENGINE_OPTIONS)
+
+    pragmas = dict(settings.SQLITE_PRAGMAS)
+    if readonly:
+        pragmas["query_only"] = "ON"
+    sqlite_engine = create_engine(url)
+
+    @event.listens_for(sqlite_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for key, value in pragmas.items():
+            cursor.execute(f"PRAGMA {key} = {value}")
+        cursor.close()
+
+    return sqlite_engine
+
+
+engine = configure_engine(str(settings.SQLALCHEMY_DB_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base(engine)
 
+# 只读查询(如告警)使用的 engine, 非 SQLite 数据库无法限制只读, 与 engine 共用
+if engine.dialect.name == "sqlite":
+    readonly_engine = configure_engine(str(settings.SQLALCHEMY_DB_URL), readonly=True)
+else:
+    readonly_engine = engine
+ReadonlySessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, bind=readonly_engine
+)
+
 
 def get_session() -> Session:
     return SessionLocal()
 
 
+def get_readonly_session() -> Session:
+    """只用于查询的 session"""
+    return ReadonlySessionLocal()
+
+
 def get_or_create(session: Session, obj: Base):
     model = type(obj)
     pk = model.__table__.primary_key.columns_autoinc_first[0].name
@@ -30,3 +79,123 @@ def get_or_create(session: Session, obj: Base):
         session.commit()
         session.flush()
         return obj, True
+
+
+def content_hash(values: Sequence[Any]) -> str:
+    """计算一行数据的摘要, 数值统一转换为 float, 枚举转换为名称, 以便与数据库读出的值比较"""
+
+    def normalize(value):
+        if isinstance(value, (decimal.Decimal, float)):
+            return float(value)
+        if isinstance(value, enum.Enum):
+            return value.name
+        return value
+
+    data = json.dumps(
+        [normalize(value) for value in values], sort_keys=True, default=str
+    )
+    return hashlib.md5(data.encode("utf-8")).hexdigest()
+
+
+def upsert_statement(
+    session: Session, table: Table, keys: List[str], columns: List[str]
+):
+    """生成 INSERT ... ON CONFLICT DO UPDATE 语句, keys 为冲突判断的唯一键"""
+    dialect = session.bind.dialect
+    updates = [column for column in columns if column not in keys]
+    if dialect.name == "postgresql":
+        stmt = postgresql.insert(table)
+        if not updates:
+            return stmt.on_conflict_do_nothing(index_elements=keys)
+        return stmt.on_conflict_do_update(
+            index_elements=keys,
+            set_={column: stmt.excluded[column] for column in updates},
+        )
+    if dialect.name == "mysql":
+        stmt = mysql.insert(table)
+        # MySQL 不支持 DO NOTHING, 用更新主键为自身代替
+        return stmt.on_duplicate_key_update(
+            {column: stmt.inserted[column] for column in updates or keys}
+        )
+    if dialect.name == "sqlite":
+        # SQLAlchemy 1.3 的 sqlite 方言不支持 on_conflict, 手动拼接 SQL(需要 SQLite 3.24+)
+        quote = dialect.identifier_preparer.quote
+        sql = "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) ".format(
+            quote(table.name),
+            ", ".join(quote(column) for column in columns),
+            ", ".join(f":{column}" for column in columns),
+            ", ".join(quote(key) for key in keys),
+        )
+        if updates:
+            sql += "DO UPDATE SET " + ", ".join(
+                f"{quote(column)} = excluded.{quote(column)}" for column in updates
+            )
+        else:
+            sql += "DO NOTHING"
+        # 通过 bindparam 指定类型, 使 Enum/JSON/DECIMAL 等类型按 ORM 的方式转换
+        return text(sql).bindparams(
+            *[bindparam(column, type_=table.c[column].type) for column in columns]
+        )
+    raise NotImplementedError(f"bulk_upsert does not support {dialect.name}")
+
+
+def bulk_upsert(
+    session: Session,
+    model,
+    rows: List[Dict[str, Any]],
+    index_elements: Optional[List[str]] = None,
+    chunk_size: int = 500,
+) -> int:
+    """在一个事务内批量插入或更新 rows, 返回实际写入的行数
+
+    :param index_elements: 冲突判断的唯一键, 默认为主键; 唯一键不完整(如自增主键为空)的行直接插入
+    与数据库中内容相同(content_hash 一致)的行会被跳过
+    """
+    table: Table = model.__table__
+    keys = index_elements or [column.name for column in table.primary_key.columns]
+
+    # 字段不同的行需要分开执行
+    groups: Dict[tuple, List[Dict[str, Any]]] = defaultdict(list)
+    for row in rows:
+        groups[tuple(sorted(row))].append(row)
+
+    written = 0
+    for columns, group in groups.items():
+        columns = list(columns)
+        inserts, upserts = [], []
+        for row in group:
+            if all(row.get(key) is not None for key in keys):
+                upserts.append(row)
+            else:
+                inserts.append(row)
+
+        for start in range(0, len(upserts), chunk_size):
+            chunk = upserts[start : start + chunk_size]
+            existing = set()
+            key_columns = [table.c[key] for key in keys]
+            if len(keys) == 1:
+                condition = key_columns[0].in_([row[keys[0]] for row in chunk])
+            else:
+                condition = tuple_(*key_columns).in_(
+                    [tuple(row[key] for key in keys) for row in chunk]
+                )
+            for values in session.query(*[table.c[c] for c in columns]).filter(
+                condition
+            ):
+                existing.add(content_hash(values))
+            changed = [
+                row
+                for row in chunk
+                if content_hash([row[column] for column in columns]) not in existing
+            ]
+            if changed:
+                session.execute(
+                    upsert_statement(session, table, keys, columns), changed
+                )
+                written += len(changed)
+
+        if inserts:
+            session.execute(table.insert(), inserts)
+            written += len(inserts)
+    session.commit()
+    return written
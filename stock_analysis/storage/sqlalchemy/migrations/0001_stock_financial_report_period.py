@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""stock_financial 增加报告期与数值字段, 合并重复的财报并建立唯一索引"""
+import json
+
+from sqlalchemy import inspect
+from stock_analysis.constants import LATEST_REPORT_PERIOD
+from stock_analysis.storage.sqlalchemy.models import StockFinancial
+
+METRICS = [
+    "net_profit",
+    "net_profix_growth",
+    "sum_of_business",
+    "sum_of_business_growth",
+    "net_profit_rate",
+    "gross_profit_rate",
+    "debt_asset_rate",
+    "return_on_equity_rate",
+]
+
+
+def upgrade(connection):
+    table = StockFinancial.__table__
+    inspector = inspect(connection)
+    if table.name not in inspector.get_table_names():
+        table.create(connection)
+        return
+
+    columns = {column["name"] for column in inspector.get_columns(table.name)}
+    if "report_period" not in columns:
+        connection.execute(
+            "ALTER TABLE stock_financial ADD COLUMN report_period VARCHAR(16) "
+            f"NOT NULL DEFAULT '{LATEST_REPORT_PERIOD}'"
+        )
+    for metric in METRICS:
+        if metric not in columns:
+            connection.execute(f"ALTER TABLE stock_financial ADD COLUMN {metric} FLOAT")
+
+    # 此前每次同步都会插入新行, 每只股票每种财报只保留最新(id 最大)的一行
+    connection.execute(
+        "DELETE FROM stock_financial WHERE id NOT IN ("
+        "SELECT max_id FROM (SELECT MAX(id) AS max_id FROM stock_financial "
+        "GROUP BY stock_code, financial_type, report_period) AS latest)"
+    )
+
+    rows = connection.execute(table.select()).fetchall()
+    for row in rows:
+        values = row["values"]
+        if isinstance(values, str):
+            values = json.loads(values)
+        connection.execute(
+            table.update()
+            .where(table.c.id == row["id"])
+            .values(**{metric: (values or {}).get(metric) for metric in METRICS})
+        )
+
+    indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in indexes:
+            index.create(connection)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""数据库迁移
+
+每个迁移是本包内的一个模块, 提供 upgrade(connection) 函数, 按 MIGRATIONS 的顺序执行,
+已执行的迁移记录在 schema_migrations 表中; 迁移需要兼容 init_db 已按最新模型建表的情况。
+"""
+import importlib
+import logging
+from typing import List
+
+from sqlalchemy import Column, MetaData, String, Table
+from stock_analysis.storage.sqlalchemy.databases import engine
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = [
+    "0001_stock_financial_report_period",
+]
+
+schema_migrations = Table(
+    "schema_migrations", MetaData(), Column("name", String(64), primary_key=True)
+)
+
+
+def migrate() -> List[str]:
+    """执行尚未执行的迁移, 返回本次执行的迁移"""
+    schema_migrations.create(engine, checkfirst=True)
+    applied = []
+    with engine.connect() as connection:
+        done = {row[0] for row in connection.execute(schema_migrations.select())}
+        for name in MIGRATIONS:
+            if name in done:
+                continue
+            module = importlib.import_module(f"{__name__}.{name}")
+            with connection.begin():
+                module.upgrade(connection)
+                connection.execute(schema_migrations.insert(), name=name)
+            logger.info("applied migration %s", name)
+            applied.append(name)
+    return applied
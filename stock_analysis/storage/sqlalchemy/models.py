@@ -1,16 +1,27 @@
 # -*- coding: utf-8 -*-
+import datetime
+
 from sqlalchemy import (
     DECIMAL,
     JSON,
     Column,
+    DateTime,
     Enum,
+    Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
     Boolean,
 )
-from stock_analysis.constants import StockFinancialType, AlertOperator
+from stock_analysis.constants import (
+    LATEST_REPORT_PERIOD,
+    AlertOperator,
+    BackfillStatus,
+    IntervalType,
+    StockFinancialType,
+)
 from stock_analysis.storage.sqlalchemy.databases import Base
 
 
@@ -26,12 +37,33 @@ class StockBaseInfo(Base):
 
 class StockFinancial(Base):
     __tablename__ = "stock_financial"
+    __table_args__ = (
+        Index(
+            "uq_stock_financial_period",
+            "stock_code",
+            "financial_type",
+            "report_period",
+            unique=True,
+        ),
+    )
 
     id = Column("id", Integer, primary_key=True)
     stock_code = Column(String(16), ForeignKey(StockBaseInfo.stock_code))
     financial_type = Column(Enum(StockFinancialType))
+    report_period = Column(
+        String(16), nullable=False, default=LATEST_REPORT_PERIOD, comment="报告期"
+    )
     values = Column(JSON, comment="财报值, 详见StockFinancial")
 
+    net_profit = Column(Float, index=True, comment="净利润")
+    net_profix_growth = Column(Float, index=True, comment="净利润增长率(%)")
+    sum_of_business = Column(Float, index=True, comment="营业收入")
+    sum_of_business_growth = Column(Float, index=True, comment="营业同比增长率(%)")
+    net_profit_rate = Column(Float, index=True, comment="净利率")
+    gross_profit_rate = Column(Float, index=True, comment="毛利率")
+    debt_asset_rate = Column(Float, index=True, comment="资产负债率")
+    return_on_equity_rate = Column(Float, index=True, comment="净资产收益率")
+
 
 class InfluxdbAlertStrategy(Base):
     __tablename__ = "influxdb_alert_strategy"
@@ -44,3 +76,30 @@ class InfluxdbAlertStrategy(Base):
     sql = Column(Text, comment="告警sql")
     threshold = Column(DECIMAL, comment="阈值")
     operator = Column(Enum(AlertOperator), comment="阈值对比操作")
+
+
+class HistoryCoverage(Base):
+    """已写入 stock_history 的时间段, 同一股票与周期的时间段互不重叠"""
+
+    __tablename__ = "history_coverage"
+    __table_args__ = (Index("ix_history_coverage_code", "stock_code", "interval"),)
+
+    id = Column(Integer, primary_key=True)
+    stock_code = Column(String(16), comment="股票代码")
+    interval = Column(Enum(IntervalType), comment="单位时间长度")
+    start_dt = Column(DateTime, comment="开始时间(含)")
+    end_dt = Column(DateTime, comment="结束时间(含)")
+
+
+class BackfillJob(Base):
+    """历史行情回填任务, 用于恢复中断的回填"""
+
+    __tablename__ = "backfill_job"
+
+    id = Column(Integer, primary_key=True)
+    code_list = Column(JSON, comment="股票代码列表")
+    interval = Column(Enum(IntervalType), comment="单位时间长度")
+    start_dt = Column(DateTime, comment="开始时间")
+    end_dt = Column(DateTime, comment="结束时间")
+    status = Column(Enum(BackfillStatus), default=BackfillStatus.RUNNING)
+    created_at = Column(DateTime, default=datetime.datetime.now)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""时序数据的存储后端, 由 settings.TIMESERIES_BACKEND 选择 influxdb 或 columnar(嵌入式列存储)"""
+import abc
+import datetime
+import logging
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+from pandas import DataFrame
+
+from stock_analysis import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TimeSeriesBackend(metaclass=abc.ABCMeta):
+    """tick、k 线写入与告警、回测查询使用的接口"""
+
+    @abc.abstractmethod
+    def write_columns(
+        self,
+        measurement: str,
+        tags: Dict[str, Union[str, Sequence[str]]],
+        fields: Dict[str, np.ndarray],
+        times: np.ndarray,
+    ):
+        """按列写入, 参数含义见 line_protocol.encode"""
+
+    @abc.abstractmethod
+    def query(self, sql: str) -> DataFrame:
+        """执行 InfluxQL 查询, 返回以 UTC 时间为索引的 DataFrame, 没有数据时返回空的 DataFrame"""
+
+    @abc.abstractmethod
+    def latest(self, measurement: str, code: str) -> DataFrame:
+        """查询 code 最新的一条数据"""
+
+    @abc.abstractmethod
+    def last_values(
+        self, measurement: str, fields: Sequence[str], start: datetime.datetime
+    ) -> DataFrame:
+        """一次查询 start(UTC) 之后各股票 fields 的最后一个值, 返回以股票代码为索引的 DataFrame"""
+
+    @abc.abstractmethod
+    def bars(
+        self,
+        measurement: str,
+        code: str,
+        seconds: int,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        aggregates: Optional[Dict[str, str]] = None,
+    ) -> DataFrame:
+        """查询 seconds 周期的 OHLCV, aggregates 见 retention.bar_query"""
+
+    @abc.abstractmethod
+    def rollup(
+        self,
+        measurement: str,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        codes: Optional[Sequence[str]] = None,
+    ):
+        """聚合 [start, end)(UTC) 内写入的历史数据, 用于回填等 continuous query 处理不到的数据"""
+
+    @abc.abstractmethod
+    def replay(self) -> bool:
+        """回放写入失败暂存的数据, 返回是否已全部写入"""
+
+
+class InfluxDBBackend(TimeSeriesBackend):
+    def __init__(self):
+        from stock_analysis.storage.influxdb.cache import query_cache
+        from stock_analysis.storage.influxdb.databases import df_client, line_writer
+
+        self.df_client = df_client
+        self.line_writer = line_writer
+        self.query_cache = query_cache
+        # 回放 spool 的数据不经过 write_columns, 需要单独聚合并使缓存失效
+        line_writer.on_replay = self.after_replay
+
+    def write_columns(self, measurement, tags, fields, times):
+        self.line_writer.write_columns(measurement, tags, fields, times)
+        if self.query_cache is not None and len(times):
+            code = tags.get("code")
+            if code is not None:
+                code = [code] if isinstance(code, str) else set(code)
+            self.query_cache.invalidate(
+                measurement, code, int(np.min(times)), int(np.max(times)),
+            )
+
+    def after_replay(self, lines: List[str]):
+        from stock_analysis.storage.influxdb import retention
+        from stock_analysis.storage.influxdb.line_protocol import decode_scopes
+
+        scopes = decode_scopes(lines, self.line_writer.precision)
+        for measurement, (codes, start, end) in scopes.items():
+            if measurement in retention.SOURCES:
+                try:
+                    self.rollup(
+                        measurement,
+                        datetime.datetime.utcfromtimestamp(start),
+                        datetime.datetime.utcfromtimestamp(end + 1),
+                        codes,
+                    )
+                except Exception:
+                    logger.exception("rollup replayed %s failed", measurement)
+            if self.query_cache is not None:
+                self.query_cache.invalidate(measurement, codes, start, end)
+
+    def query(self, sql: str) -> DataFrame:
+        result = self.df_client.query(sql)
+        if not result:
+            return DataFrame()
+        # 结果可能被缓存共享, 不能修改
+        return next(iter(result.values()))
+
+    def latest(self, measurement: str, code: str) -> DataFrame:
+        return self.query(
+            f"select * from {measurement} where code = '{code}' ORDER BY desc LIMIT 1"
+        )
+
+    def last_values(self, measurement, fields, start):
+        select = ", ".join(f'last("{f}") AS "{f}"' for f in fields)
+        result = self.df_client.query(
+            f'SELECT {select} FROM "{measurement}" '
+            f"WHERE time >= '{start}' GROUP BY \"code\""
+        )
+        rows = {
+            dict(tags)["code"]: frame.iloc[-1]
+            for (_, tags), frame in (result or {}).items()
+        }
+        return DataFrame.from_dict(rows, orient="index", columns=list(fields))
+
+    def bars(self, measurement, code, seconds, start=None, end=None, aggregates=None):
+        from stock_analysis.storage.influxdb import retention
+
+        return retention.query_bars(
+            self.query, measurement, code, seconds, start, end, aggregates
+        )
+
+    def rollup(self, measurement, start, end, codes=None):
+        from stock_analysis.storage.influxdb import retention
+        from stock_analysis.storage.influxdb.databases import client
+
+        retention.rollup(client, measurement, start, end, codes=codes)
+        if self.query_cache is not None:
+            # 聚合数据的查询以测量名失效, 范围按最粗的精度对齐, 覆盖被重新计算的整个周期
+            seconds = max((tier.seconds for tier in retention.load_tiers()), default=1)
+            self.query_cache.invalidate(
+                measurement,
+                codes,
+                (
+                    retention.align_time(start, seconds) - retention.EPOCH
+                ).total_seconds(),
+                (
+                    retention.align_time(end, seconds, ceil=True) - retention.EPOCH
+                ).total_seconds(),
+            )
+
+    def replay(self) -> bool:
+        return self.line_writer.replay()
+
+
+class ColumnarBackend(TimeSeriesBackend):
+    def __init__(self):
+        from stock_analysis.storage.columnar.store import ColumnarStore
+
+        self.store = ColumnarStore(**settings.COLUMNAR_STORE)
+
+    def write_columns(self, measurement, tags, fields, times):
+        self.store.write_columns(measurement, tags, fields, times)
+
+    def query(self, sql: str) -> DataFrame:
+        return self.store.query(sql)
+
+    def latest(self, measurement: str, code: str) -> DataFrame:
+        return self.store.latest(measurement, code)
+
+    def last_values(self, measurement, fields, start):
+        return self.store.last_values(measurement, fields, start)
+
+    def bars(self, measurement, code, seconds, start=None, end=None, aggregates=None):
+        return self.store.bars(measurement, code, seconds, start, end, aggregates)
+
+    def rollup(self, measurement, start, end, codes=None):
+        # 列存储查询时直接聚合原始数据, 没有聚合数据
+        pass
+
+    def replay(self) -> bool:
+        return True
+
+
+BACKENDS = {"influxdb": InfluxDBBackend, "columnar": ColumnarBackend}
+
+backend: TimeSeriesBackend = BACKENDS[settings.TIMESERIES_BACKEND]()
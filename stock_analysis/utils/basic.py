@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
+import logging
+from typing import Iterable, Optional, Set
+
 from futu import Market
 
+logger = logging.getLogger(__name__)
+
 
-def detect_stock_market(code: str) -> str:
-    """探测股票属于哪个市场"""
+def detect_stock_market(code: str) -> Optional[str]:
+    """探测股票属于哪个市场, 无法识别时返回 None"""
     code = code.upper()
     if code.startswith("HK."):
         return Market.HK
@@ -13,3 +18,15 @@ def detect_stock_market(code: str) -> str:
         return Market.SZ
     if code.startswith("SH.") or code.endswith("XSHG"):
         return Market.SH
+
+
+def detect_stock_markets(code_list: Iterable[str]) -> Set[str]:
+    """探测 code_list 涉及的市场, 跳过无法识别的股票代码"""
+    markets = set()
+    for code in code_list:
+        market = detect_stock_market(code)
+        if market is None:
+            logger.warning("unknown market of stock code: %s, skipped", code)
+            continue
+        markets.add(market)
+    return markets
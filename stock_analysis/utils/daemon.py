@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import logging
 import datetime
+import math
 import signal
 import time
-from typing import List, Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Callable, Optional, Set, Union
 
-from stock_analysis.utils.timeit import catch_time
+from stock_analysis.utils.trading_calendar import TradingCalendar
 
 HANDLED_SIGNALS = (
     signal.SIGINT,  # Unix signal 2. Sent by Ctrl+C.
@@ -26,39 +30,154 @@ class SignalHandler:
         self.callbacks.append(callback)
 
 
-class Daemon:
-    trading_times = [
-        (datetime.time(hour=8, minute=45), datetime.time(hour=11, minute=31)),
-        (datetime.time(hour=12, minute=59), datetime.time(hour=16, minute=1)),
-    ]
+@dataclass
+class PluginStats:
+    """插件运行统计"""
+
+    runs: int = 0
+    # 执行时间超过调度周期的次数
+    overruns: int = 0
+    # 因超时或上一次执行未结束而跳过的周期数
+    skipped: int = 0
+    timeouts: int = 0
+    failures: int = 0
+    last_duration: float = 0
+
+
+@dataclass
+class Plugin:
+    """守护进程插件, 按固定频率(与挂钟对齐)执行 func
+
+    markets 为空时不受交易时段限制, 否则仅在其中任一市场开市时执行
+    """
+
+    func: Callable
+    period: float = 3
+    timeout: Optional[float] = None
+    name: Optional[str] = None
+    markets: Optional[Set[str]] = None
+    stats: PluginStats = field(default_factory=PluginStats)
 
-    def __init__(self, plugins: List[Callable]):
-        self.plugins = plugins
+    def __post_init__(self):
+        if self.timeout is None:
+            self.timeout = self.period
+        if self.name is None:
+            self.name = getattr(self.func, "__qualname__", repr(self.func))
+
+    def next_boundary(self, now: float) -> float:
+        """获取 now 之后下一个与挂钟对齐的调度时刻"""
+        return (math.floor(now / self.period) + 1) * self.period
+
+    def align(self, ts: float) -> float:
+        """获取 ts 之后(含)第一个与挂钟对齐的调度时刻"""
+        return math.ceil(ts / self.period) * self.period
+
+
+class Daemon:
+    def __init__(
+        self,
+        plugins: List[Union[Callable, Plugin]],
+        calendar: Optional[TradingCalendar] = None,
+    ):
+        self.plugins = [
+            plugin if isinstance(plugin, Plugin) else Plugin(plugin)
+            for plugin in plugins
+        ]
+        self.calendar = calendar or TradingCalendar()
         self.should_exit = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._exit_event: Optional[asyncio.Event] = None
         signal_handler.register(self.signal_handler)
 
-    def in_trading(self, now: datetime.time = None):
-        now = now or datetime.datetime.now().time()
-        for trading_time in self.trading_times:
-            if trading_time[0] <= now <= trading_time[1]:
-                return True
-        return False
+    def in_trading(self, plugin: Plugin, now: float) -> bool:
+        return not plugin.markets or self.calendar.is_open_any(plugin.markets, now)
 
     def loop(self):
-        delta = 3
-        while not self.should_exit:
-            logger.debug("Start A Loop")
-            if not self.in_trading():
-                continue
-            with catch_time() as ctx:
-                for plugin in self.plugins:
-                    plugin()
-                if ctx.time_delta < delta:
-                    time.sleep(delta - ctx.time_delta)
+        asyncio.run(self.serve())
+        for plugin in self.plugins:
+            logger.info("plugin %s stats: %s", plugin.name, plugin.stats)
         logger.info("exit.")
 
+    async def serve(self):
+        """并发调度所有插件, 直到收到退出信号"""
+        self._loop = asyncio.get_running_loop()
+        self._exit_event = asyncio.Event()
+        if self.should_exit:
+            return
+
+        # 同步插件在线程池中执行, 每个插件至多占用一个线程
+        executor = ThreadPoolExecutor(
+            max_workers=max(len(self.plugins), 1), thread_name_prefix="daemon"
+        )
+        self._loop.set_default_executor(executor)
+        tasks = [asyncio.ensure_future(self.schedule(p)) for p in self.plugins]
+        try:
+            await self._exit_event.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            executor.shutdown(wait=False)
+
+    async def schedule(self, plugin: Plugin):
+        """按 plugin.period 固定频率调度插件, 超时或超期时跳过错过的周期而不是追赶"""
+        loop = asyncio.get_running_loop()
+        running: Optional[asyncio.Future] = None
+        next_run = plugin.next_boundary(time.time())
+        while True:
+            await asyncio.sleep(max(next_run - time.time(), 0))
+
+            if running is not None and not running.done():
+                # 上一次已超时的调用仍未返回, 避免同一插件并发执行
+                plugin.stats.skipped += 1
+                next_run += plugin.period
+                continue
+
+            now = time.time()
+            if not self.in_trading(plugin, now):
+                opening = self.calendar.next_open_any(plugin.markets, now)
+                if opening is None:
+                    logger.warning("plugin %s: no more trading session", plugin.name)
+                    return
+                next_run = plugin.align(opening)
+                logger.info(
+                    "plugin %s sleep until %s",
+                    plugin.name,
+                    datetime.datetime.fromtimestamp(next_run),
+                )
+                continue
+
+            started = time.time()
+            running = loop.run_in_executor(None, plugin.func)
+            try:
+                await asyncio.wait_for(asyncio.shield(running), plugin.timeout)
+            except asyncio.TimeoutError:
+                plugin.stats.timeouts += 1
+                logger.warning(
+                    "plugin %s timeout after %.2fs", plugin.name, plugin.timeout
+                )
+            except Exception:
+                plugin.stats.failures += 1
+                logger.exception("plugin %s failed", plugin.name)
+            plugin.stats.runs += 1
+            plugin.stats.last_duration = time.time() - started
+
+            missed = math.floor((time.time() - next_run) / plugin.period)
+            if missed > 0:
+                plugin.stats.overruns += 1
+                plugin.stats.skipped += missed
+                logger.warning(
+                    "plugin %s overrun, took %.2fs, skip %d period(s)",
+                    plugin.name,
+                    plugin.stats.last_duration,
+                    missed,
+                )
+            next_run += (max(missed, 0) + 1) * plugin.period
+
     def signal_handler(self, sig, frame):
         self.should_exit = True
+        if self._loop is not None and self._exit_event is not None:
+            self._loop.call_soon_threadsafe(self._exit_event.set)
 
 
 signal_handler = SignalHandler()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""基于 asyncio streams 的 HTTP/1.1 客户端, 支持 keep-alive 连接池与流式读取响应"""
+import asyncio
+import logging
+import zlib
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class HTTPError(Exception):
+    """HTTP 请求失败"""
+
+
+class AsyncHTTPConnectionPool:
+    """单个 host 的 keep-alive 连接池, maxsize 同时限制了并发请求数
+
+    需要在事件循环内创建和使用
+    """
+
+    def __init__(self, host: str, port: int = 80, maxsize: int = 8, timeout=5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._idle: List[Connection] = []
+        self._semaphore = asyncio.Semaphore(maxsize)
+
+    async def _connect(self) -> Connection:
+        return await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout
+        )
+
+    def _release(self, conn: Connection, reusable: bool):
+        if reusable:
+            self._idle.append(conn)
+        else:
+            conn[1].close()
+
+    async def iter_lines(
+        self, path: str, headers: Optional[Dict[str, str]] = None
+    ) -> AsyncIterator[bytes]:
+        """发送 GET 请求, 逐行返回响应体"""
+        async with self._semaphore:
+            # 复用的空闲连接可能已被服务端关闭, 此时换一个新连接重试
+            reused = bool(self._idle)
+            conn = self._idle.pop() if reused else await self._connect()
+            reusable = False
+            # 任何异常(包括超时与取消)都由 finally 关闭当前连接, 只有完整读取了响应的连接才放回连接池
+            try:
+                try:
+                    status, response_headers = await self._send(conn, path, headers)
+                except (ConnectionError, asyncio.IncompleteReadError, HTTPError):
+                    if not reused:
+                        raise
+                    conn[1].close()
+                    conn = await self._connect()
+                    status, response_headers = await self._send(conn, path, headers)
+
+                if status != 200:
+                    raise HTTPError(f"GET {self.host}{path[:64]} returns {status}")
+                buffer = b""
+                async for chunk in self._iter_body(conn[0], response_headers):
+                    buffer += chunk
+                    *lines, buffer = buffer.split(b"\n")
+                    for line in lines:
+                        yield line
+                if buffer:
+                    yield buffer
+                reusable = response_headers.get("connection") != "close"
+            finally:
+                self._release(conn, reusable)
+
+    async def _send(
+        self, conn: Connection, path: str, headers: Optional[Dict[str, str]]
+    ) -> Tuple[int, Dict[str, str]]:
+        reader, writer = conn
+        lines = [
+            f"GET {path} HTTP/1.1",
+            f"Host: {self.host}",
+            "Connection: keep-alive",
+            "Accept-Encoding: gzip, deflate",
+            *(f"{key}: {value}" for key, value in (headers or {}).items()),
+        ]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+        status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+        if not status_line:
+            raise ConnectionError("connection closed by server")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            response_headers[key.strip().lower()] = value.strip().lower()
+        return status, response_headers
+
+    async def _iter_body(
+        self, reader: asyncio.StreamReader, headers: Dict[str, str]
+    ) -> AsyncIterator[bytes]:
+        decompressor = None
+        if headers.get("content-encoding") == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif headers.get("content-encoding") == "deflate":
+            decompressor = zlib.decompressobj()
+
+        async for chunk in self._iter_raw_body(reader, headers):
+            yield decompressor.decompress(chunk) if decompressor else chunk
+        if decompressor:
+            yield decompressor.flush()
+
+    async def _iter_raw_body(
+        self, reader: asyncio.StreamReader, headers: Dict[str, str]
+    ) -> AsyncIterator[bytes]:
+        if headers.get("transfer-encoding") == "chunked":
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), self.timeout)
+                size = int(size_line.split(b";")[0], 16)
+                if size == 0:
+                    # 忽略 trailer
+                    while await reader.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+                yield await asyncio.wait_for(reader.readexactly(size), self.timeout)
+                await reader.readexactly(2)
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining > 0:
+                chunk = await asyncio.wait_for(
+                    reader.read(min(remaining, 65536)), self.timeout
+                )
+                if not chunk:
+                    raise asyncio.IncompleteReadError(chunk, remaining)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            # 没有声明长度时读取到连接关闭为止
+            headers["connection"] = "close"
+            while True:
+                chunk = await asyncio.wait_for(reader.read(65536), self.timeout)
+                if not chunk:
+                    return
+                yield chunk
+
+    def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
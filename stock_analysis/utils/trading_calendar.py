@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""各市场交易日历: 交易时段、午休与节假日"""
+import bisect
+import datetime
+import logging
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import pytz
+
+from stock_analysis import settings
+from stock_analysis.constants import MarketType
+
+logger = logging.getLogger(__name__)
+
+Period = Tuple[datetime.time, datetime.time]
+# 交易日 -> 交易类型(WHOLE/MORNING/AFTERNOON)
+TradingDays = Dict[datetime.date, str]
+TradingDaysProvider = Callable[[str, int], TradingDays]
+
+
+@dataclass(frozen=True)
+class MarketSessions:
+    """市场的交易时段(当地时间), 包含集合竞价"""
+
+    timezone: str
+    morning: Tuple[Period, ...]
+    afternoon: Tuple[Period, ...]
+
+
+MARKET_SESSIONS = {
+    MarketType.SH: MarketSessions(
+        "Asia/Shanghai",
+        morning=((datetime.time(9, 15), datetime.time(11, 30)),),
+        afternoon=((datetime.time(13, 0), datetime.time(15, 0)),),
+    ),
+    MarketType.SZ: MarketSessions(
+        "Asia/Shanghai",
+        morning=((datetime.time(9, 15), datetime.time(11, 30)),),
+        afternoon=((datetime.time(13, 0), datetime.time(15, 0)),),
+    ),
+    MarketType.HK: MarketSessions(
+        "Asia/Hong_Kong",
+        morning=((datetime.time(9, 0), datetime.time(12, 0)),),
+        afternoon=((datetime.time(13, 0), datetime.time(16, 10)),),
+    ),
+    # 美股无午休, 半日市在 13:00 收市
+    MarketType.US: MarketSessions(
+        "America/New_York",
+        morning=((datetime.time(9, 30), datetime.time(13, 0)),),
+        afternoon=((datetime.time(13, 0), datetime.time(16, 0)),),
+    ),
+}
+
+
+def weekday_trading_days(market: str, year: int) -> TradingDays:
+    """以工作日减去 settings.MARKET_HOLIDAYS 作为交易日"""
+    holidays = {
+        datetime.date.fromisoformat(day)
+        for day in settings.MARKET_HOLIDAYS.get(market, [])
+    }
+    day = datetime.date(year, 1, 1)
+    result = {}
+    while day.year == year:
+        if day.weekday() < 5 and day not in holidays:
+            result[day] = "WHOLE"
+        day += datetime.timedelta(days=1)
+    return result
+
+
+class TradingCalendar:
+    """交易日历, 按 (市场, 年份) 预先计算并缓存全年的交易时段"""
+
+    def __init__(
+        self, provider: Optional[TradingDaysProvider] = None, padding: float = 60
+    ):
+        self.provider = provider or weekday_trading_days
+        # 交易时段前后额外放宽的秒数, 以免漏掉开盘前和收盘后的最后一笔 tick
+        self.padding = padding
+        self._cache: Dict[Tuple[str, int], Tuple[List[float], List[float]]] = {}
+
+    def get_trading_days(self, market: str, year: int) -> TradingDays:
+        try:
+            return self.provider(market, year)
+        except Exception:
+            logger.exception(
+                "fetch trading days of %s in %d failed, fallback to weekdays",
+                market,
+                year,
+            )
+            return weekday_trading_days(market, year)
+
+    def sessions(self, market: str, year: int) -> Tuple[List[float], List[float]]:
+        """获取 market 在 year 年内所有交易时段的开始/结束时间戳"""
+        key = (market, year)
+        if key in self._cache:
+            return self._cache[key]
+
+        market_sessions = MARKET_SESSIONS[MarketType(market)]
+        tz = pytz.timezone(market_sessions.timezone)
+        periods = []
+        for day, trade_date_type in sorted(self.get_trading_days(market, year).items()):
+            if trade_date_type in ("WHOLE", "MORNING"):
+                periods.extend(market_sessions.morning)
+            if trade_date_type in ("WHOLE", "AFTERNOON"):
+                periods.extend(market_sessions.afternoon)
+            for start, end in periods:
+                begin = tz.localize(datetime.datetime.combine(day, start))
+                finish = tz.localize(datetime.datetime.combine(day, end))
+                self._append(key, begin.timestamp(), finish.timestamp())
+            periods.clear()
+        return self._cache.setdefault(key, ([], []))
+
+    def _append(self, key: Tuple[str, int], start: float, end: float):
+        starts, ends = self._cache.setdefault(key, ([], []))
+        start, end = start - self.padding, end + self.padding
+        # 合并相邻或重叠的时段(如美股的上下午)
+        if ends and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+
+    def _year_of(self, market: str, ts: float) -> int:
+        tz = pytz.timezone(MARKET_SESSIONS[MarketType(market)].timezone)
+        return datetime.datetime.fromtimestamp(ts, tz).year
+
+    def is_open(self, market: str, ts: float) -> bool:
+        starts, ends = self.sessions(market, self._year_of(market, ts))
+        idx = bisect.bisect_right(starts, ts) - 1
+        return idx >= 0 and ts < ends[idx]
+
+    def next_open(self, market: str, ts: float) -> Optional[float]:
+        """获取 ts 之后(含)最近一个交易时段的开始时间, 若 ts 处于交易时段内则返回 ts"""
+        year = self._year_of(market, ts)
+        for y in (year, year + 1):
+            starts, ends = self.sessions(market, y)
+            idx = bisect.bisect_right(starts, ts) - 1
+            if idx >= 0 and ts < ends[idx]:
+                return ts
+            if idx + 1 < len(starts):
+                return starts[idx + 1]
+        return None
+
+    def is_open_any(self, markets: Iterable[str], ts: float) -> bool:
+        return any(self.is_open(market, ts) for market in markets)
+
+    def next_open_any(self, markets: Iterable[str], ts: float) -> Optional[float]:
+        candidates = [self.next_open(market, ts) for market in markets]
+        candidates = [c for c in candidates if c is not None]
+        return min(candidates) if candidates else None